@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+
+import numpy as np
+import shapely
+import geopandas as gpd
+from shapely.geometry import box
+
+from xmrgprocessing import __version__
+from xmrgprocessing.geoXmrg import geoXmrg, LatLong
+from xmrgprocessing.grid_geometry_cache import grid_geometry_cache
+from xmrgprocessing.boundary_weights import boundary_weights
+from xmrgprocessing.xmrg_results import xmrg_results
+from xmrgprocessing.xmrg_file_processing import xmrg_file_processing
+from xmrgprocessing.xmrgdatasaver.nexrad_data_saver import precipitation_saver
+
+from .synthetic_xmrg import write_xmrg_file, write_xmrg_archive, HEADER_VARIANTS
+
+# Bounding box that falls inside the default synthetic grid.
+MIN_LAT_LON = (32.0, -81.5)
+MAX_LAT_LON = (34.5, -78.0)
+
+
+class memory_saver(precipitation_saver):
+    '''
+    Saver that only keeps the results, used so the full run benchmark doesn't need a database.
+    '''
+    def __init__(self):
+        self.results = []
+        self.new_records_added = 0
+        self.records_updated = 0
+
+    def save(self, data):
+        self.results.append(data)
+        self.new_records_added += 1
+
+    def finalize(self):
+        pass
+
+
+def synthetic_boundaries(count):
+    '''
+    Builds count rectangular boundaries laid out in the middle of the benchmark bounding box. The HRAP grid is
+    rotated relative to lat/long, so the corners of the bounding box fall outside the cropped grid.
+    '''
+    columns = int(np.ceil(np.sqrt(count)))
+    lat_step = (MAX_LAT_LON[0] - MIN_LAT_LON[0]) * 0.6 / columns
+    lon_step = (MAX_LAT_LON[1] - MIN_LAT_LON[1]) * 0.6 / columns
+    boundaries = []
+    for ndx in range(count):
+        row, col = divmod(ndx, columns)
+        min_lat = MIN_LAT_LON[0] + (MAX_LAT_LON[0] - MIN_LAT_LON[0]) * 0.2 + row * lat_step
+        min_lon = MIN_LAT_LON[1] + (MAX_LAT_LON[1] - MIN_LAT_LON[1]) * 0.2 + col * lon_step
+        boundaries.append((f"Boundary {ndx}",
+                           box(min_lon + lon_step * 0.1, min_lat + lat_step * 0.1,
+                               min_lon + lon_step * 0.9, min_lat + lat_step * 0.9)))
+    return boundaries
+
+
+def time_it(name, func, repeat, setup=None, **params):
+    '''
+    Runs func repeat times and returns the timing statistics. setup is called before each run and its return
+    value is passed to func, its time isn't counted.
+    '''
+    timings = []
+    for run in range(repeat):
+        setup_value = setup() if setup is not None else None
+        start_time = time.perf_counter()
+        func(setup_value)
+        timings.append(time.perf_counter() - start_time)
+    result = {
+        'name': name,
+        'params': params,
+        'repeat': repeat,
+        'min_seconds': min(timings),
+        'mean_seconds': statistics.fmean(timings),
+        'median_seconds': statistics.median(timings),
+        'max_seconds': max(timings)
+    }
+    print(f"{name} {params}: median {result['median_seconds']:.6f}s min {result['min_seconds']:.6f}s")
+    return result
+
+
+def open_xmrg(file_path, **kwargs):
+    xmrg = geoXmrg(LatLong(*MIN_LAT_LON), LatLong(*MAX_LAT_LON), **kwargs)
+    xmrg.openFile(file_path)
+    return xmrg
+
+
+def read_header(file_path, **kwargs):
+    xmrg = open_xmrg(file_path, **kwargs)
+    if not xmrg.readFileHeader():
+        raise RuntimeError(f"Failed to read header for: {file_path} {xmrg.lastErrorMsg}")
+    return xmrg
+
+
+def benchmark_headers(work_directory, args):
+    results = []
+    for header_variant in HEADER_VARIANTS:
+        for byte_order in ('<', '>'):
+            for compress in (False, True):
+                file_path = os.path.join(work_directory, f"header_{header_variant}_{byte_order == '<'}_{compress}"
+                                                         f"{'.gz' if compress else ''}")
+                write_xmrg_file(file_path, header_variant=header_variant, byte_order=byte_order,
+                                compress=compress, maxx=args.maxx, maxy=args.maxy,
+                                rain_fraction=args.rain_fraction, seed=1)
+
+                def read(setup_value):
+                    read_header(file_path).cleanUp(False, False)
+
+                results.append(time_it('readFileHeader', read, args.repeat,
+                                       header_variant=header_variant, byte_order=byte_order, gzip=compress))
+    return results
+
+
+def benchmark_read_all_rows(work_directory, args):
+    results = []
+    for compress in (False, True):
+        file_path = os.path.join(work_directory, f"rows{'.gz' if compress else ''}")
+        write_xmrg_file(file_path, compress=compress, maxx=args.maxx, maxy=args.maxy,
+                        rain_fraction=args.rain_fraction, seed=2)
+        # Streaming only changes how gzip files are read.
+        for stream_compressed in ((True, False) if compress else (True,)):
+            for bulk_decode in (True, False):
+                for cached_geometry in (False, True):
+                    geometry_cache = grid_geometry_cache() if cached_geometry else None
+                    if geometry_cache is not None:
+                        # Prime the cache so the timed runs only decode.
+                        xmrg = read_header(file_path, geometry_cache=geometry_cache)
+                        xmrg.cellGeometries()
+                        xmrg.cleanUp(False, False)
+
+                    def setup():
+                        return read_header(file_path, bulk_decode=bulk_decode, geometry_cache=geometry_cache,
+                                           stream_compressed=stream_compressed)
+
+                    def read(xmrg):
+                        # The GeoDataFrame is built lazily, use it so the timings still include the geometry.
+                        xmrg.readAllRows()
+                        xmrg.geo_data_frame
+                        xmrg.cleanUp(False, False)
+
+                    results.append(time_it('readAllRows', read, args.repeat, setup=setup,
+                                           gzip=compress, stream_compressed=stream_compressed,
+                                           bulk_decode=bulk_decode, cached_geometry=cached_geometry,
+                                           maxx=args.maxx, maxy=args.maxy))
+    return results
+
+
+def benchmark_weighting(work_directory, args):
+    results = []
+    file_path = os.path.join(work_directory, "weighting")
+    write_xmrg_file(file_path, maxx=args.maxx, maxy=args.maxy, rain_fraction=args.rain_fraction, seed=3)
+    xmrg = read_header(file_path)
+    xmrg.readAllRows()
+    xmrg.cleanUp(False, False)
+    boundaries = synthetic_boundaries(args.boundaries)
+    precipitation = xmrg.geo_data_frame['Precipitation'].to_numpy()
+
+    def build(setup_value):
+        boundary_weights(boundaries).get_matrix(xmrg.gridSignature(), xmrg.geo_data_frame.geometry)
+
+    results.append(time_it('weight_matrix_build', build, args.repeat, boundaries=args.boundaries))
+
+    weight_matrix = boundary_weights(boundaries).get_matrix(xmrg.gridSignature(), xmrg.geo_data_frame.geometry)
+
+    def matrix(setup_value):
+        weight_matrix.weighted_averages(precipitation)
+
+    results.append(time_it('weighting', matrix, args.repeat, mode='matrix', boundaries=args.boundaries))
+
+    boundary_frames = [gpd.GeoDataFrame({'Name': [name]}, geometry=[geometry], crs="EPSG:4326")
+                       for name, geometry in boundaries]
+
+    def overlay(setup_value):
+        for boundary_row in boundary_frames:
+            overlayed = gpd.overlay(boundary_row, xmrg.geo_data_frame, how="intersection", keep_geom_type=False)
+            sum(overlayed['Precipitation'] * (overlayed.area / float(boundary_row.area.iloc[0])))
+
+    results.append(time_it('weighting', overlay, args.repeat, mode='overlay', boundaries=args.boundaries))
+
+    boundary_geometries = np.asarray([geometry for name, geometry in boundaries], dtype=object)
+    boundary_areas = shapely.area(boundary_geometries)
+
+    def batched_overlay(setup_value):
+        cell_geometries = xmrg.cellGeometries()
+        boundary_index, cell_index = cell_geometries.sindex.query(boundary_geometries, predicate='intersects')
+        intersections = shapely.intersection(boundary_geometries[boundary_index],
+                                             np.asarray(cell_geometries.values)[cell_index])
+        weights = shapely.area(intersections) / boundary_areas[boundary_index]
+        np.bincount(boundary_index, weights=precipitation[cell_index] * weights, minlength=len(boundaries))
+
+    results.append(time_it('weighting', batched_overlay, args.repeat, mode='batched_overlay',
+                           boundaries=args.boundaries))
+    return results
+
+
+def benchmark_saver(work_directory, args):
+    try:
+        from xmrgprocessing.xmrgdatasaver.nexrad_xenia_saver import nexrad_xenia_sqlite_saver
+    except ImportError as e:
+        print(f"Skipping saver benchmark: {e}")
+        return [{'name': 'nexrad_xenia_sqlite_saver', 'skipped': str(e)}]
+
+    results = []
+    boundary_names = [name for name, geometry in synthetic_boundaries(args.boundaries)]
+    start_date = datetime(2024, 1, 1)
+    save_results = []
+    for hour in range(args.hours):
+        result = xmrg_results()
+        result.datetime = (start_date + timedelta(hours=hour)).strftime("%Y-%m-%dT%H:00:00")
+        for ndx, boundary_name in enumerate(boundary_names):
+            result.add_boundary_result(boundary_name, 'weighted_average', float(ndx + hour) / 100.0)
+            result.set_boundary_centroid(boundary_name, (-80.0, 33.0))
+        save_results.append(result)
+
+    for batch_size in (None, 500):
+        def setup():
+            database_file = tempfile.mktemp(suffix='.sqlite', dir=work_directory)
+            return nexrad_xenia_sqlite_saver(database_file, batch_size=batch_size)
+
+        def save(saver):
+            for result in save_results:
+                saver.save(result)
+            saver.finalize()
+
+        results.append(time_it('nexrad_xenia_sqlite_saver', save, args.repeat, setup=setup,
+                               batch_size=batch_size, hours=args.hours, boundaries=args.boundaries))
+    return results
+
+
+def benchmark_process(work_directory, args):
+    results = []
+    base_xmrg_directory = os.path.join(work_directory, 'archive')
+    start_date = datetime(2024, 1, 1)
+    write_xmrg_archive(base_xmrg_directory, start_date, args.hours, maxx=args.maxx, maxy=args.maxy,
+                       rain_fraction=args.rain_fraction)
+    debug_directory = os.path.join(work_directory, 'debug')
+    log_directory = os.path.join(work_directory, 'logs')
+    os.makedirs(debug_directory, exist_ok=True)
+    os.makedirs(log_directory, exist_ok=True)
+    boundaries = synthetic_boundaries(args.boundaries)
+
+    for weighting_mode in ('matrix', 'overlay'):
+        def setup():
+            return xmrg_file_processing(worker_process_count=args.workers,
+                                        min_latitude_longitude=MIN_LAT_LON,
+                                        max_latitude_longitude=MAX_LAT_LON,
+                                        save_all_precip_values=True,
+                                        boundaries=boundaries,
+                                        source_file_working_directory=None,
+                                        delete_source_file=False,
+                                        delete_compressed_source_file=False,
+                                        kml_output_directory=debug_directory,
+                                        base_log_directory=log_directory,
+                                        weighting_mode=weighting_mode,
+                                        data_saver=memory_saver())
+
+        def process(file_processing):
+            file_processing.process(start_date=start_date,
+                                    end_date=start_date + timedelta(hours=args.hours),
+                                    base_xmrg_directory=base_xmrg_directory)
+            if file_processing.new_records_added != args.hours:
+                raise RuntimeError(f"Expected {args.hours} results, got {file_processing.new_records_added}")
+
+        results.append(time_it('xmrg_file_processing.process', process, args.repeat, setup=setup,
+                               weighting_mode=weighting_mode, hours=args.hours, workers=args.workers,
+                               boundaries=args.boundaries))
+    return results
+
+
+BENCHMARKS = {
+    'header': benchmark_headers,
+    'rows': benchmark_read_all_rows,
+    'weighting': benchmark_weighting,
+    'saver': benchmark_saver,
+    'process': benchmark_process
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the XMRG decode, weighting and save pipeline on "
+                                                 "synthetic files.")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write the results to.")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS.keys()), default=list(BENCHMARKS.keys()))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--maxx", type=int, default=335)
+    parser.add_argument("--maxy", type=int, default=159)
+    parser.add_argument("--rain_fraction", type=float, default=0.3)
+    parser.add_argument("--boundaries", type=int, default=10)
+    parser.add_argument("--hours", type=int, default=24)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="xmrg_benchmarks_") as work_directory:
+        for benchmark_name in args.benchmarks:
+            results.extend(BENCHMARKS[benchmark_name](work_directory, args))
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'package_version': __version__,
+        'git_revision': git_revision(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'geopandas': gpd.__version__,
+        'arguments': vars(args),
+        'results': results
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Wrote results to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
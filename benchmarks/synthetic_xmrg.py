@@ -0,0 +1,124 @@
+import os
+import gzip
+import struct
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from xmrgprocessing.xmrg_utilities import build_filename
+
+# Grid the generator uses by default. The origin and size cover the southeast US so the default bounding box
+# in the benchmarks falls inside it.
+DEFAULT_XOR = 900
+DEFAULT_YOR = 300
+DEFAULT_MAXX = 335
+DEFAULT_MAXY = 159
+
+# Info header variants readFileHeader supports, 0 is the pre June 1997 format with no info header.
+HEADER_VARIANTS = (66, 38, 37, 0)
+
+
+def synthetic_grid(maxx=DEFAULT_MAXX, maxy=DEFAULT_MAXY, rain_fraction=0.3, max_value=500, seed=None):
+    '''
+    Builds a (maxy, maxx) int16 grid of precipitation values in hundredths of a millimeter.
+    :param maxx: Number of columns.
+    :param maxy: Number of rows.
+    :param rain_fraction: Fraction of the cells that have rain, the rest are 0.
+    :param max_value: Largest value a raining cell can have.
+    :param seed: Random seed so the same grid can be regenerated.
+    :return:
+    '''
+    rng = np.random.default_rng(seed)
+    grid = rng.integers(1, max_value + 1, size=(maxy, maxx)).astype(np.int16)
+    grid[rng.random((maxy, maxx)) >= rain_fraction] = 0
+    return grid
+
+
+def xmrg_bytes(grid, xor=DEFAULT_XOR, yor=DEFAULT_YOR, header_variant=66, byte_order='<',
+               collection_date=None):
+    '''
+    Encodes a grid as an XMRG file, FORTRAN unformatted records with a 4 byte tag before and after each record.
+    :param grid: (MAXY, MAXX) int16 array.
+    :param xor: HRAP X origin.
+    :param yor: HRAP Y origin.
+    :param header_variant: 66, 38 or 37 for the info header size, 0 for the pre 1997 format without one.
+    :param byte_order: '<' for little endian or '>' for big endian.
+    :param collection_date: datetime written in the 66 byte info header.
+    :return: The file contents as bytes.
+    '''
+    if header_variant not in HEADER_VARIANTS:
+        raise ValueError(f"Unknown header variant: {header_variant}")
+    maxy, maxx = grid.shape
+    if collection_date is None:
+        collection_date = datetime(2024, 1, 1)
+
+    def record(payload):
+        return struct.pack(f"{byte_order}I", len(payload)) + payload + struct.pack(f"{byte_order}I", len(payload))
+
+    contents = [record(struct.pack(f"{byte_order}4i", xor, yor, maxx, maxy))]
+    valid_date = collection_date.strftime('%Y-%m-%d').encode('ascii')
+    valid_time = collection_date.strftime('%H:%M:%S').encode('ascii')
+    if header_variant == 66:
+        contents.append(record(struct.pack(f"{byte_order}2s8s10s10s8s10s10sif",
+                                           b'LX', b'synthetc', valid_date, valid_time, b'QPE01',
+                                           valid_date, valid_time, int(grid.max()), 1.0)))
+    elif header_variant in (38, 37):
+        info = struct.pack('10s10s10s8s', b'synthetic', valid_date, valid_time, b'QPE01')
+        contents.append(record(info[:header_variant]))
+
+    rows = np.empty(maxy, dtype=np.dtype([('lead_tag', f"{byte_order}u4"),
+                                          ('data', f"{byte_order}i2", (maxx,)),
+                                          ('tail_tag', f"{byte_order}u4")]))
+    rows['lead_tag'] = maxx * 2
+    rows['data'] = grid
+    rows['tail_tag'] = maxx * 2
+    contents.append(rows.tobytes())
+    return b''.join(contents)
+
+
+def write_xmrg_file(file_path, grid=None, xor=DEFAULT_XOR, yor=DEFAULT_YOR, header_variant=66, byte_order='<',
+                    compress=None, collection_date=None, **grid_kwargs):
+    '''
+    Writes a synthetic XMRG file.
+    :param file_path: Where to write the file.
+    :param grid: The grid to write, if None one is built with synthetic_grid(**grid_kwargs).
+    :param xor: HRAP X origin.
+    :param yor: HRAP Y origin.
+    :param header_variant: 66, 38 or 37 for the info header size, 0 for the pre 1997 format without one.
+    :param byte_order: '<' for little endian or '>' for big endian.
+    :param compress: If True the file is gzipped. Defaults to True if file_path ends with .gz.
+    :param collection_date: datetime written in the 66 byte info header.
+    :return: The grid that was written.
+    '''
+    if grid is None:
+        grid = synthetic_grid(**grid_kwargs)
+    if compress is None:
+        compress = file_path.endswith('.gz')
+    contents = xmrg_bytes(grid, xor, yor, header_variant, byte_order, collection_date)
+    if compress:
+        contents = gzip.compress(contents, compresslevel=6)
+    with open(file_path, 'wb') as xmrg_file:
+        xmrg_file.write(contents)
+    return grid
+
+
+def write_xmrg_archive(base_path, start_date, hour_count, compress=True, **file_kwargs):
+    '''
+    Writes hourly synthetic files in the {base_path}/{year}/{month} layout xmrg_file_iterator expects.
+    :param base_path: Parent directory of the year directories.
+    :param start_date: datetime of the first file.
+    :param hour_count: Number of hourly files to write.
+    :param compress: If True the files are gzipped.
+    :param file_kwargs: Passed on to write_xmrg_file, seed is offset by the hour so each file differs.
+    :return: List of the file paths written.
+    '''
+    file_paths = []
+    seed = file_kwargs.pop('seed', 0)
+    for hour in range(hour_count):
+        file_date = start_date + timedelta(hours=hour)
+        directory = os.path.join(base_path, str(file_date.year), file_date.strftime('%b'))
+        os.makedirs(directory, exist_ok=True)
+        file_path = os.path.join(directory, build_filename(file_date, 'gz' if compress else ''))
+        write_xmrg_file(file_path, compress=compress, collection_date=file_date, seed=seed + hour, **file_kwargs)
+        file_paths.append(file_path)
+    return file_paths
@@ -0,0 +1,188 @@
+import os
+import gzip
+import time
+import threading
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from xmrgprocessing.xmrg_utilities import http_download_file, download_files, create_download_session
+from xmrgprocessing.xmrgfileiterator.xmrg_download_iterator import xmrg_download_iterator
+
+LAST_MODIFIED = formatdate(datetime(2024, 10, 1, 10).timestamp(), usegmt=True)
+
+
+class stand_in_server:
+    '''
+    Local HTTP server standing in for the NWS download site. Files are served from a dict, every request is
+    recorded and a path can be made to fail a number of times before it is served.
+    '''
+    def __init__(self):
+        self.files = {}
+        self.failures = {}
+        self.truncated = set()
+        self.requests = []
+        self.delay = 0.0
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = self.path.lstrip('/')
+                with server._lock:
+                    server.requests.append((name, self.headers.get('If-Modified-Since', None)))
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                try:
+                    time.sleep(server.delay)
+                    self.send_file(name)
+                finally:
+                    with server._lock:
+                        server.active -= 1
+
+            def send_file(self, name):
+                if server.failures.get(name, 0) > 0:
+                    server.failures[name] -= 1
+                    self.send_error(503)
+                    return
+                if name not in server.files:
+                    self.send_error(404)
+                    return
+                data, last_modified = server.files[name]
+                if_modified_since = self.headers.get('If-Modified-Since', None)
+                if if_modified_since is not None and last_modified is not None and \
+                        parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(last_modified):
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                if last_modified is not None:
+                    self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                if name in server.truncated:
+                    # Close the connection part way through the body.
+                    self.wfile.write(data[:len(data) // 2])
+                    self.close_connection = True
+                else:
+                    self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def request_count(self, name):
+        return len([request for request in self.requests if request[0] == name])
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def server():
+    stand_in = stand_in_server()
+    yield stand_in
+    stand_in.close()
+
+
+def file_data(ndx):
+    return bytes([ndx]) * 1000 + os.urandom(64)
+
+
+def test_download_files_in_parallel(server, tmp_path):
+    file_names = [f"xmrg01012024{hour:02d}z.gz" for hour in range(8)]
+    for ndx, file_name in enumerate(file_names):
+        server.files[file_name] = (file_data(ndx), LAST_MODIFIED)
+    server.delay = 0.2
+    downloaded = download_files(file_names, str(tmp_path), server.url, max_workers=4)
+    assert downloaded == [str(tmp_path / file_name) for file_name in file_names]
+    for file_name in file_names:
+        assert (tmp_path / file_name).read_bytes() == server.files[file_name][0]
+    assert server.max_active > 1
+    assert not list(tmp_path.glob('*.part'))
+
+
+def test_download_is_renamed_into_place(server, tmp_path):
+    server.files['good.gz'] = (file_data(1), LAST_MODIFIED)
+    server.files['truncated.gz'] = (file_data(2), LAST_MODIFIED)
+    server.truncated.add('truncated.gz')
+    assert http_download_file(server.url, 'good.gz', str(tmp_path)) == str(tmp_path / 'good.gz')
+    # The server's modified time is kept so the next request can be conditional.
+    assert os.path.getmtime(tmp_path / 'good.gz') == parsedate_to_datetime(LAST_MODIFIED).timestamp()
+    assert http_download_file(server.url, 'truncated.gz', str(tmp_path)) is None
+    assert sorted(os.listdir(tmp_path)) == ['good.gz']
+
+
+def test_skip_existing(server, tmp_path):
+    server.files['xmrg0101202400z.gz'] = (file_data(1), LAST_MODIFIED)
+    (tmp_path / 'xmrg0101202400z.gz').write_bytes(b'already here')
+    downloaded = http_download_file(server.url, 'xmrg0101202400z.gz', str(tmp_path), skip_existing=True)
+    assert downloaded == str(tmp_path / 'xmrg0101202400z.gz')
+    assert (tmp_path / 'xmrg0101202400z.gz').read_bytes() == b'already here'
+    assert server.requests == []
+
+
+def test_not_modified(server, tmp_path):
+    server.files['xmrg0101202400z.gz'] = (file_data(1), LAST_MODIFIED)
+    session = create_download_session()
+    file_path = http_download_file(server.url, 'xmrg0101202400z.gz', str(tmp_path), session=session)
+    # The second request is conditional on the first download's time and the server says it's unchanged.
+    assert http_download_file(server.url, 'xmrg0101202400z.gz', str(tmp_path), session=session) == file_path
+    assert server.requests[0][1] is None
+    assert parsedate_to_datetime(server.requests[1][1]) == parsedate_to_datetime(LAST_MODIFIED)
+    assert (tmp_path / 'xmrg0101202400z.gz').read_bytes() == server.files['xmrg0101202400z.gz'][0]
+    session.close()
+
+
+def test_bad_last_modified_keeps_file(server, tmp_path):
+    server.files['xmrg0101202400z.gz'] = (file_data(1), 'not a date')
+    downloaded = http_download_file(server.url, 'xmrg0101202400z.gz', str(tmp_path))
+    assert downloaded == str(tmp_path / 'xmrg0101202400z.gz')
+    assert (tmp_path / 'xmrg0101202400z.gz').read_bytes() == server.files['xmrg0101202400z.gz'][0]
+
+
+def test_retries_server_errors(server, tmp_path):
+    server.files['xmrg0101202400z.gz'] = (file_data(1), LAST_MODIFIED)
+    server.failures['xmrg0101202400z.gz'] = 2
+    session = create_download_session(retries=3, backoff_factor=0)
+    downloaded = http_download_file(server.url, 'xmrg0101202400z.gz', str(tmp_path), session=session)
+    session.close()
+    assert downloaded == str(tmp_path / 'xmrg0101202400z.gz')
+    assert server.request_count('xmrg0101202400z.gz') == 3
+
+
+def test_retries_give_up(server, tmp_path):
+    server.files['xmrg0101202400z.gz'] = (file_data(1), LAST_MODIFIED)
+    server.failures['xmrg0101202400z.gz'] = 10
+    session = create_download_session(retries=2, backoff_factor=0)
+    assert http_download_file(server.url, 'xmrg0101202400z.gz', str(tmp_path), session=session) is None
+    session.close()
+    assert server.request_count('xmrg0101202400z.gz') == 3
+    assert os.listdir(tmp_path) == []
+
+
+def test_download_iterator_decompress(server, tmp_path):
+    data = file_data(1)
+    server.files['xmrg0101202400z.gz'] = (gzip.compress(data), LAST_MODIFIED)
+    server.files['xmrg0101202401z.gz'] = (gzip.compress(data)[:-20], LAST_MODIFIED)
+    server.files['xmrg0101202402z.gz'] = (b'not gzip data', LAST_MODIFIED)
+    iterator = xmrg_download_iterator(download_url=server.url, destination_directory=str(tmp_path),
+                                      decompress=True, max_workers=2)
+    iterator.setup_iterator(start_date=datetime(2024, 1, 1, 0), end_date=datetime(2024, 1, 1, 4))
+    downloaded = list(iterator)
+    assert downloaded == [str(tmp_path / 'xmrg0101202400z')]
+    assert (tmp_path / 'xmrg0101202400z').read_bytes() == data
+    assert sorted(iterator.failed_files) == ['xmrg0101202401z.gz', 'xmrg0101202402z.gz', 'xmrg0101202403z.gz']
+    assert sorted(os.listdir(tmp_path)) == ['xmrg0101202400z']
@@ -0,0 +1,71 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+from shapely.geometry import box
+
+from benchmarks.synthetic_xmrg import write_xmrg_file
+from xmrgprocessing.xmrg_processing import xmrg_processing_geopandas
+from xmrgprocessing.xmrg_utilities import build_filename
+from xmrgprocessing.rolling_accumulation import accumulation_result_type
+
+MIN_LAT_LON = (32.0, -81.5)
+MAX_LAT_LON = (34.5, -78.0)
+BOUNDARIES = [('Alpha', box(-80.9, 32.6, -80.2, 33.1)),
+              ('Beta', box(-79.5, 33.2, -78.9, 33.9))]
+START_DATE = datetime(2024, 1, 1)
+WINDOW = 3
+
+
+def write_files(directory, hours):
+    file_paths = []
+    for hour in hours:
+        file_date = START_DATE + timedelta(hours=hour)
+        file_path = directory / build_filename(file_date, 'gz')
+        write_xmrg_file(str(file_path), maxx=335, maxy=159, rain_fraction=0.4, seed=hour, collection_date=file_date)
+        file_paths.append(str(file_path))
+    return file_paths
+
+
+def run(file_paths, log_directory, **kwargs):
+    results = {}
+    processing = xmrg_processing_geopandas()
+    processing.setup(worker_process_count=2, min_latitude_longitude=MIN_LAT_LON,
+                     max_latitude_longitude=MAX_LAT_LON, boundaries=BOUNDARIES,
+                     base_log_output_directory=str(log_directory),
+                     callback_function=lambda xmrg_results_data: results.update(
+                         {xmrg_results_data.datetime: dict(xmrg_results_data.get_boundary_data())}),
+                     accumulation_windows=[WINDOW], **kwargs)
+    processing.import_files(iter(file_paths))
+    return results
+
+
+@pytest.mark.parametrize('execution_backend', ['serial', 'queue', 'pool'])
+def test_rerun_keeps_rolling_totals(tmp_path, execution_backend):
+    file_paths = write_files(tmp_path, range(9))
+    ledger_file = str(tmp_path / 'ledger.sqlite')
+    expected = run(file_paths, tmp_path, execution_backend='serial')
+
+    first_run = run(file_paths[:6], tmp_path, execution_backend=execution_backend, ledger_file=ledger_file)
+    assert sorted(first_run) == sorted(expected)[:6]
+    # The re-run skips the first 6 hours, the totals for the new hours still include them.
+    rerun = run(file_paths, tmp_path, execution_backend=execution_backend, ledger_file=ledger_file)
+    assert sorted(rerun) == sorted(expected)[6:]
+    result_type = accumulation_result_type(WINDOW)
+    for result_date, boundary_results in rerun.items():
+        for boundary_name, _ in BOUNDARIES:
+            assert boundary_results[boundary_name][result_type] == \
+                pytest.approx(expected[result_date][boundary_name][result_type])
+
+
+def test_rerun_without_saved_values_processes_again(tmp_path):
+    file_paths = write_files(tmp_path, range(4))
+    ledger_file = str(tmp_path / 'ledger.sqlite')
+    run(file_paths[:3], tmp_path, execution_backend='serial', ledger_file=ledger_file)
+    # A ledger written before the weighted averages were kept.
+    with sqlite3.connect(ledger_file) as db:
+        db.execute("UPDATE processed_files SET result_date = NULL, weighted_averages = NULL")
+    db.close()
+    rerun = run(file_paths, tmp_path, execution_backend='serial', ledger_file=ledger_file)
+    assert len(rerun) == 4
+    assert accumulation_result_type(WINDOW) in rerun['2024-01-01T03:00:00']['Alpha']
@@ -0,0 +1,296 @@
+import logging
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from .shared_artifacts import pack_geometries, unpack_geometries
+
+
+def build_intersection_frame(boundary_name, precipitation, weights, intersections, epsg=4326):
+    '''
+    Builds the GeoDataFrame of a boundary's intersections with the grid cells that the overlay path produces.
+    :param boundary_name: Name of the boundary.
+    :param precipitation: Array of the values of the intersecting cells.
+    :param weights: Array of the fraction of the boundary area each intersection covers.
+    :param intersections: Array of the intersection polygons.
+    :param epsg: EPSG code of the polygons.
+    :return: GeoDataFrame with Name, Precipitation, percent and weighted average columns.
+    '''
+    precipitation = np.asarray(precipitation, dtype=np.float64)
+    return gpd.GeoDataFrame({'Name': [boundary_name] * len(precipitation),
+                             'Precipitation': precipitation,
+                             'percent': weights,
+                             'weighted average': precipitation * weights},
+                            geometry=intersections,
+                            crs=f"EPSG:{epsg}")
+
+
+class boundary_weight_matrix:
+    '''
+    Sparse (boundary x cell) matrix of the fraction of each boundary's area covered by each grid cell.
+    The matrix is stored in coordinate form: for every intersecting boundary/cell pair we keep the boundary
+    index, the cell index and the weight, which is the area of the intersection divided by the boundary area.
+    This is the same percentage the gpd.overlay path calculates, so the weighted average for every boundary
+    becomes a sparse matrix-vector product with the cell precipitation values.
+    '''
+    def __init__(self, boundary_names, boundary_geometries, cell_geometries, epsg=4326):
+        '''
+
+        :param boundary_names: List of the boundary names.
+        :param boundary_geometries: List or array of the boundary polygons, in the same order as the names.
+        :param cell_geometries: GeoSeries of the grid cell polygons. The cell index is the position in this series.
+        :param epsg: EPSG code of the geometries, used for the debug frames.
+        '''
+        self._boundary_names = list(boundary_names)
+        self._epsg = epsg
+        self._cell_count = len(cell_geometries)
+        boundary_geometries = np.asarray(boundary_geometries, dtype=object)
+        self._boundary_areas = shapely.area(boundary_geometries)
+
+        boundary_index, cell_index = cell_geometries.sindex.query(boundary_geometries, predicate='intersects')
+        order = np.lexsort((cell_index, boundary_index))
+        boundary_index = boundary_index[order]
+        cell_index = cell_index[order]
+
+        intersections = shapely.intersection(boundary_geometries[boundary_index],
+                                             np.asarray(cell_geometries.values)[cell_index])
+        weights = shapely.area(intersections) / self._boundary_areas[boundary_index]
+        # Cells that only touch the boundary have no area and add nothing to the average.
+        keep = weights > 0.0
+        self._boundary_index = boundary_index[keep].astype(np.int32)
+        self._cell_index = cell_index[keep].astype(np.int64)
+        self._weights = weights[keep]
+        self._intersections = intersections[keep]
+        self._intersection_wkb = None
+        self._cell_order = None
+        self._sorted_cells = None
+        # Start and end offset of each boundary's entries, the entries are sorted by boundary.
+        self._boundary_offsets = np.searchsorted(self._boundary_index, np.arange(len(self._boundary_names) + 1))
+
+        # The center of the cells covering each boundary. The intersections don't overlap, so the area weighted
+        # mean of their centroids is the centroid of their union. Boundaries with no cells use their own centroid.
+        areas = shapely.area(self._intersections)
+        centroids = shapely.get_coordinates(shapely.centroid(self._intersections))
+        boundary_count = len(self._boundary_names)
+        total_areas = np.bincount(self._boundary_index, weights=areas, minlength=boundary_count)
+        self._centroids = shapely.get_coordinates(shapely.centroid(boundary_geometries))
+        has_cells = total_areas > 0.0
+        for axis in range(2):
+            axis_sum = np.bincount(self._boundary_index, weights=areas * centroids[:, axis], minlength=boundary_count)
+            self._centroids[has_cells, axis] = axis_sum[has_cells] / total_areas[has_cells]
+
+    @classmethod
+    def from_arrays(cls, boundary_names, arrays, epsg=4326):
+        '''
+        Rebuilds a matrix from the arrays returned by to_arrays, such as views onto a shared memory block. The
+        arrays are used as is, not copied. The intersection polygons are only decoded if they are asked for.
+        :param boundary_names: List of the boundary names.
+        :param arrays: Dict, or anything with get(name), of the arrays.
+        :param epsg: EPSG code of the geometries.
+        :return: boundary_weight_matrix
+        '''
+        weight_matrix = cls.__new__(cls)
+        weight_matrix._boundary_names = list(boundary_names)
+        weight_matrix._epsg = epsg
+        weight_matrix._cell_count = int(arrays.get('cell_count')[0])
+        weight_matrix._boundary_areas = arrays.get('boundary_areas')
+        weight_matrix._boundary_index = arrays.get('boundary_index')
+        weight_matrix._cell_index = arrays.get('cell_index')
+        weight_matrix._weights = arrays.get('weights')
+        weight_matrix._boundary_offsets = arrays.get('boundary_offsets')
+        weight_matrix._centroids = arrays.get('centroids')
+        weight_matrix._intersections = None
+        weight_matrix._intersection_wkb = (arrays.get('intersection_wkb'), arrays.get('intersection_offsets'))
+        weight_matrix._cell_order = None
+        weight_matrix._sorted_cells = None
+        return weight_matrix
+
+    def to_arrays(self):
+        '''
+        Returns the matrix as a dict of numpy arrays that from_arrays can rebuild it from.
+        :return:
+        '''
+        intersection_wkb, intersection_offsets = pack_geometries(self.intersections)
+        return {'cell_count': np.array([self._cell_count], dtype=np.int64),
+                'boundary_areas': self._boundary_areas,
+                'boundary_index': self._boundary_index,
+                'cell_index': self._cell_index,
+                'weights': self._weights,
+                'boundary_offsets': self._boundary_offsets,
+                'centroids': self._centroids,
+                'intersection_wkb': intersection_wkb,
+                'intersection_offsets': intersection_offsets}
+
+    @property
+    def intersections(self):
+        if self._intersections is None:
+            self._intersections = unpack_geometries(*self._intersection_wkb)
+            self._intersection_wkb = None
+        return self._intersections
+
+    @property
+    def boundary_names(self):
+        return self._boundary_names
+
+    @property
+    def cell_count(self):
+        return self._cell_count
+
+    @property
+    def entry_count(self):
+        return len(self._weights)
+
+    def weighted_averages(self, values):
+        '''
+        Calculates the weighted average of the cell values for every boundary.
+        :param values: Array of the cell values, ordered the same as the cell geometries the matrix was built from.
+        :return: Array of the weighted averages, one per boundary.
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        return np.bincount(self._boundary_index,
+                           weights=self._weights * values[self._cell_index],
+                           minlength=len(self._boundary_names))
+
+    def nonzero_entries(self, sparse):
+        '''
+        Finds the matrix entries whose cell is in the sparse grid. Only the nonzero cells are looked up, so the
+        cost follows the number of raining cells rather than the size of the matrix.
+        :param sparse: sparse_grid of the window the matrix was built for.
+        :return: Tuple of (entry indexes, the raw cell value for each entry). The entries are in matrix order,
+          so they are grouped by boundary.
+        '''
+        if self._cell_order is None:
+            # The entries sorted by cell, built the first time the matrix is used with a sparse grid.
+            self._cell_order = np.argsort(self._cell_index, kind='stable')
+            self._sorted_cells = self._cell_index[self._cell_order]
+        first = np.searchsorted(self._sorted_cells, sparse.cell_index, side='left')
+        counts = np.searchsorted(self._sorted_cells, sparse.cell_index, side='right') - first
+        # Expand each nonzero cell into the positions of its entries in the cell sorted order.
+        group_starts = np.cumsum(counts) - counts
+        positions = np.repeat(first - group_starts, counts) + np.arange(counts.sum())
+        entries = self._cell_order[positions]
+        values = np.repeat(sparse.values, counts)
+        order = np.argsort(entries, kind='stable')
+        return entries[order], values[order]
+
+    def entry_weighted_averages(self, entries, values):
+        '''
+        Calculates the weighted average for every boundary from a subset of the entries, the entries that aren't
+        given are taken as 0.
+        :param entries: Array of entry indexes from nonzero_entries.
+        :param values: Array of the cell value for each entry.
+        :return: Array of the weighted averages, one per boundary.
+        '''
+        return np.bincount(self._boundary_index[entries],
+                           weights=self._weights[entries] * values,
+                           minlength=len(self._boundary_names))
+
+    def entry_offsets(self, entries):
+        '''
+        Returns the start and end offset of each boundary's entries in an array from nonzero_entries.
+        :param entries:
+        :return: Array of len(boundary_names) + 1 offsets.
+        '''
+        return np.searchsorted(self._boundary_index[entries], np.arange(len(self._boundary_names) + 1))
+
+    def entry_cells(self, entries):
+        '''
+        Returns the cell indexes and weights of the given entries.
+        :param entries:
+        :return: Tuple of (cell indexes, weights).
+        '''
+        return (self._cell_index[entries], self._weights[entries])
+
+    def boundary_centroid(self, boundary_ndx):
+        '''
+        Returns the (longitude, latitude) center of the grid cells covering the boundary.
+        :param boundary_ndx: Index of the boundary.
+        :return:
+        '''
+        return (float(self._centroids[boundary_ndx, 0]), float(self._centroids[boundary_ndx, 1]))
+
+    def boundary_cells(self, boundary_ndx):
+        '''
+        Returns the cell indexes and weights for a boundary.
+        :param boundary_ndx: Index of the boundary.
+        :return: Tuple of (cell indexes, weights).
+        '''
+        start = self._boundary_offsets[boundary_ndx]
+        end = self._boundary_offsets[boundary_ndx + 1]
+        return (self._cell_index[start:end], self._weights[start:end])
+
+    def boundary_entries(self, boundary_ndx):
+        '''
+        Returns the cell indexes, weights and intersection polygons for a boundary.
+        :param boundary_ndx: Index of the boundary.
+        :return: Tuple of (cell indexes, weights, intersection polygons).
+        '''
+        start = self._boundary_offsets[boundary_ndx]
+        end = self._boundary_offsets[boundary_ndx + 1]
+        return (self._cell_index[start:end], self._weights[start:end], self.intersections[start:end])
+
+    def boundary_frame(self, boundary_ndx, values):
+        '''
+        Builds the same GeoDataFrame the overlay path produces for a boundary. This is only used for the debug
+        output files.
+        :param boundary_ndx: Index of the boundary.
+        :param values: Array of the cell values.
+        :return: GeoDataFrame with Name, Precipitation, percent and weighted average columns.
+        '''
+        cell_index, weights, intersections = self.boundary_entries(boundary_ndx)
+        return build_intersection_frame(self._boundary_names[boundary_ndx], np.asarray(values)[cell_index],
+                                        weights, intersections, self._epsg)
+
+
+class boundary_weights:
+    '''
+    Holds the boundaries being processed and builds a boundary_weight_matrix once per grid signature.
+    Every file with the same signature reuses the matrix, so the intersections are only computed once per
+    grid and boundary set instead of once per file.
+    '''
+    def __init__(self, boundaries, epsg=4326):
+        '''
+
+        :param boundaries: List of (name, polygon) tuples.
+        :param epsg: EPSG code of the boundary polygons.
+        '''
+        self._logger = logging.getLogger()
+        self._boundary_names = [boundary[0] for boundary in boundaries]
+        self._boundary_geometries = [boundary[1] for boundary in boundaries]
+        self._epsg = epsg
+        self._matrices = {}
+
+    def add_matrix(self, signature, weight_matrix):
+        '''
+        Adds a matrix built elsewhere, such as one the parent process shared, for the grid signature.
+        :param signature: The tuple returned by geoXmrg.gridSignature().
+        :param weight_matrix: boundary_weight_matrix built for the same boundaries.
+        :return:
+        '''
+        self._matrices[signature] = weight_matrix
+
+    def find_matrix(self, signature):
+        '''
+        Returns the weight matrix for the grid signature if it has already been built, otherwise None.
+        :param signature: The tuple returned by geoXmrg.gridSignature().
+        :return: boundary_weight_matrix or None
+        '''
+        return self._matrices.get(signature, None)
+
+    def get_matrix(self, signature, cell_geometries):
+        '''
+        Returns the weight matrix for the grid signature, building it if this is the first time we've seen it.
+        :param signature: The tuple returned by geoXmrg.gridSignature().
+        :param cell_geometries: GeoSeries of the grid cell polygons for the signature.
+        :return: boundary_weight_matrix
+        '''
+        weight_matrix = self._matrices.get(signature, None)
+        if weight_matrix is None:
+            weight_matrix = boundary_weight_matrix(self._boundary_names,
+                                                   self._boundary_geometries,
+                                                   cell_geometries,
+                                                   self._epsg)
+            self._logger.debug(f"Built boundary weight matrix for grid: {signature} "
+                               f"with {weight_matrix.entry_count} entries.")
+            self._matrices[signature] = weight_matrix
+        return weight_matrix
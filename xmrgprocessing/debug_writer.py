@@ -0,0 +1,155 @@
+import os
+import queue
+import logging
+import threading
+from datetime import datetime, timedelta
+
+# Output formats and the file extension used for each.
+DEBUG_FORMATS = {
+    'geojson': '.json',
+    'flatgeobuf': '.fgb',
+    'geoparquet': '.parquet'
+}
+DEFAULT_DEBUG_QUEUE_SIZE = 8
+EPOCH = datetime(1970, 1, 1)
+
+
+class debug_writer:
+    '''
+    Writes the debug GeoDataFrames from a background thread so the processing loop never waits on them.
+    Frames are handed over on a bounded queue, one at a time or as a batch, such as all the files for one XMRG
+    file, that takes a single slot and is written or dropped as a whole. If the queue is full the frames are
+    dropped rather than blocking the worker. A frame can be passed as a callable, which is then only built in
+    the writer thread, so it must only use data that the worker won't change afterwards.
+    The sampling controls decide which files get debug output: specific dates, every Nth hour, or by default
+    only the first file a worker processes.
+    '''
+    def __init__(self, output_directory, output_format='geojson', queue_size=DEFAULT_DEBUG_QUEUE_SIZE,
+                 every_nth_hour=None, dates=None):
+        '''
+
+        :param output_directory: Directory the debug files are written to.
+        :param output_format: 'geojson', 'flatgeobuf' or 'geoparquet'. GeoParquet needs pyarrow, if it isn't
+          installed FlatGeobuf is used instead.
+        :param queue_size: Number of frames that can be waiting to be written.
+        :param every_nth_hour: If set, files whose hour since the epoch is a multiple of this are written. Using the
+          file date instead of a count keeps the sample the same however the files are spread over the workers.
+        :param dates: If set, list of dates or ISO date strings, files on those days or hours are written.
+        '''
+        self._logger = logging.getLogger()
+        self._output_directory = output_directory
+        if output_format not in DEBUG_FORMATS:
+            raise ValueError(f"Unknown debug output format: {output_format}")
+        if output_format == 'geoparquet':
+            try:
+                import pyarrow
+            except ImportError:
+                self._logger.error("GeoParquet debug output needs pyarrow, writing FlatGeobuf instead.")
+                output_format = 'flatgeobuf'
+        self._output_format = output_format
+        self._every_nth_hour = every_nth_hour
+        self._dates = None
+        if dates:
+            self._dates = tuple(date.isoformat() if isinstance(date, datetime) else str(date) for date in dates)
+        self._files_sampled = 0
+        self._written_count = 0
+        self._dropped_count = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self.write_frames, name="xmrg_debug_writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def written_count(self):
+        return self._written_count
+
+    @property
+    def dropped_count(self):
+        return self._dropped_count
+
+    def file_path(self, base_name):
+        return os.path.join(self._output_directory, f"{base_name}{DEBUG_FORMATS[self._output_format]}")
+
+    def wants(self, file_date):
+        '''
+        Checks the sampling controls for a file.
+        :param file_date: The file's date as the "%Y-%m-%dT%H:%M:%S" string the workers use.
+        :return: True if debug output should be written for the file.
+        '''
+        if self._dates is not None:
+            sampled = file_date.startswith(self._dates)
+        elif self._every_nth_hour:
+            hour = (datetime.strptime(file_date, "%Y-%m-%dT%H:%M:%S") - EPOCH) // timedelta(hours=1)
+            sampled = (hour % self._every_nth_hour) == 0
+        else:
+            sampled = self._files_sampled == 0
+        if sampled:
+            self._files_sampled += 1
+        return sampled
+
+    def submit(self, base_name, frame, overwrite=True):
+        '''
+        Queues a frame to be written without blocking.
+        :param base_name: File name without the extension.
+        :param frame: GeoDataFrame or a callable that returns one.
+        :param overwrite: If False and the file already exists, nothing is written.
+        :return: True if the frame was queued.
+        '''
+        return self.submit_batch([(base_name, frame)], overwrite)
+
+    def submit_batch(self, frames, overwrite=True):
+        '''
+        Queues several frames as one item without blocking. They are all written, or if the queue is full all
+        dropped, so the output for a file is never a partial set.
+        :param frames: List of (base_name, frame) tuples.
+        :param overwrite: If False, files that already exist are not written.
+        :return: True if the frames were queued.
+        '''
+        batch = [(self.file_path(base_name), frame) for base_name, frame in frames]
+        if not overwrite:
+            batch = [(file_path, frame) for file_path, frame in batch if not os.path.exists(file_path)]
+        if not batch:
+            return False
+        try:
+            self._queue.put_nowait(batch)
+        except queue.Full:
+            self._dropped_count += len(batch)
+            self._logger.error(f"Debug writer queue is full, dropped {len(batch)} debug files.")
+            return False
+        return True
+
+    def write_frames(self):
+        for batch in iter(self._queue.get, None):
+            for file_path, frame in batch:
+                try:
+                    if callable(frame):
+                        frame = frame()
+                    if self._output_format == 'geoparquet':
+                        frame.to_parquet(file_path)
+                    elif self._output_format == 'flatgeobuf':
+                        frame.to_file(file_path, driver="FlatGeobuf")
+                    else:
+                        frame.to_file(file_path, driver="GeoJSON")
+                    self._written_count += 1
+                except Exception as e:
+                    self._logger.exception(e)
+            self._queue.task_done()
+
+    def flush(self):
+        '''
+        Waits for the frames queued so far to be written, the thread keeps running.
+        :return:
+        '''
+        self._queue.join()
+
+    def close(self, timeout=None):
+        '''
+        Waits for the queued frames to be written and stops the thread.
+        :param timeout: Seconds to wait for the writes to finish, None waits until they are done.
+        :return:
+        '''
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            self._logger.error("Debug writer queue is still full, not waiting for it to finish.")
+            return
+        self._thread.join(timeout)
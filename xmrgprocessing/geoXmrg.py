@@ -1,19 +1,24 @@
 import sys
 import os
 import time
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import array
 import struct
 import re
 
-from shapely.geometry import Polygon
+import shapely
 import logging
 import logging.handlers
 import gzip
+import io
+import mmap
 import shutil
 import math
 
+from .sparse_grid import sparse_grid
+
 
 class hrapCoord(object):
     def __init__(self, column=None, row=None):
@@ -28,12 +33,16 @@ class LatLong(object):
 
 
 class geoXmrg:
-    def __init__(self, minimum_lat_lon, maximum_lat_lon, data_multiplier=0.01):
+    def __init__(self, minimum_lat_lon, maximum_lat_lon, data_multiplier=0.01, bulk_decode=True,
+                 geometry_cache=None, stream_compressed=True):
         self.logger = logging.getLogger()
 
         self.fileName = ''
         self.lastErrorMsg = ''
         self.headerRead = False
+        # Byte order of the data in the file, '<' little endian or '>' big endian. Set in readFileHeader.
+        self.byteOrder = '='
+        self.grid = None
 
         self.earthRadius = 6371.2
         self.startLong = 105.0
@@ -45,13 +54,73 @@ class geoXmrg:
         self._maximum_lat_lon = maximum_lat_lon
         self._data_multiplier = data_multiplier
 
+        # A memoryview of the file data. For gzip files this is the data decompressed into memory, otherwise it
+        # is a view of the memory mapped file.
+        self._buffer = None
+        self._mmap = None
+        # The rows and columns of the grid inside the bounding box and the (start_row, end_row, start_col, end_col)
+        # window they came from. Set by readAllRows.
+        self._window_grid = None
+        self._window = None
+        # The uncompressed file on disk we read from, if any. This is what cleanUp deletes.
+        self._diskFilepath = ''
+        self.compressedFilepath = ''
+
         self._epsg = 4326
         self._geo_data_frame = None
+        # If True, readAllRows decodes the whole data section in one read with numpy instead of row by row.
+        self._bulk_decode = bulk_decode
+        # Optional grid_geometry_cache shared across files so the cell polygons are only built once per grid.
+        self._geometry_cache = geometry_cache
+        # If True, gzip files are read as a stream instead of being decompressed into memory, so only the data up
+        # to the last row in the bounding box is ever decompressed, and nothing past the header for a dry file.
+        self._stream_compressed = stream_compressed
+        # The window values scaled by the data multiplier, built from the window grid when first asked for.
+        self._precipitation = None
+        # sparse_grid of the nonzero window cells, built from the window grid when first asked for.
+        self._sparse_grid = None
+        # Seconds spent decoding the grid and building the cell geometry.
+        self.decodeSeconds = 0.0
+        self.geometrySeconds = 0.0
 
     @property
     def geo_data_frame(self):
+        # Only the numbers are kept after decoding, the cell geometry is built the first time it's asked for.
+        if self._geo_data_frame is None and self._window_grid is not None:
+            self.buildGeoDataFrame()
         return self._geo_data_frame
 
+    @property
+    def precipitation(self):
+        '''
+        The window values scaled by the data multiplier as a float64 array, ordered row by row west to east, the
+        same order as the cells in geo_data_frame.
+        '''
+        if self._precipitation is None and self._window_grid is not None:
+            self._precipitation = self._window_grid.ravel() * self._data_multiplier
+        return self._precipitation
+
+    @property
+    def sparse_grid(self):
+        '''
+        The nonzero cells of the window as a sparse_grid of the raw int16 values.
+        '''
+        if self._sparse_grid is None and self._window_grid is not None:
+            self._sparse_grid = sparse_grid.from_dense(self._window_grid)
+        return self._sparse_grid
+
+    @property
+    def data_multiplier(self):
+        return self._data_multiplier
+
+    @property
+    def window_grid(self):
+        return self._window_grid
+
+    @property
+    def window(self):
+        return self._window
+
     """
       Function: Reset
       Purpose: Prepares the xmrgFile object for reuse. Resets various variables and closes the currently open file object.
@@ -62,36 +131,82 @@ class geoXmrg:
     def Reset(self):
         self.fileName = ''
         self.lastErrorMsg = ''
+        self.closeFile()
+
+    """
+      Function: closeFile
+      Purpose: Closes the file object and releases the memory map or decompressed buffer. If the window grid is
+        still a view into the memory map it is copied out first, numpy arrays do not keep the map open.
+      Parameters: None
+      Return: None
+      """
+
+    def closeFile(self):
+        if self._window_grid is not None and self._window_grid.base is not None:
+            self._window_grid = self._window_grid.astype(np.int16)
+        if self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
         self.xmrgFile.close()
 
     def uncompress(self, file_name: str):
         directory, xmrg_filename = os.path.split(file_name)
         xmrg_filename, xmrg_extension = os.path.splitext(xmrg_filename)
-        # Is the file compressed? If so, we want to uncompress it to a file for use.
-        # The reason for not working with the GzipFile object directly is it is not compatible
-        # with the array.fromfile() functionality.
+        # Is the file compressed? If so, uncompress it to a file next to the source. openFile only does this when
+        # asked to, normally the file is decompressed into memory.
         if xmrg_extension == '.gz':
             self.compressedFilepath = file_name
             try:
                 self.fileName = os.path.join(directory, xmrg_filename)
-                with gzip.GzipFile(file_name, 'rb') as zipFile, open(self.fileName, mode='wb') as self.xmrgFile:
+                # Write to a temporary file and rename it so a worker dying mid copy doesn't leave a partial file.
+                temp_filename = f"{self.fileName}.{os.getpid()}.tmp"
+                with gzip.GzipFile(file_name, 'rb') as zipFile, open(temp_filename, mode='wb') as self.xmrgFile:
                     shutil.copyfileobj(zipFile, self.xmrgFile)
+                os.replace(temp_filename, self.fileName)
             except (IOError, Exception) as e:
                 raise e
         return
-    def openFile(self, filePath):
+    def openFile(self, filePath, write_uncompressed=False):
         '''
-        Purpose: Attempts to open the file given in the filePath string. If the file is compressed using gzip, this will uncompress
-          the file as well.
+        Purpose: Attempts to open the file given in the filePath string. If the file is compressed using gzip, it is
+          read as a stream, or decompressed into memory if stream_compressed is False and the header and row readers
+          work on that buffer.
 
         :param filePath: is a string with the full path to the file to open.
+        :param write_uncompressed: If True, a gzip file is uncompressed to a file next to the source instead of into
+          memory.
         :return:
         '''
         self.fileName = filePath
         self.compressedFilepath = ''
+        self._buffer = None
+        self._mmap = None
+        self._diskFilepath = ''
         try:
-            self.uncompress(self.fileName)
-            self.xmrgFile = open(self.fileName, mode='rb')
+            directory, xmrg_filename = os.path.split(filePath)
+            xmrg_filename, xmrg_extension = os.path.splitext(xmrg_filename)
+            if xmrg_extension == '.gz' and not write_uncompressed:
+                self.compressedFilepath = filePath
+                # fileName is still the uncompressed name since the collection date is parsed from it.
+                self.fileName = os.path.join(directory, xmrg_filename)
+                if self._stream_compressed:
+                    self.xmrgFile = gzip.GzipFile(filePath, 'rb')
+                else:
+                    with gzip.GzipFile(filePath, 'rb') as zipFile:
+                        data = zipFile.read()
+                    self._buffer = memoryview(data)
+                    self.xmrgFile = io.BytesIO(data)
+            else:
+                self.uncompress(self.fileName)
+                self.xmrgFile = open(self.fileName, mode='rb')
+                self._diskFilepath = self.fileName
+                # Memory map the file so readAllRows can go straight to the rows in the bounding box.
+                if os.fstat(self.xmrgFile.fileno()).st_size > 0:
+                    self._mmap = mmap.mmap(self.xmrgFile.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._buffer = memoryview(self._mmap)
         except Exception as e:
             self.logger.exception(e)
             raise e
@@ -101,15 +216,16 @@ class geoXmrg:
    Purpose: Called to delete the XMRG file that was just worked with. Can delete the uncompressed file and/or 
     the source compressed file. 
    Parameters:
-     deleteFile if True, will delete the unzipped binary file.
+     deleteFile if True, will delete the unzipped binary file. If the file was decompressed into memory there
+       is no file to delete.
      deleteCompressedFile if True, will delete the compressed file the working file was extracted from.
     """
 
     def cleanUp(self, deleteFile, deleteCompressedFile):
-        self.xmrgFile.close()
-        if (deleteFile):
+        self.closeFile()
+        if (deleteFile and len(self._diskFilepath)):
             #self.logger.info(f"Deleting uncompressed file: {self.fileName}")
-            os.remove(self.fileName)
+            os.remove(self._diskFilepath)
         if (deleteCompressedFile and len(self.compressedFilepath)):
             #self.logger.info(f"Deleting compressed file: {self.compressedFilepath}")
             os.remove(self.compressedFilepath)
@@ -147,6 +263,10 @@ class geoXmrg:
             if (header[0] != 16):
                 self.swapBytes = 1
                 header.byteswap()
+            # Track the byte order of the file itself so the struct and numpy readers can decode it directly.
+            native_order = '<' if sys.byteorder == 'little' else '>'
+            swapped_order = '>' if native_order == '<' else '<'
+            self.byteOrder = swapped_order if self.swapBytes else native_order
 
             self.XOR = header[1]  # X Origin of the HRAP grid
             self.YOR = header[2]  # Y origin of the HRAP grid
@@ -177,7 +297,7 @@ class geoXmrg:
                 # valid time: char[10]
                 # max value: int
                 # version number: float
-                unpackFmt += '=2s8s10s10s8s10s10sif'
+                unpackFmt += self.byteOrder + '2s8s10s10s8s10s10sif'
                 # buf = array.array('B')
                 # buf.fromfile(self.xmrgFile,66)
                 # if( self.swapBytes ):
@@ -189,9 +309,7 @@ class geoXmrg:
                 srcFileOpen = True
             # Files written June 1997 to 1999
             elif (byteCnt == 38):
-                if (self.swapBytes):
-                    unpackFmt += '>'
-                unpackFmt += '=10s10s10s8s'
+                unpackFmt += self.byteOrder + '10s10s10s8s'
                 buf = self.xmrgFile.read(38)
                 self.fileNfoHdrData = struct.unpack(unpackFmt, buf)
                 srcFileOpen = True
@@ -199,17 +317,14 @@ class geoXmrg:
             # Files written June 1997 to 1999. I assume there was some bug for this since the source
             # code also was writing out an error message.
             elif byteCnt == 37:
-                if self.swapBytes:
-                    unpackFmt += '>'
-                unpackFmt += '=10s10s10s8s'
+                # The short record is missing the last byte of the process flag.
+                unpackFmt += self.byteOrder + '10s10s10s7s'
                 buf = self.xmrgFile.read(37)
                 self.fileNfoHdrData = struct.unpack(unpackFmt, buf)
                 srcFileOpen = True
 
             # Files written up to June 1997, no 2nd header.
             elif byteCnt == (self.MAXX * 2):
-                if (self.swapBytes):
-                    unpackFmt += '>'
                 self.logger.info("Reading pre-1997 format")
                 srcFileOpen = True
                 # File does not have 2nd header, so we need to reset the file point to the point before we
@@ -295,71 +410,318 @@ class geoXmrg:
 
         return (dataArray)
 
+    """
+      Function: recordDtype
+      Purpose: Builds the numpy dtype describing one FORTRAN row record in the file: the leading tag, MAXX shorts
+        and the trailing tag, in the byte order of the file. readFileHeader must be called first.
+      Parameters: None
+      Returns: A numpy dtype.
+      """
+
+    def recordDtype(self):
+        return np.dtype([('lead_tag', self.byteOrder + 'u4'),
+                         ('data', self.byteOrder + 'i2', (self.MAXX,)),
+                         ('tail_tag', self.byteOrder + 'u4')])
+
+    """
+      Function: readGrid
+      Purpose: Decodes the whole data section of the file with numpy, all the leading and trailing record tags
+        are verified. This is the full grid window of readWindow, or of readWindowStream if the file isn't in
+        memory, so there is only one decoder to keep right. Call readFileHeader first so the file pointer is at
+        the start of the data section.
+      Parameters: None
+      Returns: A (MAXY, MAXX) int16 numpy array in native byte order if successful, otherwise None. The array
+        is also stored in self.grid.
+      """
+
+    def readGrid(self):
+        if self._buffer is not None:
+            grid = self.readWindow(0, self.MAXY, 0, self.MAXX)
+        else:
+            grid = self.readWindowStream(0, self.MAXY, 0, self.MAXX)
+        if grid is None:
+            return (None)
+        # Anything built from a previous decode is out of date.
+        self._precipitation = None
+        self._sparse_grid = None
+        self._geo_data_frame = None
+        self.grid = grid.astype(np.int16)
+        return (self.grid)
+
+    """
+      Function: readWindow
+      Purpose: Decodes only the rows and columns in the given window directly from the memory mapped file or
+        decompressed buffer. Row offsets are computed from the fixed record size, so rows outside the window are
+        never read and only the tags of the window rows are checked. The returned array is a view of the buffer,
+        in the byte order of the file, no data is copied. Call readFileHeader first so the file pointer is at the
+        start of the data section.
+      Parameters:
+        start_row, end_row, start_col, end_col the window relative to the grid origin. End values are exclusive.
+      Returns: A (end_row - start_row, end_col - start_col) int16 numpy array if successful, otherwise None.
+        The array and window are also stored in self._window_grid and self._window.
+      """
+
+    def readWindow(self, start_row, end_row, start_col, end_col):
+        record_dtype = self.recordDtype()
+        data_offset = self.xmrgFile.tell()
+        if data_offset + record_dtype.itemsize * self.MAXY > len(self._buffer):
+            self.lastErrorMsg = f'Data section is shorter than {self.MAXY} rows.'
+            return (None)
+        records = np.ndarray(shape=(end_row - start_row,), dtype=record_dtype, buffer=self._buffer,
+                             offset=data_offset + start_row * record_dtype.itemsize)
+        tag = self.MAXX * 2
+        bad_tags = (records['lead_tag'] != tag) | (records['tail_tag'] != tag)
+        if bad_tags.any():
+            self.lastErrorMsg = f'Record tag does not match header for row: {start_row + int(np.argmax(bad_tags))}.'
+            return (None)
+        self._window = (start_row, end_row, start_col, end_col)
+        self._window_grid = records['data'][:, start_col:end_col]
+        return (self._window_grid)
+
+    """
+      Function: readWindowStream
+      Purpose: Decodes only the rows and columns in the given window reading the file sequentially. The rows
+        before the window are skipped with a relative seek, on a gzip stream that decompresses them without
+        decoding anything, and reading stops at the last row of the window. The columns are cropped from the
+        decoded records in one slice. Call readFileHeader first so the file pointer is at the start of the data
+        section.
+      Parameters:
+        start_row, end_row, start_col, end_col the window relative to the grid origin. End values are exclusive.
+      Returns: A (end_row - start_row, end_col - start_col) int16 numpy array in native byte order if successful,
+        otherwise None. The array and window are also stored in self._window_grid and self._window.
+      """
+
+    def readWindowStream(self, start_row, end_row, start_col, end_col):
+        record_dtype = self.recordDtype()
+        row_count = end_row - start_row
+        self.xmrgFile.seek(start_row * record_dtype.itemsize, os.SEEK_CUR)
+        buf = self.xmrgFile.read(record_dtype.itemsize * row_count)
+        if len(buf) != record_dtype.itemsize * row_count:
+            self.lastErrorMsg = f'Data section is shorter than {end_row} rows.'
+            return (None)
+        records = np.frombuffer(buf, dtype=record_dtype, count=row_count)
+        tag = self.MAXX * 2
+        bad_tags = (records['lead_tag'] != tag) | (records['tail_tag'] != tag)
+        if bad_tags.any():
+            self.lastErrorMsg = f'Record tag does not match header for row: {start_row + int(np.argmax(bad_tags))}.'
+            return (None)
+        self._window = (start_row, end_row, start_col, end_col)
+        self._window_grid = records['data'][:, start_col:end_col].astype(np.int16)
+        return (self._window_grid)
+
     """
       Function: readAllRows
-      Purpose: Reads all the rows in the file and stores them in a dataArray object. Data is stored in self.grid.
+      Purpose: Reads the rows in the bounding box into self._window_grid. Only the rows in the bounding box are
+        decoded. The GeoDataFrame of the grid cells is built the first time geo_data_frame is used, callers that
+        only need the values use window_grid or precipitation and never pay for the geometry.
       Parameters: None
       Returns: True if succesful otherwise False.
     
       """
 
     def readAllRows(self):
+        return (self.readWindowGrid())
+
+    """
+      Function: readWindowGrid
+      Purpose: Decodes the rows in the bounding box into self._window_grid without building any geometry.
+        When the file is memory mapped or decompressed into memory the window rows are read straight from the
+        buffer, otherwise the file is read sequentially up to the last row of the window, skipping the rows
+        before it. Call readFileHeader first.
+      Parameters: None
+      Returns: True if succesful otherwise False.
+      """
+
+    def readWindowGrid(self):
+        decode_start_time = time.perf_counter()
+        start_row, end_row, start_col, end_col = self.gridWindow()
+
+        if self._bulk_decode and self._buffer is not None:
+            # Every row record is the same size, so we only touch the rows in the bounding box.
+            if self.readWindow(start_row, end_row, start_col, end_col) is None:
+                return (False)
+        elif self._bulk_decode:
+            if self.readWindowStream(start_row, end_row, start_col, end_col) is None:
+                return (False)
+        else:
+            # Each record is the MAXX shorts plus the leading and trailing 4 byte tags.
+            self.xmrgFile.seek(start_row * (self.MAXX * 2 + 8), os.SEEK_CUR)
+            rows = []
+            for row in range(start_row, end_row):
+                dataArray = self.readRow()
+                if (dataArray == None):
+                    return (False)
+                rows.append(dataArray[start_col:end_col])
+            self._window = (start_row, end_row, start_col, end_col)
+            self._window_grid = np.array(rows, dtype=np.int16).reshape(end_row - start_row, end_col - start_col)
+        # Anything built from a previous decode is out of date.
+        self._precipitation = None
+        self._sparse_grid = None
+        self._geo_data_frame = None
+        self.decodeSeconds = time.perf_counter() - decode_start_time
+        return (True)
 
+    """
+      Function: buildGeoDataFrame
+      Purpose: Builds the GeoDataFrame of the grid cells in the window decoded by readWindowGrid. This is done
+        by the geo_data_frame property when it is first used.
+      Parameters: None
+      Returns: The GeoDataFrame, also stored in self._geo_data_frame.
+      """
+
+    def buildGeoDataFrame(self):
+        geometry_start_time = time.perf_counter()
+        # Cells are ordered row by row, west to east, the same order the grid is stored in.
+        self._geo_data_frame = gpd.GeoDataFrame({'Precipitation': self.precipitation},
+                                                geometry=self.cellGeometries(),
+                                                crs=f"EPSG:{self._epsg}")
+        self.geometrySeconds = time.perf_counter() - geometry_start_time
+        return (self._geo_data_frame)
+
+    """
+      Function: cellGeometries
+      Purpose: Returns the polygons of the grid cells in the bounding box window, from the geometry cache if the
+        grid has been seen before. Only the header is needed, the rows don't have to be decoded.
+      Parameters: None
+      Returns: A GeoSeries of the cell polygons, ordered row by row west to east.
+      """
+
+    def cellGeometries(self):
+        grid_polygons = None
+        if self._geometry_cache is not None:
+            signature = self.gridSignature()
+            grid_polygons = self._geometry_cache.get(signature)
+        if grid_polygons is None:
+            start_row, end_row, start_col, end_col = self.gridWindow()
+            grid_polygons = gpd.GeoSeries(self.buildCellPolygons(start_row, end_row, start_col, end_col),
+                                          crs=f"EPSG:{self._epsg}")
+            if self._geometry_cache is not None:
+                self._geometry_cache.put(signature, grid_polygons)
+        return (grid_polygons)
+
+    """
+      Function: headerMaxValue
+      Purpose: Returns the maximum value of the grid from the info header. Only the header written from 1999 on
+        has the field. readFileHeader must be called first.
+      Parameters: None
+      Returns: The maximum value as the raw integer, in the file's units, or None if the header doesn't have it.
+      """
+
+    def headerMaxValue(self):
+        if len(self.fileNfoHdrData) == 9:
+            return (self.fileNfoHdrData[7])
+        return (None)
+
+    """
+      Function: valueAtLatLong
+      Purpose: Returns the value of the grid cell that contains the lat/long, straight from the decoded window
+        without building any geometry. readWindowGrid must be called first.
+      Parameters:
+        latLong is the LatLong of the point.
+      Returns: The value scaled by the data multiplier, or None if the point is outside the window.
+      """
+
+    def valueAtLatLong(self, latLong):
+        if self._window_grid is None:
+            return (None)
+        hrap = self.latLongToHRAP(latLong)
+        row = math.floor(hrap.row) - self.YOR - self._window[0]
+        column = math.floor(hrap.column) - self.XOR - self._window[2]
+        if 0 <= row < self._window_grid.shape[0] and 0 <= column < self._window_grid.shape[1]:
+            return (float(self._window_grid[row, column]) * self._data_multiplier)
+        return (None)
+
+    """
+      Function: gridSignature
+      Purpose: Builds the key that identifies the cell geometry for this file. Files with the same grid origin,
+        size and bounding box have identical cell polygons. readFileHeader must be called first.
+      Parameters: None
+      Returns: A tuple of (XOR, YOR, MAXX, MAXY, bounding box).
+      """
+
+    def gridSignature(self):
+        bbox = None
+        if self._minimum_lat_lon is not None and self._maximum_lat_lon is not None:
+            bbox = (self._minimum_lat_lon.latitude, self._minimum_lat_lon.longitude,
+                    self._maximum_lat_lon.latitude, self._maximum_lat_lon.longitude)
+        return (self.XOR, self.YOR, self.MAXX, self.MAXY, bbox)
+
+    """
+      Function: gridWindow
+      Purpose: Computes the window of grid rows and columns that falls inside the bounding box given by the
+        minimum and maximum lat/longs. Both corners are converted in one latLongToHRAPArray call, which gives
+        the same points as latLongToHRAP. If no bounding box was given, the window is the whole grid.
+        readFileHeader must be called first.
+      Parameters: None
+      Returns: A tuple of (start_row, end_row, start_col, end_col), the end values are exclusive.
+      """
+
+    def gridWindow(self):
         start_col = 0
         start_row = 0
         end_col = self.MAXX
         end_row = self.MAXY
         if self._minimum_lat_lon is not None and self._maximum_lat_lon is not None:
-            llHrap = self.latLongToHRAP(self._minimum_lat_lon, True, True)
-            urHrap = self.latLongToHRAP(self._maximum_lat_lon, True, True)
-            start_row = llHrap.row
-            start_col = llHrap.column
-            end_row = urHrap.row
-            end_col = urHrap.column
-
-        grid = []
-        # Create a integer numeric array(from numpy). Dimensions are MAXY and MAXX.
-        for row in range(self.MAXY):
-            dataArray = self.readRow()
-            if (dataArray == None):
-                return (False)
-            if row >= start_row and row < end_row:
-                for col in range(start_col, end_col):
-                    val = dataArray[col] * self._data_multiplier
-                    hrap = hrapCoord(self.XOR + col, self.YOR + row)
-                    latlon = self.hrapCoordToLatLong(hrap)
-                    latlon.longitude *= -1
-                    # Build polygon points. Each grid point represents a 4km square, so we want to create a polygon
-                    # that has each point in the grid for a given point.
-                    hrapNewPt = hrapCoord(self.XOR + col, self.YOR + row + 1)
-                    latlonUL = self.hrapCoordToLatLong(hrapNewPt)
-                    latlonUL.longitude *= -1
-
-                    hrapNewPt = hrapCoord(self.XOR + col + 1, self.YOR + row)
-                    latlonBR = self.hrapCoordToLatLong(hrapNewPt)
-                    latlonBR.longitude *= -1
-
-                    hrapNewPt = hrapCoord(self.XOR + col + 1, self.YOR + row + 1)
-                    latlonUR = self.hrapCoordToLatLong(hrapNewPt)
-                    latlonUR.longitude *= -1
-
-                    grid_polygon = Polygon([(latlon.longitude, latlon.latitude),
-                                            (latlonUL.longitude, latlonUL.latitude),
-                                            (latlonUR.longitude, latlonUR.latitude),
-                                            (latlonBR.longitude, latlonBR.latitude),
-                                            (latlon.longitude, latlon.latitude)])
-
-                    grid.append([grid_polygon, val])
-        data_frame = pd.DataFrame(grid, columns=['Grids', 'Precipitation'])
-        geo_data_frame = gpd.GeoDataFrame(data_frame,
-                                          geometry=data_frame.Grids)
-        self._geo_data_frame = geo_data_frame.drop(columns=['Grids'])
-        self._geo_data_frame.set_crs(epsg=self._epsg, inplace=True)
-        return (True)
+            columns, rows = self.latLongToHRAPArray(
+                (self._minimum_lat_lon.latitude, self._maximum_lat_lon.latitude),
+                (self._minimum_lat_lon.longitude, self._maximum_lat_lon.longitude), True, True)
+            start_row = max(int(rows[0]), 0)
+            start_col = max(int(columns[0]), 0)
+            end_row = max(int(rows[1]), start_row)
+            end_col = max(int(columns[1]), start_col)
+        return (start_row, end_row, start_col, end_col)
+
+    """
+      Function: buildCellPolygons
+      Purpose: Builds the polygons for the grid cells in the given window. The (rows+1) x (cols+1) lattice of cell
+        corners is converted to lat/long once with hrapCoordToLatLongArray and the polygons are then created in
+        one call to shapely.polygons. Each grid point represents a 4km square, so the polygon for a cell runs from
+        its HRAP point to the next point in each direction.
+        The corners agree with the per cell hrapCoordToLatLong conversion to within 1e-12 degrees, numpy's
+        arcsin/arctan2 can differ from the math module in the last bit.
+      Parameters:
+        start_row, end_row, start_col, end_col the window of cells relative to the grid origin. End values are
+        exclusive.
+      Returns:
+        A numpy array of shapely Polygons ordered row by row, west to east.
+      """
+
+    def buildCellPolygons(self, start_row, end_row, start_col, end_col):
+        columns, rows = np.meshgrid(np.arange(self.XOR + start_col, self.XOR + end_col + 1, dtype=np.float64),
+                                    np.arange(self.YOR + start_row, self.YOR + end_row + 1, dtype=np.float64))
+        latitudes, longitudes = self.hrapCoordToLatLongArray(columns, rows)
+        corners = np.stack((-longitudes, latitudes), axis=-1)
+
+        lower_left = corners[:-1, :-1]
+        upper_left = corners[1:, :-1]
+        upper_right = corners[1:, 1:]
+        lower_right = corners[:-1, 1:]
+        rings = np.stack((lower_left, upper_left, upper_right, lower_right, lower_left), axis=-2)
+        return shapely.polygons(rings.reshape(-1, 5, 2))
+
+    """
+      Function: hrapCellPolygons
+      Purpose: Builds the polygons for arbitrary grid cells given by their HRAP column and row, using the same
+        corner order as buildCellPolygons.
+      Parameters:
+        columns is a numpy array of the HRAP columns of the cells.
+        rows is a numpy array of the HRAP rows of the cells.
+      Returns:
+        A numpy array of shapely Polygons, one per cell.
+      """
+
+    def hrapCellPolygons(self, columns, rows):
+        columns = np.asarray(columns, dtype=np.float64)
+        rows = np.asarray(rows, dtype=np.float64)
+        # Lower left, upper left, upper right, lower right, lower left.
+        corner_columns = np.stack((columns, columns, columns + 1, columns + 1, columns), axis=-1)
+        corner_rows = np.stack((rows, rows + 1, rows + 1, rows, rows), axis=-1)
+        latitudes, longitudes = self.hrapCoordToLatLongArray(corner_columns, corner_rows)
+        return shapely.polygons(np.stack((-longitudes, latitudes), axis=-1))
 
     def save_to_file(self, filename):
         try:
-            self._geo_data_frame.to_file(filename, driver="GeoJSON")
+            self.geo_data_frame.to_file(filename, driver="GeoJSON")
         except Exception as e:
             raise e
 
@@ -417,6 +779,33 @@ class geoXmrg:
 
         return (latLong)
 
+    """
+    Function: hrapCoordToLatLongArray
+    Purpose: Array version of hrapCoordToLatLong. Converts arrays of HRAP columns and rows into latitudes
+      and longitudes.
+    Parameters:
+      columns is a numpy array of the HRAP columns.
+      rows is a numpy array of the HRAP rows, the same shape as columns.
+    Returns:
+      A tuple of numpy arrays (latitudes, longitudes). As with hrapCoordToLatLong the longitudes are positive
+      degrees west.
+    """
+
+    def hrapCoordToLatLongArray(self, columns, rows):
+        x = np.asarray(columns, dtype=np.float64) - 401.0
+        y = np.asarray(rows, dtype=np.float64) - 1601.0
+        rr = x * x + y * y
+        gi = self.meshdegs * self.meshdegs
+        latitudes = np.degrees(np.arcsin((gi - rr) / (gi + rr)))
+
+        ang = np.degrees(np.arctan2(y, x))
+        ang = np.where(ang < 0.0, ang + 360.0, ang)
+        longitudes = 270.0 + self.startLong - ang
+        longitudes = np.where(longitudes < 0.0, longitudes + 360.0,
+                              np.where(longitudes > 360.0, longitudes - 360.0, longitudes))
+
+        return (latitudes, longitudes)
+
     """
     Function: latLongToHRAP
     Purpose: Converts a latitude and longitude into an HRAP grid point.
@@ -450,6 +839,38 @@ class geoXmrg:
 
         return (hrap)
 
+    """
+    Function: latLongToHRAPArray
+    Purpose: Array version of latLongToHRAP. Converts arrays of latitudes and longitudes into HRAP grid points.
+    Parameters:
+      latitudes is a numpy array of the latitudes.
+      longitudes is a numpy array of the longitudes, the same shape as latitudes.
+      roundToNearest specifies if we want to round the hrap points to the nearest integer value.
+      adjustToOrigin specifies if we want to adjust the hrap points to the origin of the file.
+    Returns:
+      A tuple of numpy arrays (columns, rows). If roundToNearest is True they are integer arrays.
+    """
+
+    def latLongToHRAPArray(self, latitudes, longitudes, roundToNearest=False, adjustToOrigin=False):
+        flat = np.radians(np.asarray(latitudes, dtype=np.float64))
+        flon = np.radians(np.abs(np.asarray(longitudes, dtype=np.float64)) + 180.0 - self.startLong)
+        r = self.meshdegs * np.cos(flat) / (1.0 + np.sin(flat))
+        columns = r * np.sin(flon) + 401.0
+        rows = r * np.cos(flon) + 1601.0
+
+        # Bounds checking
+        columns = np.minimum(columns, self.XOR + self.MAXX)
+        rows = np.minimum(rows, self.YOR + self.MAXY)
+        if (roundToNearest):
+            # int() truncates toward zero, so we do the same.
+            columns = np.trunc(columns - 0.5).astype(np.int64)
+            rows = np.trunc(rows - 0.5).astype(np.int64)
+        if (adjustToOrigin):
+            columns = columns - self.XOR
+            rows = rows - self.YOR
+
+        return (columns, rows)
+
     """
     Function: getCollectionDateFromFilename
     Purpose: Given the filename, this will return a datetime string in the format of YYYY-MM-DDTHH:MM:SS.
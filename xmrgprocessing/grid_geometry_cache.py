@@ -0,0 +1,106 @@
+import os
+import logging
+import pickle
+import hashlib
+from collections import OrderedDict
+
+
+class grid_geometry_cache:
+    '''
+    Caches the cell polygons for an XMRG grid so the geometry is only built once per grid signature.
+    Every file in a run normally has the same grid origin, size and bounding box crop, so after the first
+    file only the Precipitation values need to be replaced.
+    The in memory tier holds the GeoSeries along with its spatial index. If cache_directory is given, the
+    GeoSeries is also pickled to disk so other worker processes and later runs can load it instead of
+    building it. The spatial index is rebuilt once when an entry is loaded from disk.
+    '''
+    def __init__(self, cache_directory=None, max_entries=4):
+        '''
+
+        :param cache_directory: Optional directory for the on disk tier.
+        :param max_entries: Number of grid signatures to keep in memory.
+        '''
+        self._logger = logging.getLogger()
+        self._cache_directory = cache_directory
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def get(self, signature):
+        '''
+        Returns the GeoSeries of cell polygons for the grid signature or None if it is not cached.
+        :param signature: The tuple returned by geoXmrg.gridSignature().
+        :return:
+        '''
+        geo_series = self._entries.get(signature, None)
+        if geo_series is not None:
+            self._entries.move_to_end(signature)
+        elif self._cache_directory is not None:
+            geo_series = self._load(signature)
+            if geo_series is not None:
+                # Build the spatial index now so it is shared by every frame built from this entry.
+                geo_series.sindex
+                self._add(signature, geo_series)
+
+        if geo_series is not None:
+            self._hits += 1
+        else:
+            self._misses += 1
+        return geo_series
+
+    def put(self, signature, geo_series):
+        '''
+        Adds the GeoSeries of cell polygons for the grid signature to the cache.
+        :param signature: The tuple returned by geoXmrg.gridSignature().
+        :param geo_series: GeoSeries of the cell polygons.
+        :return:
+        '''
+        geo_series.sindex
+        self._add(signature, geo_series)
+        if self._cache_directory is not None:
+            self._save(signature, geo_series)
+
+    def _add(self, signature, geo_series):
+        self._entries[signature] = geo_series
+        self._entries.move_to_end(signature)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def _cache_filename(self, signature):
+        signature_hash = hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()
+        return os.path.join(self._cache_directory, f"xmrg_grid_geometry_{signature_hash}.pickle")
+
+    def _load(self, signature):
+        cache_file = self._cache_filename(signature)
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as cache_obj:
+                    cached_signature, geo_series = pickle.load(cache_obj)
+                if cached_signature == signature:
+                    return geo_series
+            except Exception as e:
+                self._logger.exception(e)
+        return None
+
+    def _save(self, signature, geo_series):
+        cache_file = self._cache_filename(signature)
+        if not os.path.exists(cache_file):
+            # Write to a temporary file first so other processes never load a partial file.
+            temp_file = f"{cache_file}.{os.getpid()}.tmp"
+            try:
+                with open(temp_file, 'wb') as cache_obj:
+                    pickle.dump((signature, geo_series), cache_obj, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_file, cache_file)
+            except Exception as e:
+                self._logger.exception(e)
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
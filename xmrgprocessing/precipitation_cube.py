@@ -0,0 +1,157 @@
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Value of the hours that have no grid.
+FILL_VALUE = np.iinfo(np.int16).min
+DEFAULT_CHUNK_HOURS = 24 * 31
+METADATA_FILENAME = "cube.json"
+EPOCH = datetime(1970, 1, 1)
+
+
+class precipitation_cube:
+    '''
+    On disk time x row x col cube of the cropped XMRG grids, stored as the raw int16 values.
+    The time axis is hourly and split into chunks of chunk_hours, each chunk is a .npy file that is memory mapped
+    when it is read or written. Chunks are numbered from the epoch, so hours can be added in any order and an
+    archive can be extended forwards or backwards without rewriting the existing chunks. Hours without a grid
+    hold FILL_VALUE.
+    The cube.json sidecar holds the grid window the cube covers, the value multiplier and the hours present.
+    '''
+    def __init__(self, cube_directory, chunk_hours=DEFAULT_CHUNK_HOURS):
+        '''
+
+        :param cube_directory: Directory the chunk files and metadata are kept in, created if it doesn't exist.
+        :param chunk_hours: Number of hours per chunk file, only used when the cube is created.
+        '''
+        self._logger = logging.getLogger()
+        self._cube_directory = cube_directory
+        self._metadata = None
+        self._hours = set()
+        self._chunks = {}
+        os.makedirs(cube_directory, exist_ok=True)
+        metadata_file = os.path.join(cube_directory, METADATA_FILENAME)
+        if os.path.exists(metadata_file):
+            with open(metadata_file, 'r') as metadata:
+                self._metadata = json.load(metadata)
+            self._hours = set(self._metadata.pop('hours'))
+        else:
+            self._chunk_hours = chunk_hours
+        if self._metadata is not None:
+            self._chunk_hours = self._metadata['chunk_hours']
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def shape(self):
+        return (self._metadata['rows'], self._metadata['columns'])
+
+    def hour_number(self, date_time):
+        return (date_time - EPOCH) // timedelta(hours=1)
+
+    def hour_date(self, hour_number):
+        return EPOCH + timedelta(hours=int(hour_number))
+
+    def dates(self):
+        '''
+        :return: Sorted list of the datetimes that have grids in the cube.
+        '''
+        return [self.hour_date(hour) for hour in sorted(self._hours)]
+
+    def chunk_file(self, chunk_number):
+        return os.path.join(self._cube_directory, f"chunk_{chunk_number:06d}.npy")
+
+    def get_chunk(self, chunk_number, create):
+        '''
+        Returns the memory mapped chunk, creating the file filled with FILL_VALUE if requested.
+        :param chunk_number:
+        :param create: If True and the chunk file doesn't exist it is created, otherwise None is returned.
+        :return:
+        '''
+        chunk = self._chunks.get(chunk_number, None)
+        if chunk is None:
+            chunk_file = self.chunk_file(chunk_number)
+            if os.path.exists(chunk_file):
+                chunk = np.load(chunk_file, mmap_mode='r+')
+            elif create:
+                chunk = np.lib.format.open_memmap(chunk_file, mode='w+', dtype=np.int16,
+                                                  shape=(self._chunk_hours,) + self.shape)
+                chunk[:] = FILL_VALUE
+            if chunk is not None:
+                self._chunks[chunk_number] = chunk
+        return chunk
+
+    def check_grid(self, grid_window, data_multiplier):
+        '''
+        Sets the cube's grid from the first grid written, after that every grid must have the same window.
+        :param grid_window: (XOR, YOR, start_row, start_col, rows, columns) of the cropped grid.
+        :param data_multiplier: Multiplier that converts the int16 values to millimeters.
+        :return: True if the grid matches the cube.
+        '''
+        xor, yor, start_row, start_col, rows, columns = grid_window
+        grid_metadata = {'xor': int(xor), 'yor': int(yor), 'start_row': int(start_row), 'start_col': int(start_col),
+                         'rows': int(rows), 'columns': int(columns)}
+        if self._metadata is None:
+            self._metadata = dict(grid_metadata, data_multiplier=data_multiplier, chunk_hours=self._chunk_hours,
+                                  dtype='int16', fill_value=int(FILL_VALUE))
+            self.save_metadata()
+            return True
+        return all(self._metadata[key] == value for key, value in grid_metadata.items())
+
+    def write(self, date_time, grid, grid_window, data_multiplier=0.01):
+        '''
+        Writes the grid for an hour, replacing any grid already there.
+        :param date_time: datetime of the grid.
+        :param grid: (rows, columns) int16 array of the cropped grid.
+        :param grid_window: (XOR, YOR, start_row, start_col, rows, columns) of the cropped grid.
+        :param data_multiplier: Multiplier that converts the int16 values to millimeters.
+        :return: True if the grid was written.
+        '''
+        if not self.check_grid(grid_window, data_multiplier):
+            self._logger.error(f"Grid for: {date_time} window: {grid_window} does not match the cube.")
+            return False
+        hour = self.hour_number(date_time)
+        chunk = self.get_chunk(hour // self._chunk_hours, True)
+        chunk[hour % self._chunk_hours] = grid
+        self._hours.add(hour)
+        return True
+
+    def read(self, start_date, end_date):
+        '''
+        Reads the grids from the start date up to, but not including, the end date.
+        :param start_date: datetime
+        :param end_date: datetime
+        :return: Tuple of (list of datetimes, (time, rows, columns) int16 array). Missing hours are FILL_VALUE.
+        '''
+        start_hour = self.hour_number(start_date)
+        end_hour = self.hour_number(end_date)
+        grids = np.full((max(end_hour - start_hour, 0),) + self.shape, FILL_VALUE, dtype=np.int16)
+        hour = start_hour
+        while hour < end_hour:
+            chunk_number = hour // self._chunk_hours
+            chunk_end = min((chunk_number + 1) * self._chunk_hours, end_hour)
+            chunk = self.get_chunk(chunk_number, False)
+            if chunk is not None:
+                grids[hour - start_hour:chunk_end - start_hour] = \
+                    chunk[hour % self._chunk_hours:hour % self._chunk_hours + (chunk_end - hour)]
+            hour = chunk_end
+        return [self.hour_date(hour) for hour in range(start_hour, end_hour)], grids
+
+    def save_metadata(self):
+        if self._metadata is not None:
+            metadata_file = os.path.join(self._cube_directory, METADATA_FILENAME)
+            temp_filename = f"{metadata_file}.{os.getpid()}.tmp"
+            with open(temp_filename, 'w') as metadata:
+                json.dump(dict(self._metadata, hours=sorted(self._hours)), metadata)
+            os.replace(temp_filename, metadata_file)
+
+    def close(self):
+        for chunk in self._chunks.values():
+            chunk.flush()
+        self._chunks = {}
+        self.save_metadata()
@@ -0,0 +1,163 @@
+import os
+import json
+import logging
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+
+import shapely
+
+# Status recorded for a file whose results were saved.
+STATUS_PROCESSED = 'processed'
+# Status recorded for a file that was queued but no results came back for.
+STATUS_FAILED = 'failed'
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def boundary_fingerprint(boundaries):
+    '''
+    Builds a fingerprint of the boundary set, if a boundary is added, removed or its polygon changes the
+    fingerprint changes and the files are processed again.
+    :param boundaries: List of (name, polygon) tuples.
+    :return: Hex digest string.
+    '''
+    boundary_hash = hashlib.sha256()
+    for name, geometry in boundaries:
+        boundary_hash.update(name.encode('utf-8'))
+        boundary_hash.update(shapely.to_wkb(shapely.normalize(geometry)))
+    return boundary_hash.hexdigest()
+
+
+def file_hash(file_path):
+    '''
+    SHA256 digest of the file contents.
+    :param file_path:
+    :return: Hex digest string.
+    '''
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as hash_file:
+        for chunk in iter(lambda: hash_file.read(HASH_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+class processing_ledger:
+    '''
+    SQLite ledger of the XMRG files that have been processed. Each file is recorded with its path, size,
+    modification time, content hash, the fingerprint of the boundaries it was processed against and the result
+    status. Re-runs over the same date range use it to skip files that haven't changed since they were saved.
+    The files are keyed by name, so a file is still recognised if it is processed from a different directory.
+    The hour and boundary weighted averages of each processed file are kept too, so the rolling totals can be
+    worked out over skipped hours without processing them again.
+    '''
+    def __init__(self, ledger_file):
+        '''
+
+        :param ledger_file: Path of the SQLite ledger database, it is created if it doesn't exist.
+        '''
+        self._logger = logging.getLogger()
+        self._ledger_file = ledger_file
+        # The dispatcher checks files from its feeder thread and records results from the calling thread.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(ledger_file, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            # WAL lets an overlapping run read the ledger while another is writing to it.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS processed_files ("
+                             "file_name TEXT PRIMARY KEY,"
+                             "file_path TEXT,"
+                             "file_size INTEGER,"
+                             "file_mtime REAL,"
+                             "content_hash TEXT,"
+                             "boundary_fingerprint TEXT,"
+                             "status TEXT,"
+                             "processed_date TEXT,"
+                             "result_date TEXT,"
+                             "weighted_averages TEXT)")
+            # Ledgers from before the weighted averages were kept get the columns added, their files have no
+            # saved values until they are processed again.
+            columns = [column[1] for column in self._db.execute("PRAGMA table_info(processed_files)")]
+            for column in ('result_date', 'weighted_averages'):
+                if column not in columns:
+                    self._db.execute(f"ALTER TABLE processed_files ADD COLUMN {column} TEXT")
+
+    def file_info(self, file_path):
+        '''
+        Returns the (file name, path, size, mtime, content hash) the ledger records for a file.
+        :param file_path:
+        :return:
+        '''
+        file_stat = os.stat(file_path)
+        return (os.path.basename(file_path), file_path, file_stat.st_size, file_stat.st_mtime, file_hash(file_path))
+
+    def is_processed(self, file_path, fingerprint):
+        '''
+        Checks if the file was already processed successfully with the same boundaries and hasn't changed since.
+        If the size and modification time match we trust them, if only the modification time differs, such as a
+        file that was downloaded again, the contents are hashed and compared.
+        :param file_path: Path of the XMRG file.
+        :param fingerprint: The boundary_fingerprint of the boundaries being processed.
+        :return: True if the file can be skipped.
+        '''
+        with self._lock:
+            row = self._db.execute("SELECT file_size, file_mtime, content_hash, boundary_fingerprint, status "
+                                   "FROM processed_files WHERE file_name = ?",
+                                   (os.path.basename(file_path),)).fetchone()
+        if row is None:
+            return False
+        file_size, file_mtime, content_hash, processed_fingerprint, status = row
+        if status != STATUS_PROCESSED or processed_fingerprint != fingerprint:
+            return False
+        file_stat = os.stat(file_path)
+        if file_stat.st_size != file_size:
+            return False
+        if file_stat.st_mtime == file_mtime:
+            return True
+        return file_hash(file_path) == content_hash
+
+    def saved_results(self, file_path):
+        '''
+        Returns the hour and boundary weighted averages recorded for a processed file.
+        :param file_path: Path of the XMRG file.
+        :return: Tuple of (result date string, dict of boundary name to weighted average) or None if the ledger
+          has no values for the file.
+        '''
+        with self._lock:
+            row = self._db.execute("SELECT result_date, weighted_averages FROM processed_files WHERE file_name = ?",
+                                   (os.path.basename(file_path),)).fetchone()
+        if row is None or row[0] is None or row[1] is None:
+            return None
+        return (row[0], json.loads(row[1]))
+
+    def record(self, file_info, fingerprint, status, result_date=None, weighted_averages=None):
+        '''
+        Adds or updates the ledger entry for a file.
+        :param file_info: Tuple returned by file_info().
+        :param fingerprint: The boundary_fingerprint the file was processed against.
+        :param status: STATUS_PROCESSED or STATUS_FAILED.
+        :param result_date: The hour of the results, as the "%Y-%m-%dT%H:%M:%S" string the results use.
+        :param weighted_averages: Dict of boundary name to the hourly weighted average.
+        :return:
+        '''
+        file_name, file_path, file_size, file_mtime, content_hash = file_info
+        if weighted_averages is not None:
+            weighted_averages = json.dumps(weighted_averages)
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO processed_files "
+                             "(file_name, file_path, file_size, file_mtime, content_hash, boundary_fingerprint,"
+                             " status, processed_date, result_date, weighted_averages) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                             "ON CONFLICT(file_name) DO UPDATE SET "
+                             "file_path=excluded.file_path, file_size=excluded.file_size,"
+                             "file_mtime=excluded.file_mtime, content_hash=excluded.content_hash,"
+                             "boundary_fingerprint=excluded.boundary_fingerprint, status=excluded.status,"
+                             "processed_date=excluded.processed_date, result_date=excluded.result_date,"
+                             "weighted_averages=excluded.weighted_averages",
+                             (file_name, file_path, file_size, file_mtime, content_hash, fingerprint, status,
+                              datetime.now().isoformat(), result_date, weighted_averages))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
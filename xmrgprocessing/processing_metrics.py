@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the stage histogram buckets. The last bucket catches everything else.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# Stages timed while processing a file.
+STAGE_QUEUE_WAIT = 'queue_wait'
+STAGE_OPEN = 'open'
+STAGE_HEADER = 'header'
+STAGE_DECODE = 'decode'
+STAGE_GEOMETRY = 'geometry'
+STAGE_WEIGHTING = 'weighting'
+STAGE_RESULT_IPC = 'result_ipc'
+STAGE_SAVE = 'save'
+
+
+class processing_metrics:
+    '''
+    Counters and per stage timing histograms. The workers each keep one, ship what they've collected to the
+    parent with every result as a plain dict, and the parent merges them into the run totals. At the end of a run
+    the totals can be written out as JSON or in the Prometheus text exposition format.
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._counters = {}
+        # Per stage {'count': int, 'sum': float, 'min': float, 'max': float, 'buckets': [count per bucket]}
+        self._histograms = {}
+        # The parent updates its metrics from the feeder thread as well as the calling thread.
+        self._lock = threading.Lock()
+
+    @property
+    def counters(self):
+        return self._counters
+
+    @property
+    def histograms(self):
+        return self._histograms
+
+    def empty(self):
+        return not self._counters and not self._histograms
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        '''
+        Adds a timing to the stage histogram.
+        :param stage: Name of the stage.
+        :param seconds: Elapsed time.
+        :return:
+        '''
+        with self._lock:
+            histogram = self._histograms.get(stage, None)
+            if histogram is None:
+                histogram = {'count': 0, 'sum': 0.0, 'min': seconds, 'max': seconds,
+                             'buckets': [0] * len(self._buckets)}
+                self._histograms[stage] = histogram
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['min'] = min(histogram['min'], seconds)
+            histogram['max'] = max(histogram['max'], seconds)
+            for ndx, upper_bound in enumerate(self._buckets):
+                if seconds <= upper_bound:
+                    histogram['buckets'][ndx] += 1
+                    break
+
+    @contextmanager
+    def time_stage(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time)
+
+    def merge(self, metrics_data):
+        '''
+        Adds the counters and histograms from another processing_metrics or its to_dict().
+        :param metrics_data:
+        :return:
+        '''
+        if isinstance(metrics_data, processing_metrics):
+            metrics_data = metrics_data.to_dict()
+        with self._lock:
+            for name, value in metrics_data.get('counters', {}).items():
+                self._counters[name] = self._counters.get(name, 0) + value
+            for stage, other in metrics_data.get('histograms', {}).items():
+                histogram = self._histograms.get(stage, None)
+                if histogram is None:
+                    self._histograms[stage] = {'count': other['count'], 'sum': other['sum'], 'min': other['min'],
+                                               'max': other['max'], 'buckets': list(other['buckets'])}
+                else:
+                    histogram['count'] += other['count']
+                    histogram['sum'] += other['sum']
+                    histogram['min'] = min(histogram['min'], other['min'])
+                    histogram['max'] = max(histogram['max'], other['max'])
+                    histogram['buckets'] = [count + other_count for count, other_count
+                                            in zip(histogram['buckets'], other['buckets'])]
+
+    def to_dict(self):
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'histograms': {stage: dict(histogram, buckets=list(histogram['buckets']))
+                                   for stage, histogram in self._histograms.items()}}
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def summary(self):
+        '''
+        Returns the counters and, for each stage, the count, total, mean, min and max seconds.
+        :return:
+        '''
+        metrics_data = self.to_dict()
+        stages = {}
+        for stage, histogram in metrics_data['histograms'].items():
+            stages[stage] = {'count': histogram['count'],
+                             'total_seconds': histogram['sum'],
+                             'mean_seconds': histogram['sum'] / histogram['count'] if histogram['count'] else 0.0,
+                             'min_seconds': histogram['min'],
+                             'max_seconds': histogram['max']}
+        return {'counters': metrics_data['counters'], 'stages': stages}
+
+    def write_json(self, file_name):
+        metrics_data = self.to_dict()
+        metrics_data['buckets'] = [str(upper_bound) for upper_bound in self._buckets]
+        metrics_data['summary'] = self.summary()
+        with open(file_name, 'w') as json_file:
+            json.dump(metrics_data, json_file, indent=2)
+
+    def write_prometheus(self, file_name, prefix='xmrg'):
+        '''
+        Writes the metrics in the Prometheus text format, for example for the node exporter textfile collector.
+        The file is written to a temporary name and renamed so the collector never reads a partial file.
+        :param file_name:
+        :param prefix: Prefix of the metric names.
+        :return:
+        '''
+        metrics_data = self.to_dict()
+        lines = []
+        for name, value in sorted(metrics_data['counters'].items()):
+            metric_name = f"{prefix}_{name}_total"
+            lines.append(f"# TYPE {metric_name} counter")
+            lines.append(f"{metric_name} {value}")
+        metric_name = f"{prefix}_stage_seconds"
+        lines.append(f"# HELP {metric_name} Time spent in each processing stage.")
+        lines.append(f"# TYPE {metric_name} histogram")
+        for stage, histogram in sorted(metrics_data['histograms'].items()):
+            cumulative_count = 0
+            for upper_bound, count in zip(self._buckets, histogram['buckets']):
+                cumulative_count += count
+                le = '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+                lines.append(f'{metric_name}_bucket{{stage="{stage}",le="{le}"}} {cumulative_count}')
+            lines.append(f'{metric_name}_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'{metric_name}_count{{stage="{stage}"}} {histogram["count"]}')
+        temp_filename = f"{file_name}.{os.getpid()}.tmp"
+        with open(temp_filename, 'w') as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
+        os.replace(temp_filename, file_name)
@@ -0,0 +1,152 @@
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+DEFAULT_ACCUMULATION_WINDOWS = (24, 48, 72)
+EPOCH = datetime(1970, 1, 1)
+
+
+def accumulation_result_type(hours):
+    '''
+    Name of the result type the rolling sum for a window is added to the xmrg_results as.
+    :param hours: Window length in hours.
+    :return:
+    '''
+    return f"weighted_average_{hours}h"
+
+
+class rolling_accumulator:
+    '''
+    Adds rolling multi hour rainfall totals to the hourly results as they come back from the workers.
+    The boundary weighted average is linear in the grid values, so the total of the hourly weighted averages is
+    the weighted average of the summed grids. We only need to keep a ring buffer of the last N hourly weighted
+    averages per boundary rather than the grids, and each file is still only decoded once.
+    The workers finish files out of order, so results are held in a small reorder buffer and released in time
+    order. A result that shows up after later hours were released is still added to the ring buffer, but the
+    totals already released for those later hours don't include it.
+    Hours that aren't processed again, such as files the ledger skips, can be added with add_hourly from their
+    saved weighted averages. They go through the reorder buffer so they fill the windows, but aren't released.
+    '''
+    def __init__(self, boundary_names, windows=DEFAULT_ACCUMULATION_WINDOWS, min_coverage=1.0, reorder_size=16):
+        '''
+
+        :param boundary_names: Names of the boundaries being processed.
+        :param windows: Window lengths in hours.
+        :param min_coverage: Fraction of the hours in a window that must have results for the total to be added,
+          1.0 means every hour must be present.
+        :param reorder_size: Number of results held back to put them in time order before they are released.
+        '''
+        self._logger = logging.getLogger()
+        self._boundary_names = list(boundary_names)
+        self._boundary_ndx = {name: ndx for ndx, name in enumerate(self._boundary_names)}
+        self._windows = sorted(set(windows))
+        self._min_coverage = min_coverage
+        self._reorder_size = max(reorder_size, 0)
+        ring_size = self._windows[-1]
+        # Ring buffer of the hourly weighted averages, the slot for an hour is hour % ring_size. slot_hours holds
+        # the hour each slot was written for so stale slots and gaps are ignored.
+        self._values = np.zeros((ring_size, len(self._boundary_names)), dtype=np.float64)
+        self._slot_hours = np.full(ring_size, -1, dtype=np.int64)
+        # Heap of (hour, sequence, result) waiting to be released.
+        self._pending = []
+        self._sequence = 0
+        self._last_released_hour = None
+        # The skipped hours are added from the dispatcher's feeder thread, the results from the calling thread.
+        self._lock = threading.Lock()
+
+    @property
+    def windows(self):
+        return self._windows
+
+    def result_hour(self, xmrg_results_data):
+        return self.date_hour(xmrg_results_data.datetime)
+
+    def date_hour(self, result_datetime):
+        result_date = datetime.strptime(result_datetime, "%Y-%m-%dT%H:%M:%S")
+        return (result_date - EPOCH) // timedelta(hours=1)
+
+    def add(self, xmrg_results_data):
+        '''
+        Adds an hourly result.
+        :param xmrg_results_data: xmrg_results from a worker.
+        :return: List of the results released, in time order, with the rolling totals added.
+        '''
+        hour = self.result_hour(xmrg_results_data)
+        weighted_averages = {boundary_name: boundary_results.get('weighted_average', None)
+                             for boundary_name, boundary_results in xmrg_results_data.get_boundary_data()}
+        return self.push(hour, weighted_averages, xmrg_results_data)
+
+    def add_hourly(self, result_datetime, weighted_averages):
+        '''
+        Adds the weighted averages of an hour that isn't being processed again. They are used for the rolling
+        totals but no result is released for the hour. Nothing is released here either, so this can be called
+        from another thread than add, the hour is stored when the next add or flush reaches it.
+        :param result_datetime: The hour as the "%Y-%m-%dT%H:%M:%S" string the results use.
+        :param weighted_averages: Dict of boundary name to the hour's weighted average.
+        :return:
+        '''
+        hour = self.date_hour(result_datetime)
+        with self._lock:
+            heapq.heappush(self._pending, (hour, self._sequence, weighted_averages, None))
+            self._sequence += 1
+
+    def push(self, hour, weighted_averages, xmrg_results_data):
+        with self._lock:
+            heapq.heappush(self._pending, (hour, self._sequence, weighted_averages, xmrg_results_data))
+            self._sequence += 1
+            released = []
+            while len(self._pending) > self._reorder_size:
+                released.append(self.release())
+        return [xmrg_results_data for xmrg_results_data in released if xmrg_results_data is not None]
+
+    def flush(self):
+        '''
+        Releases all the results still in the reorder buffer.
+        :return: List of the results in time order.
+        '''
+        released = []
+        with self._lock:
+            while self._pending:
+                released.append(self.release())
+        return [xmrg_results_data for xmrg_results_data in released if xmrg_results_data is not None]
+
+    def store(self, hour, weighted_averages):
+        ring_size = len(self._slot_hours)
+        slot = hour % ring_size
+        if self._slot_hours[slot] > hour:
+            # The slot was already reused for a later hour, this result is too old to be part of any window.
+            return
+        values = np.zeros(len(self._boundary_names), dtype=np.float64)
+        for boundary_name, weighted_average in weighted_averages.items():
+            ndx = self._boundary_ndx.get(boundary_name, None)
+            if ndx is not None and weighted_average is not None and weighted_average != -9999:
+                values[ndx] = weighted_average
+        self._values[slot] = values
+        self._slot_hours[slot] = hour
+
+    def release(self):
+        hour, sequence, weighted_averages, xmrg_results_data = heapq.heappop(self._pending)
+        # Results go into the ring buffer as they are released, so it never holds hours past the one being released.
+        self.store(hour, weighted_averages)
+        if xmrg_results_data is None:
+            # An hour added from its saved values, it only fills the windows.
+            self._last_released_hour = max(hour, self._last_released_hour or hour)
+            return None
+        if self._last_released_hour is not None and hour < self._last_released_hour:
+            self._logger.debug(f"Result for: {xmrg_results_data.datetime} arrived after later hours were released.")
+        else:
+            self._last_released_hour = hour
+        ring_size = len(self._slot_hours)
+        for window in self._windows:
+            window_hours = hour - np.arange(window)
+            slots = window_hours % ring_size
+            present = self._slot_hours[slots] == window_hours
+            if present.sum() / window >= self._min_coverage:
+                totals = self._values[slots[present]].sum(axis=0)
+                result_type = accumulation_result_type(window)
+                for ndx, boundary_name in enumerate(self._boundary_names):
+                    xmrg_results_data.add_boundary_result(boundary_name, result_type, float(totals[ndx]))
+        return xmrg_results_data
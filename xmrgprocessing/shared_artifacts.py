@@ -0,0 +1,113 @@
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+import shapely
+
+# Arrays are aligned in the shared block so the views are properly aligned for any dtype.
+ARRAY_ALIGNMENT = 64
+
+
+def pack_geometries(geometries):
+    '''
+    Packs geometries into a single WKB byte array so they can be put in shared memory.
+    :param geometries: Array or list of shapely geometries.
+    :return: Tuple of (uint8 array of the WKB, int64 array of the start offset of each geometry plus the end).
+    '''
+    wkb = shapely.to_wkb(np.asarray(geometries, dtype=object))
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(geometry_wkb) for geometry_wkb in wkb])
+    return np.frombuffer(b''.join(wkb), dtype=np.uint8), offsets
+
+
+def unpack_geometries(wkb, offsets):
+    '''
+    Rebuilds the geometries packed by pack_geometries.
+    :param wkb: uint8 array of the WKB.
+    :param offsets: int64 array of offsets.
+    :return: numpy array of shapely geometries.
+    '''
+    wkb_bytes = wkb.tobytes()
+    return shapely.from_wkb([wkb_bytes[offsets[ndx]:offsets[ndx + 1]] for ndx in range(len(offsets) - 1)])
+
+
+class shared_artifacts:
+    '''
+    A set of named, read only numpy arrays in one multiprocessing.shared_memory block. The parent publishes the
+    arrays once and hands the small descriptor to the workers, which attach and get views onto the same memory
+    instead of each building or unpickling their own copy.
+    The parent that published the block must unlink it once the workers are done.
+    '''
+    def __init__(self, shm, descriptor, owner):
+        self._logger = logging.getLogger()
+        self._shm = shm
+        self._descriptor = descriptor
+        self._owner = owner
+        self._arrays = {}
+        for name, (dtype, shape, offset) in descriptor['arrays'].items():
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            array.flags.writeable = False
+            self._arrays[name] = array
+
+    @classmethod
+    def publish(cls, arrays, metadata=None):
+        '''
+        Copies the arrays into a new shared memory block.
+        :param arrays: Dict of name to numpy array.
+        :param metadata: Small picklable dict sent to the workers with the descriptor.
+        :return: shared_artifacts that owns the block.
+        '''
+        layout = {}
+        size = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            size = -(-size // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+            layout[name] = (array.dtype.str, array.shape, size)
+            size += array.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, array in arrays.items():
+            dtype, shape, offset = layout[name]
+            np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)[...] = array
+        descriptor = {'shm_name': shm.name, 'arrays': layout, 'metadata': metadata or {}}
+        return cls(shm, descriptor, True)
+
+    @classmethod
+    def attach(cls, descriptor):
+        '''
+        Attaches to a block published by another process.
+        :param descriptor: The descriptor from the publishing shared_artifacts.
+        :return: shared_artifacts
+        '''
+        return cls(shared_memory.SharedMemory(name=descriptor['shm_name']), descriptor, False)
+
+    @property
+    def descriptor(self):
+        return self._descriptor
+
+    @property
+    def metadata(self):
+        return self._descriptor['metadata']
+
+    @property
+    def size(self):
+        return self._shm.size
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def get(self, name):
+        return self._arrays[name]
+
+    def close(self):
+        # The views must be released before the block can be closed.
+        self._arrays = {}
+        try:
+            self._shm.close()
+        except BufferError as e:
+            self._logger.error(f"Shared memory block: {self._descriptor['shm_name']} still in use.")
+            self._logger.exception(e)
+
+    def unlink(self):
+        self.close()
+        if self._owner:
+            self._shm.unlink()
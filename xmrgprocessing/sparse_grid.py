@@ -0,0 +1,61 @@
+import numpy as np
+
+
+class sparse_grid:
+    '''
+    The nonzero cells of a decoded grid window in coordinate form. Most hours have rain over a small part of the
+    grid, so keeping only the flat cell index, row by row west to east, and the raw int16 value of the nonzero
+    cells makes the work and memory per file scale with the area that is raining rather than the grid size.
+    Negative values, such as missing data, are nonzero and are kept.
+    '''
+    __slots__ = ('_shape', '_cell_index', '_values')
+
+    def __init__(self, shape, cell_index, values):
+        '''
+
+        :param shape: (rows, columns) of the dense window.
+        :param cell_index: Sorted array of the flat indexes of the nonzero cells.
+        :param values: int16 array of the values of those cells.
+        '''
+        self._shape = tuple(shape)
+        self._cell_index = np.asarray(cell_index, dtype=np.int64)
+        self._values = np.asarray(values, dtype=np.int16)
+
+    @classmethod
+    def from_dense(cls, window_grid):
+        '''
+        Builds the sparse grid from a (rows, columns) array.
+        :param window_grid:
+        :return: sparse_grid
+        '''
+        window_grid = np.asarray(window_grid)
+        cell_index = np.flatnonzero(window_grid)
+        return cls(window_grid.shape, cell_index, window_grid.reshape(-1)[cell_index])
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def cell_index(self):
+        return self._cell_index
+
+    @property
+    def values(self):
+        return self._values
+
+    @property
+    def nonzero_count(self):
+        return len(self._cell_index)
+
+    def has_rain(self):
+        return bool((self._values > 0).any())
+
+    def to_dense(self):
+        '''
+        Returns the int16 (rows, columns) array.
+        :return:
+        '''
+        window_grid = np.zeros(self._shape, dtype=np.int16)
+        window_grid.reshape(-1)[self._cell_index] = self._values
+        return window_grid
@@ -1,9 +1,10 @@
 import logging
 import time
-from .xmrg_processing import xmrg_processing_geopandas
+from .xmrg_processing import xmrg_processing_geopandas, DEFAULT_SERIAL_FILE_LIMIT, DEFAULT_POOL_FILE_THRESHOLD
 from .xmrg_utilities import download_files, file_list_from_date_range
 from .xmrg_results import xmrg_results
 from .xmrgfileiterator.xmrg_file_iterator import xmrg_file_iterator
+from .xmrgfileiterator.xmrg_download_iterator import xmrg_download_iterator
 
 
 class xmrg_file_processing:
@@ -17,15 +18,44 @@ class xmrg_file_processing:
                     source_file_working_directory=kwargs['source_file_working_directory'],
                     delete_source_file=kwargs['delete_source_file'],
                     delete_compressed_source_file=kwargs['delete_compressed_source_file'],
+                    write_uncompressed_file=kwargs.get('write_uncompressed_file', False),
                     kml_output_directory=kwargs['kml_output_directory'],
                     callback_function=self.process_results_callback,
-                    base_log_output_directory=kwargs['base_log_directory'])
+                    base_log_output_directory=kwargs['base_log_directory'],
+                    geometry_cache_directory=kwargs.get('geometry_cache_directory', None),
+                    weighting_mode=kwargs.get('weighting_mode', 'matrix'),
+                    ledger_file=kwargs.get('ledger_file', None),
+                    force_reprocess=kwargs.get('force_reprocess', False),
+                    accumulation_windows=kwargs.get('accumulation_windows', None),
+                    accumulation_min_coverage=kwargs.get('accumulation_min_coverage', 1.0),
+                    save_window_grid=kwargs.get('save_window_grid', False),
+                    debug_output_format=kwargs.get('debug_output_format', 'geojson'),
+                    debug_every_nth_hour=kwargs.get('debug_every_nth_hour', None),
+                    debug_dates=kwargs.get('debug_dates', None),
+                    execution_backend=kwargs.get('execution_backend', 'auto'),
+                    serial_file_limit=kwargs.get('serial_file_limit', DEFAULT_SERIAL_FILE_LIMIT),
+                    pool_file_threshold=kwargs.get('pool_file_threshold', DEFAULT_POOL_FILE_THRESHOLD),
+                    pool_chunk_size=kwargs.get('pool_chunk_size', None))
         #self._file_list = kwargs.get('file_list', [])
-        self._file_list_iterator = kwargs.get('file_list_iterator', xmrg_file_iterator())
         self._copy_file = kwargs.get('copy_source_file', False)
-        self._download_directory = "./"
-        self._xmrg_url = ""
+        self._download_directory = kwargs.get('download_directory', None)
+        self._xmrg_url = kwargs.get('xmrg_url', "")
+        #If we're given a URL, the files are downloaded as we go and each one is handed to the workers as soon
+        #as it arrives instead of waiting for the whole date range to download.
+        if 'file_list_iterator' in kwargs:
+            self._file_list_iterator = kwargs['file_list_iterator']
+        elif len(self._xmrg_url):
+            self._file_list_iterator = xmrg_download_iterator(download_url=self._xmrg_url,
+                                                              destination_directory=self._download_directory,
+                                                              max_in_flight=kwargs.get('max_downloads_in_flight', 8),
+                                                              max_workers=kwargs.get('download_worker_count', 4),
+                                                              decompress=kwargs.get('decompress_downloads', False))
+        else:
+            self._file_list_iterator = xmrg_file_iterator()
         self._data_saver = kwargs['data_saver']
+        #Optional files the run's stage timings and counters are written to when process finishes.
+        self._metrics_json_file = kwargs.get('metrics_json_file', None)
+        self._metrics_prometheus_file = kwargs.get('metrics_prometheus_file', None)
 
         self._logger = logging.getLogger(kwargs.get("logger_name", ""))
     @property
@@ -51,7 +81,35 @@ class xmrg_file_processing:
 
         self._xmrg_proc.import_files(self._file_list_iterator)
 
-        self._data_saver.finalize()
+        metrics = self._xmrg_proc.metrics
+        with metrics.time_stage('finalize'):
+            self._data_saver.finalize()
 
-        self._logger.info(f"process finished in {time.time()-start_time} seconds.")
+        run_seconds = time.time() - start_time
+        self._logger.info(f"process finished in {run_seconds} seconds.")
+        self.write_metrics(metrics, run_seconds)
+
+    @property
+    def metrics(self):
+        return self._xmrg_proc.metrics
+
+    def write_metrics(self, metrics, run_seconds):
+        '''
+        Logs the stage summary and writes the metrics files if they were configured.
+        :param metrics: processing_metrics of the run.
+        :param run_seconds: Wall clock time of the run.
+        :return:
+        '''
+        metrics.observe('run', run_seconds)
+        for stage, stage_summary in metrics.summary()['stages'].items():
+            self._logger.info(f"Stage: {stage} count: {stage_summary['count']} "
+                              f"total: {stage_summary['total_seconds']:.3f} "
+                              f"mean: {stage_summary['mean_seconds']:.6f} seconds.")
+        try:
+            if self._metrics_json_file is not None:
+                metrics.write_json(self._metrics_json_file)
+            if self._metrics_prometheus_file is not None:
+                metrics.write_prometheus(self._metrics_prometheus_file)
+        except Exception as e:
+            self._logger.exception(e)
 
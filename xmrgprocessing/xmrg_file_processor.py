@@ -0,0 +1,455 @@
+import os
+import time
+import logging
+from multiprocessing import current_process
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from .xmrg_results import xmrg_results
+from .geoXmrg import geoXmrg, LatLong
+from .grid_geometry_cache import grid_geometry_cache
+from .boundary_weights import boundary_weights, boundary_weight_matrix, build_intersection_frame
+from .debug_writer import debug_writer, DEFAULT_DEBUG_QUEUE_SIZE
+from .shared_artifacts import shared_artifacts, unpack_geometries
+from .xmrg_utilities import get_collection_date_from_filename
+from .processing_metrics import processing_metrics, STAGE_OPEN, STAGE_HEADER, STAGE_DECODE, STAGE_GEOMETRY, \
+    STAGE_WEIGHTING
+
+
+def build_boundary_frame(name, geometry):
+    df = pd.DataFrame([[name, geometry]], columns=['Name', 'Boundaries'])
+    boundary_df = gpd.GeoDataFrame(df, geometry=df.Boundaries)
+    boundary_df = boundary_df.drop(columns=['Boundaries'])
+    boundary_df.set_crs(epsg=4326, inplace=True)
+    return boundary_df
+
+
+def build_grid_frame(precipitation, cell_geometries):
+    return gpd.GeoDataFrame({'Precipitation': precipitation}, geometry=cell_geometries, crs="EPSG:4326")
+
+
+def setup_worker_logger(base_log_output_directory):
+    '''
+    Each worker gets its own log file and error log file.
+    :param base_log_output_directory: Directory the log files are written to.
+    :return: The logger.
+    '''
+    process_name = current_process().name
+    log_output_filename = os.path.join(base_log_output_directory,
+                                       f"process_xmrg_file_geopandas-{process_name}.log")
+    error_log_output_filename = os.path.join(base_log_output_directory,
+                                             f"process_xmrg_file_geopandas_errors-{process_name}.log")
+
+    logger = logging.getLogger("process_xmrg_file_geopandas")
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter("%(asctime)s,%(levelname)s,%(funcName)s,%(lineno)d,%(message)s")
+    fh = logging.handlers.RotatingFileHandler(log_output_filename)
+    error_fh = logging.handlers.RotatingFileHandler(error_log_output_filename)
+    ch = logging.StreamHandler()
+    fh.setLevel(logging.DEBUG)
+    error_fh.setLevel(logging.ERROR)
+    ch.setLevel(logging.DEBUG)
+    fh.setFormatter(formatter)
+    ch.setFormatter(formatter)
+    logger.addHandler(fh)
+    logger.addHandler(ch)
+    return logger
+
+
+class xmrg_file_processor:
+    '''
+    Turns one XMRG file at a time into an xmrg_results. All the per run setup, the boundaries, weight matrices,
+    grid geometry cache and debug writer, is done once in the constructor so every execution backend, the queue
+    workers, the process pool and the in process serial mode, share the same file processing.
+    '''
+    def __init__(self, logger=None, **kwargs):
+        '''
+
+        :param logger: Logger to use, defaults to the process_xmrg_file_geopandas logger.
+        :param kwargs: The worker arguments built by xmrg_processing_geopandas.worker_args.
+        '''
+        self._logger = logger if logger is not None else logging.getLogger("process_xmrg_file_geopandas")
+        self._process_name = current_process().name
+        # Stage timings and counters since the last time they were taken with take_metrics.
+        self._metrics = processing_metrics()
+        self._file_count = 0
+        self._debug_files_written = 0
+        self._debug_files_dropped = 0
+
+        debug_dir = kwargs.get('debug_files_directory', None)
+        self._save_all_precip_vals = kwargs.get('save_all_precip_vals', False)
+        self._delete_source_file = kwargs.get('delete_source_file', False)
+        self._delete_compressed_source_file = kwargs.get('delete_compressed_source_file', False)
+        # Gzip files are decompressed into memory unless we are asked to write the uncompressed file out.
+        self._write_uncompressed_file = kwargs.get('write_uncompressed_file', False)
+        # Send the raw grid window back with the results for the savers that keep the whole grid.
+        self._save_window_grid = kwargs.get('save_window_grid', False)
+        # A course bounding box that restricts us to our area of interest.
+        self._min_lat_long = None
+        self._max_lat_long = None
+        if kwargs.get('min_lat_lon', None) is not None and kwargs.get('max_lat_lon', None) is not None:
+            self._min_lat_long = LatLong(kwargs['min_lat_lon'][0], kwargs['min_lat_lon'][1])
+            self._max_lat_long = LatLong(kwargs['max_lat_lon'][0], kwargs['max_lat_lon'][1])
+
+        # The grid cell polygons are the same for every file in a run, so we build them once per worker.
+        self._geometry_cache = grid_geometry_cache(kwargs.get('geometry_cache_directory', None))
+
+        # 'matrix' uses the precomputed boundary weight matrix, 'overlay' runs gpd.overlay for every file and is
+        # kept as the reference to check results against.
+        self._weighting_mode = kwargs.get('weighting_mode', 'matrix')
+
+        # Boundaries we are creating the weighted averages for. If the dispatcher prepared them in shared
+        # memory we attach to those, along with the weight matrix and cell geometry for the grid it found.
+        self._artifacts = None
+        if kwargs.get('shared_boundary_artifacts', None) is not None:
+            self._artifacts = shared_artifacts.attach(kwargs['shared_boundary_artifacts'])
+            boundaries = list(zip(self._artifacts.metadata['boundary_names'],
+                                  unpack_geometries(self._artifacts.get('boundary_geometry_wkb'),
+                                                    self._artifacts.get('boundary_geometry_offsets'))))
+            self._weighting = boundary_weights(boundaries)
+            if 'weights' in self._artifacts:
+                grid_signature = self._artifacts.metadata['grid_signature']
+                self._weighting.add_matrix(grid_signature,
+                                           boundary_weight_matrix.from_arrays(
+                                               self._artifacts.metadata['boundary_names'], self._artifacts))
+                self._geometry_cache.put(grid_signature,
+                                         gpd.GeoSeries(shapely.polygons(self._artifacts.get('cell_rings')),
+                                                       crs="EPSG:4326"))
+        else:
+            boundaries = kwargs['boundaries']
+            self._weighting = boundary_weights(boundaries)
+
+        self._save_boundary_grid_cells = True
+
+        # The debug files are written from a background thread so they never hold up the processing.
+        self._writer = None
+        if debug_dir is not None:
+            self._writer = debug_writer(debug_dir,
+                                        kwargs.get('debug_output_format', 'geojson'),
+                                        kwargs.get('debug_queue_size', DEFAULT_DEBUG_QUEUE_SIZE),
+                                        kwargs.get('debug_every_nth_hour', None),
+                                        kwargs.get('debug_dates', None))
+
+        # The overlay path intersects all the boundaries with the grid at once, so it only needs the polygons
+        # and their areas. The boundary frames are only built for the debug files.
+        self._boundary_names = [boundary[0] for boundary in boundaries]
+        self._boundary_geometries = np.asarray([boundary[1] for boundary in boundaries], dtype=object)
+        self._boundary_areas = shapely.area(self._boundary_geometries)
+        self._boundary_centroids = shapely.get_coordinates(shapely.centroid(self._boundary_geometries))
+        # Write out files we can use to visualize the boundaries if needed. They are queued as one batch in the
+        # empty queue, so every boundary gets its file however many there are.
+        if self._writer is not None:
+            self._writer.submit_batch([(f"{boundary[0].replace(' ', '_')}_boundary",
+                                        lambda boundary=boundary: build_boundary_frame(boundary[0], boundary[1]))
+                                       for boundary in boundaries],
+                                      overwrite=False)
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def file_count(self):
+        return self._file_count
+
+    def take_metrics(self):
+        '''
+        Returns the metrics collected since the last call as a dict and starts collecting again.
+        :return:
+        '''
+        metrics_data = self._metrics.to_dict()
+        self._metrics.reset()
+        return metrics_data
+
+    def process_file(self, xmrg_filename):
+        '''
+        Decodes the file and calculates the boundary results.
+        :param xmrg_filename: Path of the XMRG file.
+        :return: xmrg_results or None if the file could not be processed.
+        '''
+        logger = self._logger
+        metrics = self._metrics
+        boundary_names = self._boundary_names
+        process_name = self._process_name
+        gp_results = None
+        source_filename = os.path.basename(xmrg_filename)
+        if logger:
+            logger.debug("ID: %s processing file: %s" % (process_name, xmrg_filename))
+
+        gpXmrg = geoXmrg(self._min_lat_long, self._max_lat_long, 0.01, geometry_cache=self._geometry_cache)
+        open_start_time = time.perf_counter()
+        try:
+            gpXmrg.openFile(xmrg_filename, write_uncompressed=self._write_uncompressed_file)
+        except Exception as e:
+            metrics.increment('files_failed')
+            logger.error("ID: %s Process: %s Failed to open file: %s" % (process_name, process_name, xmrg_filename))
+            logger.exception(e)
+            return None
+        metrics.observe(STAGE_OPEN, time.perf_counter() - open_start_time)
+
+        # This is the database insert datetime.
+        # Parse the filename to get the data time.
+        (directory, filetime) = os.path.split(gpXmrg.fileName)
+        xmrg_filename = filetime
+        (filetime, ext) = os.path.splitext(filetime)
+        filetime = get_collection_date_from_filename(filetime)
+
+        try:
+            header_start_time = time.perf_counter()
+            header_read = gpXmrg.readFileHeader()
+            metrics.observe(STAGE_HEADER, time.perf_counter() - header_start_time)
+            rows_read = False
+            no_rain = False
+            if header_read:
+                read_rows_start = time.time()
+                # Most hours are dry. If the header's max value is 0 or less there is no rain anywhere on the grid,
+                # so the rows aren't decoded at all. The savers that keep the grid still need the rows.
+                header_max_value = gpXmrg.headerMaxValue()
+                if not self._save_window_grid and header_max_value is not None and header_max_value <= 0:
+                    no_rain = True
+                else:
+                    rows_read = gpXmrg.readWindowGrid()
+                    if rows_read:
+                        metrics.observe(STAGE_DECODE, gpXmrg.decodeSeconds)
+                        # Older headers have no max value and the max covers the whole grid, so the window can
+                        # still be dry. Checking it is much cheaper than building the geometry.
+                        no_rain = not gpXmrg.sparse_grid.has_rain()
+
+            if no_rain or rows_read:
+                gp_results = xmrg_results()
+                gp_results.datetime = filetime
+                gp_results.source_file = source_filename
+                start_row, end_row, start_col, end_col = gpXmrg.gridWindow()
+                gp_results.set_grid_window(gpXmrg.XOR, gpXmrg.YOR, start_row, start_col, end_col - start_col)
+
+                weighting_start_time = time.perf_counter()
+                if no_rain:
+                    self.add_no_rain_results(gpXmrg, gp_results)
+                    metrics.increment('files_no_rain')
+                    if logger:
+                        logger.info(f"ID: {process_name} File: {xmrg_filename} has no rain in the window, "
+                                    f"header max value: {header_max_value}.")
+                else:
+                    if logger:
+                        logger.info(f"ID: {process_name}({time.time() - read_rows_start} secs)"
+                                    f" to read all rows in file: {xmrg_filename}")
+                    self.add_weighted_results(gpXmrg, gp_results, xmrg_filename)
+                    # The grid GeoDataFrame is only built if the overlay or debug files needed it.
+                    if gpXmrg.geometrySeconds:
+                        metrics.observe(STAGE_GEOMETRY, gpXmrg.geometrySeconds)
+
+                metrics.observe(STAGE_WEIGHTING, time.perf_counter() - weighting_start_time)
+                metrics.increment('files_processed')
+                metrics.increment('boundaries_processed', len(boundary_names))
+                self._file_count += 1
+                try:
+                    gpXmrg.cleanUp(self._delete_source_file, self._delete_compressed_source_file)
+                except Exception as e:
+                    logger.exception(e)
+                # Closing the file copies the grid out of the memory map, so it's added once the file is closed.
+                if self._save_window_grid:
+                    gp_results.set_window_grid(gpXmrg.sparse_grid)
+            else:
+                metrics.increment('files_failed')
+                if logger:
+                    logger.error("ID: %s Process: %s Failed to process file: %s"
+                                 % (process_name, process_name, xmrg_filename))
+        except Exception as e:
+            gp_results = None
+            metrics.increment('files_failed')
+            logger.error("ID: %s Process: %s Failed to process file: %s" % (process_name, process_name, xmrg_filename))
+            logger.exception(e)
+        return gp_results
+
+    def add_weighted_results(self, gpXmrg, gp_results, xmrg_filename):
+        '''
+        Calculates the weighted average for each boundary from the decoded grid and queues the debug files.
+        :param gpXmrg: geoXmrg with the window decoded.
+        :param gp_results: xmrg_results the boundary results are added to.
+        :param xmrg_filename: Name of the file, for logging.
+        :return:
+        '''
+        logger = self._logger
+        writer = self._writer
+        boundary_names = self._boundary_names
+        filetime = gp_results.datetime
+        write_debug_files = writer is not None and writer.wants(filetime)
+        debug_file_prefix = filetime.replace(':', '_')
+        # The debug files for the file are queued together once all the boundaries are done.
+        debug_frames = []
+        if self._weighting_mode == 'matrix':
+            # The intersections only depend on the grid, so the matrix is built once per grid signature and
+            # each file is just a sparse matrix-vector product. Only the entries of the nonzero cells are
+            # touched, a boundary with no rain in its cells has no entries and is 0.
+            weight_matrix = self.weight_matrix(gpXmrg)
+            entries, entry_values = weight_matrix.nonzero_entries(gpXmrg.sparse_grid)
+            entry_values = entry_values * gpXmrg.data_multiplier
+            weighted_averages = weight_matrix.entry_weighted_averages(entries, entry_values)
+            entry_offsets = weight_matrix.entry_offsets(entries)
+        else:
+            # Reference path, intersect the boundaries with the grid for every file. All the boundaries are done
+            # in one pass and the averages come from a groupby on the combined intersections.
+            all_overlayed = self.overlay_boundaries(gpXmrg)
+            weighted_averages = all_overlayed.groupby('boundary_index')['weighted average'].sum()\
+                .reindex(range(len(boundary_names)), fill_value=0.0).to_numpy()
+            overlay_offsets = np.searchsorted(all_overlayed['boundary_index'].to_numpy(),
+                                              np.arange(len(boundary_names) + 1))
+
+        for index, boundary_name in enumerate(boundary_names):
+            file_start_time = time.time()
+            if self._weighting_mode == 'matrix':
+                overlayed = None
+                wghtd_avg_val = float(weighted_averages[index])
+                if self._save_boundary_grid_cells:
+                    # Only the cell indexes, values and weights go back through the result
+                    # queue, the parent rebuilds the polygons if it needs them. Unless we are saving all
+                    # the values, that is only the nonzero cells.
+                    if self._save_all_precip_vals:
+                        cell_index, weights = weight_matrix.boundary_cells(index)
+                        gp_results.set_boundary_cells(boundary_name, cell_index,
+                                                      gpXmrg.precipitation[cell_index], weights)
+                    elif entry_offsets[index] < entry_offsets[index + 1]:
+                        boundary_entries = slice(entry_offsets[index], entry_offsets[index + 1])
+                        cell_index, weights = weight_matrix.entry_cells(entries[boundary_entries])
+                        gp_results.set_boundary_cells(boundary_name, cell_index,
+                                                      entry_values[boundary_entries], weights)
+                    gp_results.set_boundary_centroid(boundary_name, weight_matrix.boundary_centroid(index))
+            else:
+                overlayed = all_overlayed.iloc[overlay_offsets[index]:overlay_offsets[index + 1]]
+                wghtd_avg_val = float(weighted_averages[index])
+
+                if self._save_boundary_grid_cells:
+                    for row in overlayed.itertuples():
+                        if self._save_all_precip_vals or row.Precipitation != 0:
+                            gp_results.add_grid(row.Name, (row.geometry, row.Precipitation))
+                    # The saved cells may only be the raining ones, so the centroid of all the cells covering the
+                    # boundary is worked out here. The pieces don't overlap, so the area weighted mean of their
+                    # centroids is the centroid of their union. Boundaries with no cells use their own centroid,
+                    # as the weight matrix does.
+                    areas = shapely.area(overlayed.geometry.values)
+                    if areas.sum() > 0.0:
+                        centroids = shapely.get_coordinates(shapely.centroid(overlayed.geometry.values))
+                        gp_results.set_boundary_centroid(boundary_name,
+                                                         (float(np.dot(areas, centroids[:, 0]) / areas.sum()),
+                                                          float(np.dot(areas, centroids[:, 1]) / areas.sum())))
+                    else:
+                        gp_results.set_boundary_centroid(boundary_name,
+                                                         (float(self._boundary_centroids[index, 0]),
+                                                          float(self._boundary_centroids[index, 1])))
+            gp_results.add_boundary_result(boundary_name, 'weighted_average', wghtd_avg_val)
+            logger.info(f"ID: {self._process_name} File: {xmrg_filename} "
+                        f"Processed boundary: {boundary_name} WgtdAvg: {wghtd_avg_val}"
+                        f" in {time.time() - file_start_time} seconds.")
+
+            if write_debug_files:
+                percentage_file = f"{debug_file_prefix}_{boundary_name.replace(' ', '_')}_percentage"
+                if overlayed is None:
+                    # The intersection frame is built in the writer thread from copies of the arrays it
+                    # needs, the writer never touches the geoXmrg or the weight matrix.
+                    cell_index, weights, intersections = weight_matrix.boundary_entries(index)
+                    frame_arrays = (boundary_name, gpXmrg.precipitation[cell_index], weights.copy(),
+                                    intersections.copy())
+                    overlayed = lambda frame_arrays=frame_arrays: build_intersection_frame(*frame_arrays)
+                else:
+                    overlayed = overlayed.drop(columns=['boundary_index'])
+                debug_frames.append((percentage_file, overlayed))
+
+        if write_debug_files:
+            grid_arrays = (gpXmrg.precipitation.copy(), np.array(gpXmrg.cellGeometries().values, dtype=object))
+            debug_frames.append((f"{debug_file_prefix}_{boundary_names[0].replace(' ', '_')}_fullgrid_",
+                                 lambda grid_arrays=grid_arrays: build_grid_frame(*grid_arrays)))
+            writer.submit_batch(debug_frames)
+
+    def overlay_boundaries(self, gpXmrg):
+        '''
+        Intersects every boundary with the grid cells in one pass. The STRtree of the cells belongs to the cached
+        cell geometry, so it is built once per grid and shared by all the boundaries and files.
+        :param gpXmrg: geoXmrg with the window decoded.
+        :return: GeoDataFrame of the intersections, sorted by boundary, with the boundary_index, Name,
+          Precipitation, percent of the boundary area and weighted average columns.
+        '''
+        cell_geometries = gpXmrg.cellGeometries()
+        boundary_index, cell_index = cell_geometries.sindex.query(self._boundary_geometries, predicate='intersects')
+        order = np.lexsort((cell_index, boundary_index))
+        boundary_index = boundary_index[order]
+        cell_index = cell_index[order]
+        intersections = shapely.intersection(self._boundary_geometries[boundary_index],
+                                             np.asarray(cell_geometries.values)[cell_index])
+        percent = shapely.area(intersections) / self._boundary_areas[boundary_index]
+        precipitation = gpXmrg.precipitation[cell_index]
+        return gpd.GeoDataFrame({'boundary_index': boundary_index,
+                                 'Name': np.asarray(self._boundary_names, dtype=object)[boundary_index],
+                                 'Precipitation': precipitation,
+                                 'percent': percent,
+                                 'weighted average': precipitation * percent},
+                                geometry=intersections,
+                                crs="EPSG:4326")
+
+    def weight_matrix(self, gpXmrg):
+        '''
+        Returns the boundary weight matrix for the file's grid. The cell geometry is only needed, and only built
+        or taken from the geometry cache, the first time the grid is seen.
+        :param gpXmrg: geoXmrg with the header read.
+        :return: boundary_weight_matrix
+        '''
+        signature = gpXmrg.gridSignature()
+        weight_matrix = self._weighting.find_matrix(signature)
+        if weight_matrix is None:
+            weight_matrix = self._weighting.get_matrix(signature, gpXmrg.cellGeometries())
+        return weight_matrix
+
+    def add_no_rain_results(self, gpXmrg, gp_results):
+        '''
+        Adds a weighted average of 0 for every boundary of a dry file without decoding the rows or building the
+        grid values. The boundary centroids, and in matrix mode the cells if all the values are being saved,
+        still come from the weight matrix, which is only built here if no file with rain has been seen for the
+        grid yet. In overlay mode that is the one intersection per grid the centroids need, the savers use them
+        to place the boundary platforms.
+        :param gpXmrg: geoXmrg with the header read.
+        :param gp_results: xmrg_results the boundary results are added to.
+        :return:
+        '''
+        gp_results.no_rain = True
+        weight_matrix = None
+        if self._save_boundary_grid_cells:
+            weight_matrix = self.weight_matrix(gpXmrg)
+        for index, boundary_name in enumerate(self._boundary_names):
+            gp_results.add_boundary_result(boundary_name, 'weighted_average', 0.0)
+            if weight_matrix is not None:
+                if self._weighting_mode == 'matrix' and self._save_all_precip_vals:
+                    cell_index, weights = weight_matrix.boundary_cells(index)
+                    gp_results.set_boundary_cells(boundary_name, cell_index, np.zeros(len(cell_index)), weights)
+                gp_results.set_boundary_centroid(boundary_name, weight_matrix.boundary_centroid(index))
+
+    def flush_debug_files(self):
+        '''
+        Waits for the queued debug files to be written and adds the writer counts to the metrics.
+        :return:
+        '''
+        if self._writer is not None:
+            self._writer.flush()
+            self.count_debug_files()
+
+    def count_debug_files(self):
+        self._metrics.increment('debug_files_written', self._writer.written_count - self._debug_files_written)
+        self._metrics.increment('debug_files_dropped', self._writer.dropped_count - self._debug_files_dropped)
+        self._debug_files_written = self._writer.written_count
+        self._debug_files_dropped = self._writer.dropped_count
+
+    def close(self):
+        '''
+        Finishes the debug files and detaches from the shared boundary artifacts.
+        :return:
+        '''
+        if self._writer is not None:
+            self._writer.close()
+            self.count_debug_files()
+            self._writer = None
+        if self._artifacts is not None:
+            # Drop the views onto the shared block before closing it, the dispatcher unlinks it.
+            self._weighting = None
+            self._artifacts.close()
+            self._artifacts = None
@@ -1,187 +1,120 @@
 import os
 import logging
 from multiprocessing import Process, Queue, current_process
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import operator
+import queue
+import threading
 import time
-import pandas as pd
-import geopandas as gpd
+import itertools
+import shapely
 import shutil
 
-from .xmrg_results import xmrg_results
 from .geoXmrg import geoXmrg, LatLong
-from .xmrg_utilities import get_collection_date_from_filename
+from .boundary_weights import boundary_weight_matrix
+from .debug_writer import DEFAULT_DEBUG_QUEUE_SIZE
+from .shared_artifacts import shared_artifacts, pack_geometries
+from .rolling_accumulation import rolling_accumulator
+from .processing_metrics import processing_metrics, STAGE_QUEUE_WAIT, STAGE_RESULT_IPC, STAGE_SAVE
+from .processing_ledger import processing_ledger, boundary_fingerprint, STATUS_PROCESSED, STATUS_FAILED
+from .xmrg_file_processor import xmrg_file_processor, setup_worker_logger
+
+# Sentinel each worker puts on the result queue when it exits.
+WORKER_FINISHED = 'FINISHED'
+# Tag of the (WORKER_METRICS, metrics dict) message a worker sends before it exits with the metrics that weren't
+# shipped with a result, such as the timings of files that failed.
+WORKER_METRICS = 'METRICS'
+# How often blocked queue calls wake up to check the workers are still alive.
+QUEUE_POLL_SECONDS = 5.0
+# Number of files the dispatcher tries to open to get the grid for the shared boundary weight matrix.
+SHARED_ARTIFACT_PEEK_FILES = 24
+# Execution backends. 'serial' processes the files in this process, 'pool' sends chunks of files to a
+# ProcessPoolExecutor, 'queue' streams single files to long lived worker processes. 'auto' picks one from the
+# number of files in the job.
+EXECUTION_BACKENDS = ('auto', 'serial', 'pool', 'queue')
+# With 'auto', jobs up to this many files run serially, spawning the workers costs more than it saves.
+DEFAULT_SERIAL_FILE_LIMIT = 12
+# With 'auto', jobs of at least this many files use the process pool. Jobs in between, or whose size isn't known,
+# use the queue workers.
+DEFAULT_POOL_FILE_THRESHOLD = 500
+# Largest number of files sent to a pool worker at once.
+MAX_POOL_CHUNK_SIZE = 64
+
 
 def process_xmrg_file_geopandas(**kwargs):
+    logger = None
+    processor = None
     try:
-        try:
-            processing_start_time = time.time()
-            xmrg_file_count = 1
-            logger = None
-            process_name = current_process().name
-
-            #Each worker will get its own log file.
-            base_log_output_directory = kwargs.get('base_log_output_directory', f'process_xmrg_file_geopandas.log')
-            log_output_filename = os.path.join(base_log_output_directory,
-                                               f"process_xmrg_file_geopandas-{process_name}.log")
-            error_log_output_filename = os.path.join(base_log_output_directory,
-                                               f"process_xmrg_file_geopandas_errors-{process_name}.log")
-
-            logger = logging.getLogger("process_xmrg_file_geopandas")
-            logger.setLevel(logging.DEBUG)
-            formatter = logging.Formatter("%(asctime)s,%(levelname)s,%(funcName)s,%(lineno)d,%(message)s")
-            fh = logging.handlers.RotatingFileHandler(log_output_filename)
-            error_fh = logging.handlers.RotatingFileHandler(error_log_output_filename)
-            ch = logging.StreamHandler()
-            fh.setLevel(logging.DEBUG)
-            error_fh.setLevel(logging.ERROR)
-            ch.setLevel(logging.DEBUG)
-            fh.setFormatter(formatter)
-            ch.setFormatter(formatter)
-            logger.addHandler(fh)
-            logger.addHandler(ch)
-
-            debug_dir = kwargs['debug_files_directory']
-
-            logger.info(f"{process_name} starting process_xmrg_file_geopandas.")
-
-            inputQueue = kwargs['input_queue']
-            resultsQueue = kwargs['results_queue']
-            save_all_precip_vals = kwargs['save_all_precip_vals']
-            delete_source_file = kwargs['delete_source_file']
-            delete_compressed_source_file = kwargs['delete_compressed_source_file']
-            # A course bounding box that restricts us to our area of interest.
-            minLatLong = None
-            maxLatLong = None
-            if 'min_lat_lon' in kwargs and 'max_lat_lon' in kwargs:
-                minLatLong = LatLong(kwargs['min_lat_lon'][0], kwargs['min_lat_lon'][1])
-                maxLatLong = LatLong(kwargs['max_lat_lon'][0], kwargs['max_lat_lon'][1])
-
-            # Boundaries we are creating the weighted averages for.
-            boundaries = kwargs['boundaries']
-
-            save_boundary_grid_cells = True
-            save_boundary_grids_one_pass = True
-            write_percentages_grids_one_pass = True
-
-        except Exception as e:
-            if logger:
+        processing_start_time = time.time()
+        #Each worker will get its own log file.
+        logger = setup_worker_logger(kwargs.get('base_log_output_directory', f'process_xmrg_file_geopandas.log'))
+        logger.info(f"{current_process().name} starting process_xmrg_file_geopandas.")
+
+        inputQueue = kwargs['input_queue']
+        resultsQueue = kwargs['results_queue']
+        processor = xmrg_file_processor(logger, **kwargs)
+        # Stage timings and counters, shipped to the parent with each result.
+        metrics = processor.metrics
+        while True:
+            queue_wait_start_time = time.perf_counter()
+            xmrg_filename = inputQueue.get()
+            metrics.observe(STAGE_QUEUE_WAIT, time.perf_counter() - queue_wait_start_time)
+            if xmrg_filename == 'STOP':
+                break
+            gp_results = processor.process_file(xmrg_filename)
+            if gp_results is not None:
+                gp_results.metrics = processor.take_metrics()
+                ipc_start_time = time.perf_counter()
+                resultsQueue.put(gp_results)
+                # Shipped with the next result.
+                metrics.observe(STAGE_RESULT_IPC, time.perf_counter() - ipc_start_time)
+        logger.debug("ID: %s process finished. Processed: %d files in time: %f seconds"
+                     % (current_process().name, processor.file_count, time.time() - processing_start_time))
+    except Exception as e:
+        if logger:
+            logger.exception(e)
+    finally:
+        if processor is not None:
+            try:
+                processor.close()
+            except Exception as e:
                 logger.exception(e)
+        # Let the dispatcher know this worker is done so it can stop waiting on the result queue.
+        if 'results_queue' in kwargs:
+            if processor is not None and not processor.metrics.empty():
+                kwargs['results_queue'].put((WORKER_METRICS, processor.take_metrics()))
+            kwargs['results_queue'].put(WORKER_FINISHED)
+    return
 
-        else:
-            # Build boundary dataframes
-            boundary_frames = []
-            for boundary in boundaries:
-                df = pd.DataFrame([[boundary[0], boundary[1]]], columns=['Name', 'Boundaries'])
-                boundary_df = gpd.GeoDataFrame(df, geometry=df.Boundaries)
-                boundary_df = boundary_df.drop(columns=['Boundaries'])
-                boundary_df.set_crs(epsg=4326, inplace=True)
-                boundary_frames.append(boundary_df)
-                # Write out a geojson file we can use to visualize the boundaries if needed.
-                try:
-                    boundaries_outfile = os.path.join(debug_dir,
-                                                      f"{boundary_df['Name'][0].replace(' ', '_')}_boundary.json")
-                    if not os.path.exists(boundaries_outfile):
-                        boundary_df.to_file(boundaries_outfile, driver="GeoJSON")
-                except Exception as e:
-                    logger.exception(e)
-            for xmrg_filename in iter(inputQueue.get, 'STOP'):
-                tot_file_time_start = time.time()
-                if logger:
-                    logger.debug("ID: %s processing file: %s" % (current_process().name, xmrg_filename))
 
-                gpXmrg = geoXmrg(minLatLong, maxLatLong, 0.01)
-                try:
-                    gpXmrg.openFile(xmrg_filename)
-                except Exception as e:
-                    logger.error("ID: %s Process: %s Failed to open file: %s" \
-                                 % (current_process().name, current_process().name, xmrg_filename))
-                    logger.exception(e)
-                else:
-
-                    # This is the database insert datetime.
-                    # Parse the filename to get the data time.
-                    (directory, filetime) = os.path.split(gpXmrg.fileName)
-                    xmrg_filename = filetime
-                    (filetime, ext) = os.path.splitext(filetime)
-                    filetime = get_collection_date_from_filename(filetime)
+# The xmrg_file_processor of a process pool worker, built once by initialize_pool_worker.
+_pool_file_processor = None
 
-                    try:
-                        if gpXmrg.readFileHeader():
-                            read_rows_start = time.time()
-                            gpXmrg.readAllRows()
-                            if logger:
-                                logger.info(f"ID: {current_process().name}({time.time() - read_rows_start} secs)"
-                                            f" to read all rows in file: {xmrg_filename}")
-
-                            # precip = gpXmrg._geo_data_frame[gpXmrg._geo_data_frame.Precipitation > 0.0]
-                            # if len(precip):
-                            #  print(precip)
-                            gp_results = xmrg_results()
-                            gp_results.datetime = filetime
-                            # overlayed = gpd.overlay(gpXmrg._geo_data_frame, boundary_df, how="intersection")
-
-                            for index, boundary_row in enumerate(boundary_frames):
-                                file_start_time = time.time()
-                                overlayed = gpd.overlay(boundary_row, gpXmrg._geo_data_frame, how="intersection",
-                                                        keep_geom_type=False)
-
-                                if save_boundary_grid_cells:
-                                    for ndx, row in overlayed.iterrows():
-                                        gp_results.add_grid(row.Name, (row.geometry, row.Precipitation))
-                                # Here we create our percentage column by applying the function in the map(). This applies to
-                                # each area.
-                                overlayed['percent'] = overlayed.area.map(
-                                    lambda area: float(area) / float(boundary_row.area))
-                                overlayed['weighted average'] = (overlayed['Precipitation']) * (overlayed['percent'])
-
-                                wghtd_avg_val = sum(overlayed['weighted average'])
-                                gp_results.add_boundary_result(boundary_row['Name'][0], 'weighted_average',
-                                                               wghtd_avg_val)
-                                logger.info(f"ID: {process_name} File: {xmrg_filename} "
-                                            f"Processed boundary: {boundary_row.Name[0]} WgtdAvg: {wghtd_avg_val}"
-                                            f" in {time.time() - file_start_time} seconds.")
-                                xmrg_file_count += 1
-
-                                if write_percentages_grids_one_pass:
-                                    try:
-                                        percentage_file = os.path.join(debug_dir,
-                                            f"{overlayed['Name'][0].replace(' ', '_')}_percentage.json")
-                                        if not os.path.exists(percentage_file):
-                                            overlayed.to_file(percentage_file, driver="GeoJSON")
-                                        #Once we've written out each boundary, we can stop.
-                                        if index == len(boundary_frames) - 1:
-                                            write_percentages_grids_one_pass = False
-                                    except Exception as e:
-                                        logger.exception(e)
-                                if save_boundary_grids_one_pass:
-                                    try:
-                                        full_data_grid = os.path.join(debug_dir,
-                                                                      "%s_%s_fullgrid_.json" % (
-                                                                      filetime.replace(':', '_'),
-                                                                      boundary_row.Name[0].replace(' ', '_')))
-                                        gpXmrg._geo_data_frame.to_file(full_data_grid, driver="GeoJSON")
-                                        save_boundary_grids_one_pass = False
-                                    except Exception as e:
-                                        logger.exception(e)
-
-                            resultsQueue.put(gp_results)
-                            try:
-                                gpXmrg.cleanUp(delete_source_file, delete_compressed_source_file)
-                            except Exception as e:
-                                logger.exception(e)
-                        else:
-                            if logger:
-                                logger.error("ID: %s Process: %s Failed to process file: %s" \
-                                             % (current_process().name, current_process().name, xmrg_filename))
-                    except Exception as e:
-                        logger.error("ID: %s Process: %s Failed to process file: %s" \
-                                     % (current_process().name, current_process().name, xmrg_filename))
-                        logger.exception(e)
-            if logger:
-                logger.debug("ID: %s process finished. Processed: %d files in time: %f seconds" \
-                             % (current_process().name, xmrg_file_count, time.time() - processing_start_time))
-    except Exception as e:
-        logger.exception(e)
-    return
+
+def initialize_pool_worker(worker_args):
+    global _pool_file_processor
+    logger = setup_worker_logger(worker_args.get('base_log_output_directory', ''))
+    logger.info(f"{current_process().name} starting pool worker.")
+    _pool_file_processor = xmrg_file_processor(logger, **worker_args)
+
+
+def process_file_chunk(xmrg_files):
+    '''
+    Processes a chunk of files in a process pool worker.
+    :param xmrg_files: List of XMRG file paths.
+    :return: Tuple of (list of xmrg_results, metrics dict of what wasn't shipped with a result).
+    '''
+    processor = _pool_file_processor
+    chunk_results = []
+    for xmrg_filename in xmrg_files:
+        gp_results = processor.process_file(xmrg_filename)
+        if gp_results is not None:
+            gp_results.metrics = processor.take_metrics()
+            chunk_results.append(gp_results)
+    # The pool has no hook for when a worker exits, so the chunk's debug files are finished before returning.
+    processor.flush_debug_files()
+    return chunk_results, processor.take_metrics()
 
 
 class xmrg_processing_geopandas:
@@ -199,11 +132,55 @@ class xmrg_processing_geopandas:
         self._logging_config = None
         self._base_log_output_directory = ""
         self._worker_process_count = 4
+        self._geometry_cache_directory = None
+        self._weighting_mode = 'matrix'
+        self._write_uncompressed_file = False
+        self._input_queue_size = None
+        self._result_queue_size = None
+        self._ledger_file = None
+        self._force_reprocess = False
+        self._ledger = None
+        self._ledger_fingerprint = None
+        self._ledger_pending = {}
+        self._accumulation_windows = None
+        self._accumulation_min_coverage = 1.0
+        self._accumulation_reorder_size = None
+        self._accumulator = None
+        self._save_window_grid = False
+        self._share_boundary_artifacts = True
+        self._metrics = processing_metrics()
+        self._debug_output_format = 'geojson'
+        self._debug_every_nth_hour = None
+        self._debug_dates = None
+        self._debug_queue_size = DEFAULT_DEBUG_QUEUE_SIZE
+        self._execution_backend = 'auto'
+        self._serial_file_limit = DEFAULT_SERIAL_FILE_LIMIT
+        self._pool_file_threshold = DEFAULT_POOL_FILE_THRESHOLD
+        self._pool_chunk_size = None
+
+    @property
+    def metrics(self):
+        '''
+        The processing_metrics of the last import_files, merged from the workers and the dispatcher.
+        :return:
+        '''
+        return self._metrics
 
     def setup(self, **kwargs):
         #Number of Processes to spawn.
         self._worker_process_count = kwargs.get("worker_process_count", 4)
 
+        #How the files are processed, 'serial' in this process, 'pool' in chunks on a process pool, 'queue' one
+        #file at a time on the worker processes, or 'auto' to pick from the number of files in the job.
+        self._execution_backend = kwargs.get("execution_backend", 'auto')
+        if self._execution_backend not in EXECUTION_BACKENDS:
+            raise ValueError(f"Unknown execution backend: {self._execution_backend}")
+        #Job sizes, in files, 'auto' runs serially up to and uses the process pool from.
+        self._serial_file_limit = kwargs.get("serial_file_limit", DEFAULT_SERIAL_FILE_LIMIT)
+        self._pool_file_threshold = kwargs.get("pool_file_threshold", DEFAULT_POOL_FILE_THRESHOLD)
+        #Number of files sent to a pool worker at once, defaults to spreading the job over about 8 chunks per worker.
+        self._pool_chunk_size = kwargs.get("pool_chunk_size", None)
+
         #The overall bounding box to trim the XMRG data to.
         self._min_latitude_longitude = kwargs.get("min_latitude_longitude", None)
         self._max_latitude_longitude = kwargs.get("max_latitude_longitude", None)
@@ -222,89 +199,504 @@ class xmrg_processing_geopandas:
         self._delete_source_file = kwargs.get("delete_source_file", False)
         #Delete the compressed file after processing
         self._delete_compressed_source_file = kwargs.get("delete_compressed_source_file", False)
+        #Gzip files are decompressed into memory, set this to write the uncompressed file next to the source.
+        self._write_uncompressed_file = kwargs.get("write_uncompressed_file", False)
 
         #The directory to output the KML file we use for debugging.
         self._kml_output_directory = kwargs.get("kml_output_directory", None)
 
+        #Debug file output. The format is 'geojson', 'flatgeobuf' or 'geoparquet'. By default each worker writes
+        #the files for the first file it processes, set debug_every_nth_hour or debug_dates to sample others.
+        self._debug_output_format = kwargs.get("debug_output_format", 'geojson')
+        self._debug_every_nth_hour = kwargs.get("debug_every_nth_hour", None)
+        self._debug_dates = kwargs.get("debug_dates", None)
+        self._debug_queue_size = kwargs.get("debug_queue_size", DEFAULT_DEBUG_QUEUE_SIZE)
+
         #Callback function used when we have a result.
         self._callback_function = kwargs.get("callback_function", None)
 
         #Directory where logfiles are written.
         self._base_log_output_directory = kwargs.get("base_log_output_directory", "")
 
+        #Optional directory where the workers can share the grid cell geometry between processes and runs.
+        self._geometry_cache_directory = kwargs.get("geometry_cache_directory", None)
+
+        #How the boundary weighted averages are calculated. 'matrix' uses a weight matrix built once per grid,
+        #'overlay' intersects the boundaries with the grid for every file.
+        self._weighting_mode = kwargs.get("weighting_mode", 'matrix')
+
+        #Maximum number of files and results waiting in the queues. Defaults to 2 files and 4 results per worker.
+        self._input_queue_size = kwargs.get("input_queue_size", None)
+        self._result_queue_size = kwargs.get("result_queue_size", None)
+
+        #Optional SQLite ledger of the processed files. Files already processed with the same boundaries that
+        #haven't changed are skipped unless force_reprocess is set. With accumulation_windows set, the skipped
+        #hours' weighted averages saved in the ledger are used for the rolling totals, files without saved
+        #values are processed again.
+        self._ledger_file = kwargs.get("ledger_file", None)
+        self._force_reprocess = kwargs.get("force_reprocess", False)
+
+        #Prepare the boundaries and weight matrix once in this process and share them with the workers through
+        #shared memory, instead of every worker building its own copy.
+        self._share_boundary_artifacts = kwargs.get("share_boundary_artifacts", True)
+
+        #Send the raw cropped grid back with each result, needed by the precipitation cube saver.
+        self._save_window_grid = kwargs.get("save_window_grid", False)
+
+        #Optional list of window lengths in hours, such as [24, 48, 72]. The rolling rainfall totals for each
+        #boundary are added to the results as weighted_average_{hours}h.
+        self._accumulation_windows = kwargs.get("accumulation_windows", None)
+        #Fraction of the hours in a window that need results for the total to be added.
+        self._accumulation_min_coverage = kwargs.get("accumulation_min_coverage", 1.0)
+        #Number of results held back to put them back in time order, defaults to the files the workers can have
+        #queued or in progress.
+        self._accumulation_reorder_size = kwargs.get("accumulation_reorder_size", None)
+
     def import_files(self, file_list_iterator):
         self.logger.debug("Start import_files")
 
         workers = self._worker_process_count
-        input_queue = Queue()
-        result_queue = Queue()
-        processes = []
+        self._metrics.reset()
+        backend, file_count = self.select_backend(file_list_iterator)
+        self.logger.info(f"Processing {file_count if file_count is not None else 'an unknown number of'} files "
+                         f"with the {backend} backend.")
+
+        if self._ledger_file is not None:
+            self._ledger = processing_ledger(self._ledger_file)
+            self._ledger_fingerprint = boundary_fingerprint(self._boundaries)
+            self._ledger_pending = {}
+
+        if self._accumulation_windows:
+            reorder_size = self._accumulation_reorder_size
+            if reorder_size is None:
+                reorder_size = (self._input_queue_size or workers * 2) + workers
+            self._accumulator = rolling_accumulator([boundary[0] for boundary in self._boundaries],
+                                                    self._accumulation_windows,
+                                                    self._accumulation_min_coverage,
+                                                    reorder_size)
+
+        # The serial backend prepares the boundaries itself, there are no workers to share them with.
+        artifacts = None
+        if backend != 'serial' and self._share_boundary_artifacts:
+            try:
+                artifacts, file_list_iterator = self.publish_boundary_artifacts(file_list_iterator)
+            except Exception as e:
+                self.logger.error("Unable to share the boundary artifacts, each worker will build its own.")
+                self.logger.exception(e)
+
+        try:
+            if backend == 'serial':
+                rec_count = self.run_serial(file_list_iterator)
+            elif backend == 'pool':
+                rec_count = self.run_pool(file_list_iterator, file_count, artifacts)
+            else:
+                rec_count = self.run_queue(file_list_iterator, artifacts)
+            if self._accumulator is not None:
+                for xmrg_results_data in self._accumulator.flush():
+                    try:
+                        self.save_result(xmrg_results_data)
+                    except Exception as e:
+                        self.logger.exception(e)
+        finally:
+            self._accumulator = None
+            if artifacts is not None:
+                artifacts.unlink()
+
+            if self._ledger is not None:
+                # Anything still pending never came back from the workers.
+                for file_info in self._ledger_pending.values():
+                    self._ledger.record(file_info, self._ledger_fingerprint, STATUS_FAILED)
+                self._ledger_pending = {}
+                self._ledger.close()
+                self._ledger = None
+
+        self.logger.info(f"Imported: {rec_count} records")
 
-        #self.logger.info("Importing: %d files." % (len(file_list)))
-        #for file_name in file_list:
-        #    input_queue.put(file_name)
+        self.logger.debug("Finished import_files")
+
+        return
+
+    def select_backend(self, file_list_iterator):
+        '''
+        Picks the execution backend. With 'auto' the job size comes from the iterator's length hint, small jobs
+        run serially, large ones on the process pool and the rest, or any whose size isn't known, on the queue
+        workers.
+        :param file_list_iterator: Iterator of the XMRG files to process.
+        :return: Tuple of (backend, number of files or None if it isn't known).
+        '''
+        file_count = operator.length_hint(file_list_iterator, -1)
+        if file_count < 0:
+            file_count = None
+        backend = self._execution_backend
+        if backend == 'auto':
+            if file_count is None:
+                backend = 'queue'
+            elif file_count <= self._serial_file_limit:
+                backend = 'serial'
+            elif file_count >= self._pool_file_threshold:
+                backend = 'pool'
+            else:
+                backend = 'queue'
+        return backend, file_count
+
+    def worker_args(self, artifacts):
+        '''
+        Builds the arguments for the xmrg_file_processor each worker creates.
+        :param artifacts: The shared boundary artifacts, or None if the workers prepare the boundaries themselves.
+        :return: dict
+        '''
+        args = {
+            'min_lat_lon': self._min_latitude_longitude,
+            'max_lat_lon': self._max_latitude_longitude,
+            'save_all_precip_vals': self._save_all_precip_values,
+            'boundaries': self._boundaries,
+            'delete_source_file': self._delete_source_file,
+            'delete_compressed_source_file': self._delete_compressed_source_file,
+            'write_uncompressed_file': self._write_uncompressed_file,
+            'debug_files_directory': self._kml_output_directory,
+            'base_log_output_directory': self._base_log_output_directory,
+            'geometry_cache_directory': self._geometry_cache_directory,
+            'weighting_mode': self._weighting_mode,
+            'save_window_grid': self._save_window_grid,
+            'debug_output_format': self._debug_output_format,
+            'debug_every_nth_hour': self._debug_every_nth_hour,
+            'debug_dates': self._debug_dates,
+            'debug_queue_size': self._debug_queue_size
+        }
+        if artifacts is not None:
+            args['shared_boundary_artifacts'] = artifacts.descriptor
+            args['boundaries'] = None
+        return args
+
+    def run_serial(self, file_list_iterator):
+        '''
+        Processes the files in this process, there is no process start up or queue traffic so this is the
+        quickest way to run a handful of files.
+        :param file_list_iterator: Iterator of the XMRG files to process.
+        :return: The number of results processed.
+        '''
+        rec_count = 0
+        processor = xmrg_file_processor(self.logger, **self.worker_args(None))
+        try:
+            for xmrg_file in self.prepared_files(file_list_iterator):
+                xmrg_results_data = processor.process_file(xmrg_file)
+                self._metrics.merge(processor.take_metrics())
+                if xmrg_results_data is not None:
+                    try:
+                        self.process_result(xmrg_results_data)
+                    except Exception as e:
+                        self.logger.exception(e)
+                    rec_count += 1
+        finally:
+            processor.close()
+            self._metrics.merge(processor.take_metrics())
+        return rec_count
+
+    def run_pool(self, file_list_iterator, file_count, artifacts):
+        '''
+        Sends the files to a ProcessPoolExecutor in chunks. Each pool worker prepares the boundaries once in
+        its initializer. Up to two chunks per worker are in flight and they are collected in the order they were
+        sent, so the results come back in the order of the iterator.
+        :param file_list_iterator: Iterator of the XMRG files to process.
+        :param file_count: Number of files in the job, or None if it isn't known.
+        :param artifacts: The shared boundary artifacts or None.
+        :return: The number of results processed.
+        '''
+        workers = self._worker_process_count
+        chunk_size = self._pool_chunk_size
+        if chunk_size is None:
+            chunk_size = MAX_POOL_CHUNK_SIZE // 8
+            if file_count is not None:
+                chunk_size = max(1, min(MAX_POOL_CHUNK_SIZE, file_count // (workers * 8)))
+        self.logger.debug(f"Starting a pool of {workers} processes, {chunk_size} files per chunk.")
+
+        rec_count = 0
+        in_flight = deque()
+        prepared_files = self.prepared_files(file_list_iterator)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=initialize_pool_worker,
+                                 initargs=(self.worker_args(artifacts),)) as executor:
+            try:
+                while True:
+                    chunk = list(itertools.islice(prepared_files, chunk_size))
+                    if chunk:
+                        in_flight.append(executor.submit(process_file_chunk, chunk))
+                    while in_flight and (not chunk or len(in_flight) >= workers * 2):
+                        rec_count += self.collect_chunk(in_flight.popleft())
+                    if not chunk:
+                        break
+            except Exception as e:
+                self.logger.error("Process pool failed, stopping the import.")
+                self.logger.exception(e)
+                for future in in_flight:
+                    future.cancel()
+        return rec_count
+
+    def collect_chunk(self, future):
+        '''
+        Waits for a chunk from the process pool and hands its results to process_result.
+        :param future: Future of process_file_chunk.
+        :return: The number of results processed.
+        '''
+        wait_start_time = time.perf_counter()
+        try:
+            chunk_results, chunk_metrics = future.result()
+        except Exception as e:
+            self.logger.error("Process pool chunk failed.")
+            self.logger.exception(e)
+            return 0
+        self._metrics.observe('chunk_wait', time.perf_counter() - wait_start_time)
+        self._metrics.merge(chunk_metrics)
+        for xmrg_results_data in chunk_results:
+            if xmrg_results_data.metrics is not None:
+                self._metrics.merge(xmrg_results_data.metrics)
+            try:
+                self.process_result(xmrg_results_data)
+            except Exception as e:
+                self.logger.exception(e)
+        return len(chunk_results)
+
+    def run_queue(self, file_list_iterator, artifacts):
+        '''
+        Starts the worker processes and streams the files to them one at a time over a bounded queue.
+        :param file_list_iterator: Iterator of the XMRG files to process.
+        :param artifacts: The shared boundary artifacts or None.
+        :return: The number of results processed.
+        '''
+        workers = self._worker_process_count
+        # Both queues are bounded so a fast iterator or slow result callback can't grow memory without limit.
+        input_queue = Queue(maxsize=self._input_queue_size or workers * 2)
+        result_queue = Queue(maxsize=self._result_queue_size or workers * 4)
+        processes = []
 
         # Start up the worker processes.
         for workerNum in range(workers):
-            args = {
-                'input_queue': input_queue,
-                'results_queue': result_queue,
-                'min_lat_lon': self._min_latitude_longitude,
-                'max_lat_lon': self._max_latitude_longitude,
-                'save_all_precip_vals': self._save_all_precip_values,
-                'boundaries': self._boundaries,
-                'delete_source_file': self._delete_source_file,
-                'delete_compressed_source_file': self._delete_compressed_source_file,
-                'debug_files_directory': self._kml_output_directory,
-                'base_log_output_directory': self._base_log_output_directory
-            }
+            args = self.worker_args(artifacts)
+            args['input_queue'] = input_queue
+            args['results_queue'] = result_queue
             p = Process(target=process_xmrg_file_geopandas, kwargs=args)
             if self.logger:
                 self.logger.debug("Starting process: %s" % (p._name))
             p.start()
             processes.append(p)
 
-        rec_count = 0
+        # The files are fed to the workers from their own thread so this thread can block on the results. The
+        # result callback stays on the calling thread since the data savers hold database connections that
+        # can't be shared across threads.
+        feeder = threading.Thread(target=self.feed_files,
+                                  args=(file_list_iterator, input_queue, processes),
+                                  name="xmrg_file_feeder",
+                                  daemon=True)
+        feeder.start()
+
         self.logger.debug("Waiting for %d processes to complete" % (workers))
-        while any([(checkJob is not None and checkJob.is_alive()) for checkJob in processes]):
-            for xmrg_file in file_list_iterator:
+        rec_count = self.drain_results(result_queue, processes)
+
+        feeder.join()
+        for process in processes:
+            process.join()
+        return rec_count
+
+    def publish_boundary_artifacts(self, file_list_iterator):
+        '''
+        Prepares the boundaries once and publishes them in shared memory for the workers. In matrix mode the
+        first file that can be read gives us the grid, so the weight matrix and cell geometry for it are shared
+        too. The files read to find the grid are put back in front of the iterator.
+        :param file_list_iterator: Iterator of the XMRG files to process.
+        :return: Tuple of (shared_artifacts, iterator of the files to process).
+        '''
+        boundary_names = [boundary[0] for boundary in self._boundaries]
+        boundary_wkb, boundary_offsets = pack_geometries([boundary[1] for boundary in self._boundaries])
+        arrays = {'boundary_geometry_wkb': boundary_wkb, 'boundary_geometry_offsets': boundary_offsets}
+        metadata = {'boundary_names': boundary_names}
+
+        file_list_iterator = iter(file_list_iterator)
+        peeked_files = []
+        if self._weighting_mode == 'matrix':
+            min_lat_lon = None
+            max_lat_lon = None
+            if self._min_latitude_longitude is not None and self._max_latitude_longitude is not None:
+                min_lat_lon = LatLong(self._min_latitude_longitude[0], self._min_latitude_longitude[1])
+                max_lat_lon = LatLong(self._max_latitude_longitude[0], self._max_latitude_longitude[1])
+            for xmrg_file in itertools.islice(file_list_iterator, SHARED_ARTIFACT_PEEK_FILES):
+                peeked_files.append(xmrg_file)
+                if xmrg_file is None or not os.path.exists(xmrg_file):
+                    continue
+                gpXmrg = geoXmrg(min_lat_lon, max_lat_lon, 0.01)
                 try:
-                    if xmrg_file is not None:
-                        file_to_process = xmrg_file
-                        #Copy the file to our local working directory
-                        if self._source_file_working_directory is not None:
-                            source_fullfilepath = os.path.join(self._source_file_working_directory, xmrg_file)
-                            shutil.copy2(xmrg_file, source_fullfilepath)
-                            file_to_process = source_fullfilepath
-                        input_queue.put(file_to_process)
-                except StopIteration:
-                    self.logger.info("Finished iterating files.")
-                    input_queue.put('STOP')
+                    gpXmrg.openFile(xmrg_file)
+                    # The cell geometry only depends on the header, the rows don't need to be decoded.
+                    if gpXmrg.readFileHeader():
+                        cell_geometries = gpXmrg.cellGeometries()
+                        weight_matrix = boundary_weight_matrix(boundary_names,
+                                                               [boundary[1] for boundary in self._boundaries],
+                                                               cell_geometries)
+                        arrays.update(weight_matrix.to_arrays())
+                        arrays['cell_rings'] = shapely.get_coordinates(cell_geometries.values).reshape(-1, 5, 2)
+                        metadata['grid_signature'] = gpXmrg.gridSignature()
+                        break
                 except Exception as e:
+                    self.logger.error(f"Unable to read: {xmrg_file} for the shared boundary weight matrix.")
                     self.logger.exception(e)
+                finally:
+                    gpXmrg.cleanUp(False, False)
+
+        artifacts = shared_artifacts.publish(arrays, metadata)
+        self.logger.debug(f"Shared {len(boundary_names)} boundaries, grid: {metadata.get('grid_signature', None)}"
+                          f" in {artifacts.size} bytes of shared memory.")
+        return artifacts, itertools.chain(peeked_files, file_list_iterator)
+
+    def prepared_files(self, file_list_iterator):
+        '''
+        Generator of the files to process. Files the ledger shows are already processed are skipped, and the
+        files are copied to the working directory if one is set.
+        :param file_list_iterator: Iterator of the XMRG files to process.
+        :return:
+        '''
+        skipped_count = 0
+        for xmrg_file in file_list_iterator:
+            file_to_process = None
+            try:
+                if xmrg_file is not None:
+                    if self._ledger is not None:
+                        if not self._force_reprocess and \
+                                self._ledger.is_processed(xmrg_file, self._ledger_fingerprint) and \
+                                self.skip_processed_file(xmrg_file):
+                            self.logger.debug(f"Skipping already processed file: {xmrg_file}")
+                            skipped_count += 1
+                            self._metrics.increment('files_skipped')
+                            continue
+                        # Grab the file info now, the worker may delete the file once it's done with it.
+                        file_info = self._ledger.file_info(xmrg_file)
+                        self._ledger_pending[file_info[0]] = file_info
+                    file_to_process = xmrg_file
+                    #Copy the file to our local working directory
+                    if self._source_file_working_directory is not None:
+                        source_fullfilepath = os.path.join(self._source_file_working_directory,
+                                                           os.path.basename(xmrg_file))
+                        shutil.copy2(xmrg_file, source_fullfilepath)
+                        file_to_process = source_fullfilepath
+            except Exception as e:
+                self.logger.exception(e)
+                continue
+            if file_to_process is not None:
+                yield file_to_process
+        self.logger.info(f"Finished iterating files. Skipped {skipped_count} already processed files.")
+
+    def skip_processed_file(self, xmrg_file):
+        '''
+        Checks a file the ledger shows is processed can be skipped. When rolling totals are being added, the
+        skipped hour's saved weighted averages are added to the accumulator so the windows that include it are
+        still complete. A file the ledger has no saved values for is processed again.
+        :param xmrg_file: Path of the XMRG file.
+        :return: True if the file can be skipped.
+        '''
+        if self._accumulator is None:
+            return True
+        saved_results = self._ledger.saved_results(xmrg_file)
+        if saved_results is None:
+            self.logger.debug(f"No saved weighted averages for: {xmrg_file}, processing it for the rolling totals.")
+            return False
+        self._accumulator.add_hourly(*saved_results)
+        return True
+
+    def feed_files(self, file_list_iterator, input_queue, processes):
+        '''
+        Puts the files from the iterator on the input queue, then one STOP sentinel per worker.
+        :param file_list_iterator: Iterator of the XMRG files to process.
+        :param input_queue: The workers input queue.
+        :param processes: The worker processes.
+        :return:
+        '''
+        try:
+            for file_to_process in self.prepared_files(file_list_iterator):
+                if not self.put_work(input_queue, file_to_process, processes):
+                    return
+        except Exception as e:
+            self.logger.exception(e)
+        finally:
+            for process in processes:
+                if not self.put_work(input_queue, 'STOP', processes):
+                    break
+        return
 
-                if not result_queue.empty():
-                    # finalResults.append(resultQueue.get())
-                    if (rec_count % 10) == 0:
-                        self.logger.debug(f"Processed {rec_count} results")
-                    self.process_result(result_queue.get())
-                    rec_count += 1
-
-        input_queue.put('STOP')
-
-        # Poll the queue once more to get any remaining records.
-        while not result_queue.empty():
-            self.logger.debug("Pulling records from resultsQueue.")
-            self.process_result(result_queue.get())
-            rec_count += 1
-
-        self.logger.info(f"Imported: {rec_count} records")
-
-        self.logger.debug("Finished import_files")
+    def put_work(self, input_queue, work_item, processes):
+        '''
+        Blocking put on the input queue. We wake up periodically only to make sure there is still a worker
+        alive to take the item.
+        :param input_queue: The workers input queue.
+        :param work_item: The file name or STOP sentinel.
+        :param processes: The worker processes.
+        :return: True if the item was queued, False if all the workers have exited.
+        '''
+        put_start_time = time.perf_counter()
+        while True:
+            try:
+                input_queue.put(work_item, timeout=QUEUE_POLL_SECONDS)
+                self._metrics.observe('input_queue_wait', time.perf_counter() - put_start_time)
+                return True
+            except queue.Full:
+                if not any(process.is_alive() for process in processes):
+                    self.logger.error(f"All worker processes have exited, unable to queue: {work_item}")
+                    return False
+
+    def drain_results(self, result_queue, processes):
+        '''
+        Blocks on the result queue and hands each result to process_result until every worker has sent its
+        finished sentinel.
+        :param result_queue: The workers result queue.
+        :param processes: The worker processes.
+        :return: The number of results processed.
+        '''
+        rec_count = 0
+        finished_workers = 0
+        wait_start_time = time.perf_counter()
+        while finished_workers < len(processes):
+            try:
+                result = result_queue.get(timeout=QUEUE_POLL_SECONDS)
+            except queue.Empty:
+                # A worker that was killed never sends its sentinel, so stop once none are left running.
+                if not any(process.is_alive() for process in processes):
+                    self.logger.error("Worker processes exited without finishing.")
+                    break
+                continue
+            self._metrics.observe('result_queue_wait', time.perf_counter() - wait_start_time)
+            if isinstance(result, str) and result == WORKER_FINISHED:
+                finished_workers += 1
+            elif isinstance(result, tuple) and result[0] == WORKER_METRICS:
+                self._metrics.merge(result[1])
+            else:
+                if result.metrics is not None:
+                    self._metrics.merge(result.metrics)
+                try:
+                    self.process_result(result)
+                except Exception as e:
+                    self.logger.exception(e)
+                rec_count += 1
+                if (rec_count % 10) == 0:
+                    self.logger.debug(f"Processed {rec_count} results")
+            wait_start_time = time.perf_counter()
+        return rec_count
 
+    def process_result(self, xmrg_results_data):
+        if self._accumulator is not None:
+            # The results come back once the rolling totals can be added, in time order.
+            for released_results in self._accumulator.add(xmrg_results_data):
+                self.save_result(released_results)
+        else:
+            self.save_result(xmrg_results_data)
         return
 
-    def process_result(self, xmrg_results_data):
+    def save_result(self, xmrg_results_data):
         if self._callback_function is not None:
-            self._callback_function(xmrg_results_data)
+            with self._metrics.time_stage(STAGE_SAVE):
+                self._callback_function(xmrg_results_data)
+            self._metrics.increment('results_saved')
+        if self._ledger is not None:
+            file_info = self._ledger_pending.pop(xmrg_results_data.source_file, None)
+            if file_info is not None:
+                weighted_averages = {boundary_name: boundary_results.get('weighted_average', None)
+                                     for boundary_name, boundary_results in xmrg_results_data.get_boundary_data()}
+                self._ledger.record(file_info, self._ledger_fingerprint, STATUS_PROCESSED,
+                                    xmrg_results_data.datetime, weighted_averages)
         return
\ No newline at end of file
@@ -1,8 +1,71 @@
+import numpy as np
+from shapely.ops import unary_union
+
+from .geoXmrg import geoXmrg
+from .sparse_grid import sparse_grid
+
+
 class xmrg_results:
+    '''
+    The results for one XMRG file. This is what the workers send back through the result queue, so the grid
+    cells for each boundary are kept as compact arrays: the cell indexes into the cropped grid window, the
+    precipitation values and the boundary weights. The cell polygons are only rebuilt from the grid window
+    if a consumer asks for them with get_boundary_grid.
+    '''
+    __slots__ = ('_datetime', '_source_file', '_boundary_results', '_boundary_grids', '_boundary_cells',
+                 '_boundary_centroids', '_grid_window', '_window_grid', '_metrics', '_no_rain')
+
     def __init__(self):
         self._datetime = None
+        # Name of the XMRG file the results came from.
+        self._source_file = None
         self._boundary_results = {}
+        # Per boundary list of (polygon, value) tuples added with add_grid.
         self._boundary_grids = {}
+        # Per boundary tuple of (cell indexes, values, weights) arrays.
+        self._boundary_cells = {}
+        # Per boundary (longitude, latitude) of the center of the cells covering the boundary.
+        self._boundary_centroids = {}
+        # (XOR, YOR, start_row, start_col, column count) of the grid window the cell indexes refer to.
+        self._grid_window = None
+        # Optional sparse_grid of the raw values in the grid window, only the nonzero cells are sent back.
+        self._window_grid = None
+        # processing_metrics dict of the worker stage timings and counters since its previous result.
+        self._metrics = None
+        # True if the file had no rain in the window, so the results were set to 0 without decoding the grid.
+        self._no_rain = False
+
+    @property
+    def datetime(self):
+        return self._datetime
+
+    @datetime.setter
+    def datetime(self, datetime):
+        self._datetime = datetime
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self._metrics = metrics
+
+    @property
+    def no_rain(self):
+        return self._no_rain
+
+    @no_rain.setter
+    def no_rain(self, no_rain):
+        self._no_rain = no_rain
+
+    @property
+    def source_file(self):
+        return self._source_file
+
+    @source_file.setter
+    def source_file(self, source_file):
+        self._source_file = source_file
 
     def add_boundary_result(self, name, result_type, result_value):
         if name not in self._boundary_results:
@@ -22,10 +85,109 @@ class xmrg_results:
         grid_data = self._boundary_grids[boundary_name]
         grid_data.append(grid_tuple)
 
+    def set_grid_window(self, xor, yor, start_row, start_col, column_count):
+        '''
+        Sets the grid window the boundary cell indexes refer to.
+        :param xor: HRAP X origin of the grid.
+        :param yor: HRAP Y origin of the grid.
+        :param start_row: First row of the window relative to the grid origin.
+        :param start_col: First column of the window relative to the grid origin.
+        :param column_count: Number of columns in the window.
+        :return:
+        '''
+        self._grid_window = (xor, yor, start_row, start_col, column_count)
+
+    @property
+    def grid_window(self):
+        return self._grid_window
+
+    @property
+    def window_grid(self):
+        '''
+        The raw int16 (rows, columns) values of the grid window or None.
+        '''
+        if self._window_grid is None:
+            return None
+        return self._window_grid.to_dense()
+
+    @property
+    def sparse_window_grid(self):
+        return self._window_grid
+
+    def set_window_grid(self, window_grid):
+        '''
+        Sets the raw int16 values of the grid window, used by the savers that keep the whole grid. Only the
+        nonzero cells are kept.
+        :param window_grid: (rows, columns) array or a sparse_grid.
+        :return:
+        '''
+        if not isinstance(window_grid, sparse_grid):
+            window_grid = sparse_grid.from_dense(np.asarray(window_grid, dtype=np.int16))
+        self._window_grid = window_grid
+
+    def set_boundary_cells(self, boundary_name, cell_indexes, values, weights):
+        '''
+        Sets the grid cells that cover the boundary.
+        :param boundary_name: Name of the boundary.
+        :param cell_indexes: Array of the cell indexes into the grid window, row by row west to east.
+        :param values: Array of the precipitation values for the cells.
+        :param weights: Array of the fraction of the boundary area each cell covers.
+        :return:
+        '''
+        self._boundary_cells[boundary_name] = (np.asarray(cell_indexes, dtype=np.int32),
+                                               np.asarray(values, dtype=np.float32),
+                                               np.asarray(weights, dtype=np.float32))
+
+    def get_boundary_cells(self, boundary_name):
+        '''
+        Returns the (cell indexes, values, weights) arrays for the boundary or None.
+        :param boundary_name: Name of the boundary.
+        :return:
+        '''
+        return self._boundary_cells.get(boundary_name, None)
+
+    def set_boundary_centroid(self, boundary_name, centroid):
+        '''
+        :param boundary_name: Name of the boundary.
+        :param centroid: Tuple of (longitude, latitude).
+        :return:
+        '''
+        self._boundary_centroids[boundary_name] = centroid
+
+    def get_boundary_centroid(self, boundary_name):
+        '''
+        Returns the (longitude, latitude) center of the grid cells that cover the boundary. If the worker did not
+        precompute it, it is calculated from the boundary grid polygons.
+        :param boundary_name: Name of the boundary.
+        :return:
+        '''
+        centroid = self._boundary_centroids.get(boundary_name, None)
+        if centroid is None:
+            boundary_grid_data = self.get_boundary_grid(boundary_name)
+            if boundary_grid_data:
+                combined_polygons = unary_union([x[0] for x in boundary_grid_data])
+                centroid = (combined_polygons.centroid.x, combined_polygons.centroid.y)
+                self._boundary_centroids[boundary_name] = centroid
+        return centroid
+
     def get_boundary_grid(self, boundary_name):
+        '''
+        Returns a list of (polygon, value) tuples for the cells covering the boundary. When the cells were set
+        as arrays, the polygons are rebuilt from the grid window, these are the full grid cells rather than the
+        part of the cell inside the boundary.
+        :param boundary_name: Name of the boundary.
+        :return:
+        '''
         grid_data = None
         if boundary_name in self._boundary_grids:
             grid_data = self._boundary_grids[boundary_name]
+        elif boundary_name in self._boundary_cells and self._grid_window is not None:
+            xor, yor, start_row, start_col, column_count = self._grid_window
+            cell_indexes, values, weights = self._boundary_cells[boundary_name]
+            columns = xor + start_col + (cell_indexes % column_count)
+            rows = yor + start_row + (cell_indexes // column_count)
+            polygons = geoXmrg(None, None).hrapCellPolygons(columns, rows)
+            grid_data = list(zip(polygons, values.tolist()))
         return grid_data
 
     def get_boundary_data(self):
@@ -33,4 +195,4 @@ class xmrg_results:
             yield (boundary_name, boundary_data)
 
     def get_boundary_names(self):
-        return self._boundary_grids.keys()
+        return self._boundary_grids.keys() | self._boundary_cells.keys() | self._boundary_results.keys()
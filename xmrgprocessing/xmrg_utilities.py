@@ -3,10 +3,21 @@ import re
 from datetime import datetime, timedelta
 import time
 import logging.config
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger()
 
+# Number of files downloaded in parallel.
+DEFAULT_DOWNLOAD_WORKERS = 4
+# Seconds to wait to connect and between bytes received.
+DEFAULT_DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 def get_collection_date_from_filename(fileName):
     # Parse the filename to get the data time.
     (directory, filetime) = os.path.split(fileName)
@@ -73,33 +84,125 @@ def build_filename(date_time, xmrg_file_ext):
         raise e
 
 
-def http_download_file(download_url: str, file_name: str, destination_directory: str):
+def create_download_session(pool_size=DEFAULT_DOWNLOAD_WORKERS, retries=3, backoff_factor=0.5):
+    """
+    Function: create_download_session
+    Purpose: Builds a requests Session with a connection pool sized for the parallel downloads and
+     retries with exponential backoff for connection errors and transient server errors.
+    Parameters:
+      pool_size: Number of connections to keep open to the server.
+      retries: Number of times to retry a request.
+      backoff_factor: Backoff factor between retries, the sleep is backoff_factor * 2^(retry - 1) seconds.
+    Return:
+      A requests.Session.
+    """
+    retry = Retry(total=retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET", "HEAD"),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def http_download_file(download_url: str, file_name: str, destination_directory: str,
+                       session: requests.Session = None, timeout: float = DEFAULT_DOWNLOAD_TIMEOUT,
+                       skip_existing: bool = False):
+    """
+    Function: http_download_file
+    Purpose: Downloads a file to the destination directory. The file is written to a temporary file and renamed
+     once it is complete so a failed download never leaves a partial file behind.
+    Parameters:
+      download_url: The base URL the file is under.
+      file_name: Name of the file to download.
+      destination_directory: Directory to save the file to.
+      session: Optional requests Session to reuse connections, see create_download_session.
+      timeout: Seconds to wait to connect and between bytes received.
+      skip_existing: If True and the file already exists, it isn't downloaded again. Otherwise an existing file
+       is only downloaded again if the server copy is newer.
+    Return:
+      The full path to the file or None if it couldn't be downloaded.
+    """
     start_time = time.time()
-    remote_filename_url = os.path.join(download_url, file_name)
+    remote_filename_url = f"{download_url.rstrip('/')}/{file_name}"
+    dest_file = os.path.join(destination_directory, file_name)
+    headers = {}
+    if os.path.exists(dest_file) and os.path.getsize(dest_file) > 0:
+        if skip_existing:
+            logger.info(f"File: {dest_file} exists, skipping download.")
+            return dest_file
+        headers['If-Modified-Since'] = formatdate(os.path.getmtime(dest_file), usegmt=True)
+
     logger.info("Downloading file: %s" % (remote_filename_url))
+    http_session = session if session is not None else requests
     try:
-        r = requests.get(remote_filename_url, stream=True)
+        r = http_session.get(remote_filename_url, stream=True, timeout=timeout, headers=headers)
     except (requests.HTTPError, requests.ConnectionError, Exception) as e:
         logger.exception(e)
     else:
-        if r.status_code == 200:
-            dest_file = os.path.join(destination_directory, file_name)
-            logger.info(f"Saving to file: {dest_file}")
-            try:
-                with open(dest_file, 'wb') as xmrg_file:
-                    for chunk in r:
-                        xmrg_file.write(chunk)
-                    logger.info(f"Downloaded file: {dest_file} in {time.time() - start_time} seconds.")
-            except IOError as e:
-                if logger:
-                    logger.exception(e)
-            return dest_file
-        else:
-            logger.error(f"Unable to download file: {remote_filename_url}")
+        with r:
+            if r.status_code == 304:
+                logger.info(f"File: {dest_file} is up to date.")
+                return dest_file
+            if r.status_code == 200:
+                logger.info(f"Saving to file: {dest_file}")
+                temp_file = f"{dest_file}.{os.getpid()}.{threading.get_ident()}.part"
+                try:
+                    with open(temp_file, 'wb') as xmrg_file:
+                        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            xmrg_file.write(chunk)
+                    os.replace(temp_file, dest_file)
+                except (IOError, requests.RequestException) as e:
+                    if logger:
+                        logger.exception(e)
+                    if os.path.exists(temp_file):
+                        os.remove(temp_file)
+                    return None
+                # Keep the server's modified time so the next request can be conditional. The file is already
+                # in place, so a bad Last-Modified header only costs us the conditional request.
+                last_modified = r.headers.get('Last-Modified', None)
+                if last_modified is not None:
+                    try:
+                        modified_time = parsedate_to_datetime(last_modified).timestamp()
+                        os.utime(dest_file, (modified_time, modified_time))
+                    except (TypeError, ValueError, OSError) as e:
+                        logger.error(f"Unable to set the modified time of: {dest_file} from Last-Modified: "
+                                     f"{last_modified}: {e}")
+                logger.info(f"Downloaded file: {dest_file} in {time.time() - start_time} seconds.")
+                return dest_file
+            else:
+                logger.error(f"Unable to download file: {remote_filename_url} status: {r.status_code}")
     return None
 
-def download_files(file_list: str, destination_directory: str, download_url: str):
-    downloaded_files = []
-    for file_name in file_list:
-        downloaded_files.append(http_download_file(download_url, file_name, destination_directory))
-    return downloaded_files
\ No newline at end of file
+def download_files(file_list: list, destination_directory: str, download_url: str,
+                   max_workers: int = DEFAULT_DOWNLOAD_WORKERS, session: requests.Session = None,
+                   timeout: float = DEFAULT_DOWNLOAD_TIMEOUT, skip_existing: bool = False):
+    """
+    Function: download_files
+    Purpose: Downloads the files in parallel using a pooled session.
+    Parameters:
+      file_list: The names of the files to download.
+      destination_directory: Directory to save the files to.
+      download_url: The base URL the files are under.
+      max_workers: Number of files to download at the same time.
+      session: Optional requests Session, one is created with create_download_session if not given.
+      timeout: Seconds to wait to connect and between bytes received.
+      skip_existing: If True, files that already exist aren't downloaded again.
+    Return:
+      A list of the downloaded file paths in the same order as file_list, None for files that failed.
+    """
+    http_session = session if session is not None else create_download_session(pool_size=max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="xmrg_download") as executor:
+            downloaded_files = list(executor.map(
+                lambda file_name: http_download_file(download_url, file_name, destination_directory,
+                                                     session=http_session, timeout=timeout,
+                                                     skip_existing=skip_existing),
+                file_list))
+    finally:
+        if session is None:
+            http_session.close()
+    return downloaded_files
@@ -5,12 +5,39 @@ from xeniadbutilities.xeniaSQLiteAlchemy import xeniaAlchemy, multi_obs, platfor
 from datetime import datetime
 import sqlite3
 from sqlalchemy import select, update, exc
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import time
-from shapely.ops import unary_union
+
+
+# Rows per INSERT statement when flushing a batch, keeps us under SQLite's bound parameter limit.
+INSERT_CHUNK_SIZE = 500
+# Columns of the multi_obs unique constraint, the batched upsert only updates rows that conflict on these.
+MULTI_OBS_KEY_COLUMNS = ('platform_handle', 'm_date', 'm_type_id', 'sensor_id')
+
+
+def observation_key(platform_handle, m_date, m_type_id, sensor_id):
+    '''
+    Builds the key used to match buffered rows to rows in the database. The date may come back from the database
+    as a datetime or a string in a different format than it was passed in, so it is compared as an ISO string.
+    :return: Tuple of (platform_handle, ISO date string, m_type_id, sensor_id).
+    '''
+    if not isinstance(m_date, datetime):
+        m_date = datetime.fromisoformat(str(m_date))
+    return (platform_handle, m_date.replace(tzinfo=None).isoformat(timespec='seconds'), int(m_type_id), int(sensor_id))
+
 
 
 class nexrad_xenia_sqlite_saver(precipitation_saver):
-    def __init__(self, sqlite_file):
+    def __init__(self, sqlite_file, batch_size=None, boundaries=None):
+        '''
+
+        :param sqlite_file: The xenia SQLite database file.
+        :param batch_size: If set, the multi_obs rows are buffered and written with a multi-row
+          INSERT ... ON CONFLICT DO UPDATE in one transaction every batch_size rows and at finalize(), instead of
+          a commit per row.
+        :param boundaries: Optional list of (name, polygon) tuples of the boundaries being processed. A new
+          platform is placed at its boundary's centroid if the results don't carry one.
+        '''
         self._xenia_db = xeniaAlchemy()
         self._xenia_db.connect_sqlite_db(sqlite_file, False)
         self._check_exists = True
@@ -21,6 +48,14 @@ class nexrad_xenia_sqlite_saver(precipitation_saver):
         self._logger = logging.getLogger()
         self._new_records_added = 0
         self._records_updated = 0
+        self._batch_size = batch_size
+        # Pending rows keyed by (platform_handle, m_date, m_type_id, sensor_id), a later value for the same key
+        # replaces the earlier one.
+        self._pending_obs = {}
+        self._boundary_centroids = {}
+        if boundaries:
+            self._boundary_centroids = {name: (geometry.centroid.x, geometry.centroid.y)
+                                        for name, geometry in boundaries}
     @property
     def new_records_added(self):
         return self._new_records_added
@@ -38,17 +73,20 @@ class nexrad_xenia_sqlite_saver(precipitation_saver):
             self._logger.info(f"Adding platform. Org: {org_id} Platform Handle: {platform_handle} "
                                f"Short_Name: {platform_name}")
             # Figure out the center of the boundaries, we'll then use that for the latitude and longitude
-            # of the platform.
-            boundary_grid_data = xmrg_results_data.get_boundary_grid(platform_name)
-            poly_list = [x[0] for x in boundary_grid_data]
-            combined_polygons = unary_union(poly_list)
-            centroid = combined_polygons.centroid
+            # of the platform. The workers precompute it, so the grid polygons aren't needed.
+            centroid = xmrg_results_data.get_boundary_centroid(platform_name)
+            if centroid is None:
+                centroid = self._boundary_centroids.get(platform_name, None)
+            if centroid is None:
+                self._logger.error(f"No centroid for platform: {platform_handle}, not adding it.")
+                return False
+            centroid_longitude, centroid_latitude = centroid
             platform_rec = platform(
                 row_entry_date=self.row_entry_date,
                 platform_handle=platform_handle,
                 short_name=platform_name,
-                fixed_latitude=centroid.y,
-                fixed_longitude=centroid.x,
+                fixed_latitude=centroid_latitude,
+                fixed_longitude=centroid_longitude,
                 organization_id=org_id
             )
             try:
@@ -65,10 +103,11 @@ class nexrad_xenia_sqlite_saver(precipitation_saver):
                                         0,
                                         1, None, True)
 
-        return
+        return True
 
     def save(self, xmrg_results_data):
         try:
+            platforms_checked = True
             for boundary_name, boundary_results in xmrg_results_data.get_boundary_data():
                 '''
                 if self.writePrecipToKML and xmrg_results_data.get_boundary_grid(boundary_name) is not None:
@@ -80,7 +119,10 @@ class nexrad_xenia_sqlite_saver(precipitation_saver):
                 platform_handle = "nws.%s.radarcoverage" % (boundary_name)
                 self._logger.info(f"Saving platform: {platform_handle} {xmrg_results_data.datetime}")
                 if self._check_exists:
-                    self.check_exists(platform_handle, xmrg_results_data)
+                    # If the platform couldn't be added its values can't be saved, it is tried again next time.
+                    if not self.check_exists(platform_handle, xmrg_results_data):
+                        platforms_checked = False
+                        continue
                 lat = 0.0
                 lon = 0.0
 
@@ -112,40 +154,43 @@ class nexrad_xenia_sqlite_saver(precipitation_saver):
                             # Add the avg into the multi obs table. Since we are going to deal with the hourly data for the radar and use
                             # weighted averages, instead of keeping lots of radar data in the radar table, we calc the avg and
                             # store it as an obs in the multi-obs table.
-                            add_obs_start_time = time.time()
-                            db_rec = multi_obs(
-                                row_entry_date=self.row_entry_date,
-                                platform_handle=platform_handle,
-                                sensor_id=self.sensor_ids[platform_handle]['sensor_id'],
-                                m_type_id=self.sensor_ids[platform_handle]['m_type_id'],
-                                m_date=xmrg_results_data.datetime,
-                                m_lon=self.sensor_ids[platform_handle]['latitude'],
-                                m_lat=self.sensor_ids[platform_handle]['longitude'],
-                                m_value=avg
-                            )
-                            try:
-                                self._xenia_db.session.add(db_rec)
-                                self._xenia_db.session.commit()
-                                self._new_records_added += 1
-                            # Trying to add record that already exists.
-                            except exc.IntegrityError as e:
-                                self._xenia_db.session.rollback()
-                                self._logger.error("Record already exists, updating.")
+                            if self._batch_size:
+                                self.add_pending_obs(platform_handle, xmrg_results_data.datetime, avg)
+                            else:
+                                add_obs_start_time = time.time()
+                                db_rec = multi_obs(
+                                    row_entry_date=self.row_entry_date,
+                                    platform_handle=platform_handle,
+                                    sensor_id=self.sensor_ids[platform_handle]['sensor_id'],
+                                    m_type_id=self.sensor_ids[platform_handle]['m_type_id'],
+                                    m_date=xmrg_results_data.datetime,
+                                    m_lon=self.sensor_ids[platform_handle]['latitude'],
+                                    m_lat=self.sensor_ids[platform_handle]['longitude'],
+                                    m_value=avg
+                                )
                                 try:
-                                    self._xenia_db.session.query(multi_obs)\
-                                        .filter(multi_obs.platform_handle == platform_handle) \
-                                        .filter(multi_obs.m_date == xmrg_results_data.datetime) \
-                                        .filter(multi_obs.m_type_id == self.sensor_ids[platform_handle]['m_type_id']) \
-                                        .filter(multi_obs.sensor_id == self.sensor_ids[platform_handle]['sensor_id']) \
-                                        .update({"m_value": avg})
+                                    self._xenia_db.session.add(db_rec)
                                     self._xenia_db.session.commit()
-                                    self._records_updated += 1
-                                except Exception as e:
-                                    self._logger.exception(e)
-                                else:
-                                    self._logger.debug(
-                                        f"Platform: {platform_handle} Date: {xmrg_results_data.datetime} updated "
-                                        f"weighted avg: {avg} in {time.time() - add_obs_start_time} seconds.")
+                                    self._new_records_added += 1
+                                # Trying to add record that already exists.
+                                except exc.IntegrityError as e:
+                                    self._xenia_db.session.rollback()
+                                    self._logger.error("Record already exists, updating.")
+                                    try:
+                                        self._xenia_db.session.query(multi_obs)\
+                                            .filter(multi_obs.platform_handle == platform_handle) \
+                                            .filter(multi_obs.m_date == xmrg_results_data.datetime) \
+                                            .filter(multi_obs.m_type_id == self.sensor_ids[platform_handle]['m_type_id']) \
+                                            .filter(multi_obs.sensor_id == self.sensor_ids[platform_handle]['sensor_id']) \
+                                            .update({"m_value": avg})
+                                        self._xenia_db.session.commit()
+                                        self._records_updated += 1
+                                    except Exception as e:
+                                        self._logger.exception(e)
+                                    else:
+                                        self._logger.debug(
+                                            f"Platform: {platform_handle} Date: {xmrg_results_data.datetime} updated "
+                                            f"weighted avg: {avg} in {time.time() - add_obs_start_time} seconds.")
 
                         else:
                             self._logger.debug(
@@ -159,9 +204,74 @@ class nexrad_xenia_sqlite_saver(precipitation_saver):
                     self._logger.error(f"Platform: {platform_handle} Date: {xmrg_results_data.datetime} "
                                        f"Weighted AVG error")
 
-            self._check_exists = False
+            if platforms_checked:
+                self._check_exists = False
         except Exception as e:
             self._logger.exception(e)
         return
+    def add_pending_obs(self, platform_handle, m_date, avg):
+        '''
+        Buffers a multi_obs row for the next batch flush.
+        :param platform_handle: The platform the observation is for.
+        :param m_date: The observation date.
+        :param avg: The weighted average value.
+        :return:
+        '''
+        sensor_info = self.sensor_ids[platform_handle]
+        key = observation_key(platform_handle, m_date, sensor_info['m_type_id'], sensor_info['sensor_id'])
+        self._pending_obs[key] = {
+            'row_entry_date': self.row_entry_date,
+            'platform_handle': platform_handle,
+            'sensor_id': sensor_info['sensor_id'],
+            'm_type_id': sensor_info['m_type_id'],
+            'm_date': m_date,
+            'm_lon': sensor_info['latitude'],
+            'm_lat': sensor_info['longitude'],
+            'm_value': avg
+        }
+        if len(self._pending_obs) >= self._batch_size:
+            self.flush()
+        return
+
+    def flush(self):
+        '''
+        Writes the buffered multi_obs rows with multi-row INSERT ... ON CONFLICT DO UPDATE statements in a single
+        transaction. Rows that already exist are looked up first so the new and updated counters stay accurate.
+        :return:
+        '''
+        if not self._pending_obs:
+            return
+        flush_start_time = time.time()
+        pending_obs = self._pending_obs
+        self._pending_obs = {}
+        session = self._xenia_db.session
+        try:
+            existing_query = select(multi_obs.platform_handle, multi_obs.m_date,
+                                    multi_obs.m_type_id, multi_obs.sensor_id) \
+                .where(multi_obs.sensor_id.in_({row['sensor_id'] for row in pending_obs.values()})) \
+                .where(multi_obs.m_date.in_({row['m_date'] for row in pending_obs.values()}))
+            # The pending keys are already normalised, the dates from the database may not be.
+            existing_keys = set(observation_key(*row) for row in session.execute(existing_query))
+            updated_count = len(existing_keys & pending_obs.keys())
+
+            rows = list(pending_obs.values())
+            for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+                insert_stmt = sqlite_insert(multi_obs).values(rows[start:start + INSERT_CHUNK_SIZE])
+                insert_stmt = insert_stmt.on_conflict_do_update(index_elements=list(MULTI_OBS_KEY_COLUMNS),
+                                                                set_={'m_value': insert_stmt.excluded.m_value})
+                session.execute(insert_stmt)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            self._logger.error(f"Failed to save batch of {len(pending_obs)} records.")
+            self._logger.exception(e)
+        else:
+            self._new_records_added += len(pending_obs) - updated_count
+            self._records_updated += updated_count
+            self._logger.debug(f"Saved batch of {len(pending_obs)} records, {updated_count} updated, "
+                               f"in {time.time() - flush_start_time} seconds.")
+        return
+
     def finalize(self):
+        self.flush()
         self._xenia_db.disconnect()
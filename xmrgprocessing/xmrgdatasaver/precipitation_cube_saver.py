@@ -0,0 +1,63 @@
+import logging
+from datetime import datetime
+
+from .nexrad_data_saver import precipitation_saver
+from ..precipitation_cube import precipitation_cube, DEFAULT_CHUNK_HOURS
+
+
+class precipitation_cube_saver(precipitation_saver):
+    '''
+    Writes the cropped grid from each result into a precipitation_cube so later jobs can slice the grids without
+    decoding the XMRG archive again. The results must carry the grid, set save_window_grid when setting up the
+    processing. Another saver can be given so the boundary results are still saved in the same pass.
+    '''
+    def __init__(self, cube_directory, chunk_hours=DEFAULT_CHUNK_HOURS, data_multiplier=0.01, data_saver=None):
+        '''
+
+        :param cube_directory: Directory of the cube, an existing cube is appended to.
+        :param chunk_hours: Number of hours per chunk file when the cube is created.
+        :param data_multiplier: Multiplier that converts the int16 values to millimeters, stored in the metadata.
+        :param data_saver: Optional precipitation_saver the results are also passed to.
+        '''
+        self._logger = logging.getLogger()
+        self._cube = precipitation_cube(cube_directory, chunk_hours)
+        self._data_multiplier = data_multiplier
+        self._data_saver = data_saver
+        self._new_records_added = 0
+        self._records_updated = 0
+
+    @property
+    def new_records_added(self):
+        if self._data_saver is not None:
+            return self._data_saver.new_records_added
+        return self._new_records_added
+
+    @property
+    def records_updated(self):
+        if self._data_saver is not None:
+            return self._data_saver.records_updated
+        return self._records_updated
+
+    def save(self, xmrg_results_data):
+        try:
+            window_grid = xmrg_results_data.window_grid
+            if window_grid is None:
+                self._logger.error(f"Results for: {xmrg_results_data.datetime} have no grid, set save_window_grid "
+                                   f"to write the precipitation cube.")
+            else:
+                xor, yor, start_row, start_col, column_count = xmrg_results_data.grid_window
+                if self._cube.write(datetime.strptime(xmrg_results_data.datetime, "%Y-%m-%dT%H:%M:%S"),
+                                    window_grid,
+                                    (xor, yor, start_row, start_col, window_grid.shape[0], window_grid.shape[1]),
+                                    self._data_multiplier):
+                    self._new_records_added += 1
+        except Exception as e:
+            self._logger.exception(e)
+        if self._data_saver is not None:
+            self._data_saver.save(xmrg_results_data)
+        return
+
+    def finalize(self):
+        self._cube.close()
+        if self._data_saver is not None:
+            self._data_saver.finalize()
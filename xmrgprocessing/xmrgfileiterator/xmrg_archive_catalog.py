@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import bisect
+import logging.config
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from ..xmrg_utilities import get_collection_date_from_filename
+
+# Hourly files: xmrgMMDDYYYYHHz, legacy hourly files: xmrg_MMDDYYYY_HHz_SE (SE is the region) and
+# 24 hour files: 24hrxmrgMMDDYYYY. Each can be gzipped or uncompressed.
+HOURLY_FILE_PATTERN = re.compile(r"^xmrg\d{10}z(\.gz)?$")
+LEGACY_HOURLY_FILE_PATTERN = re.compile(r"^xmrg_\d{8}_\d{1,2}z_[A-Za-z]+(\.gz)?$")
+DAILY_FILE_PATTERN = re.compile(r"^24hrxmrg\d{8}z?(\.gz)?$")
+
+HOURLY_FILE = 'hourly'
+DAILY_FILE = '24hr'
+
+DEFAULT_CATALOG_WORKERS = 8
+CATALOG_VERSION = 1
+
+
+def xmrg_file_type(file_name):
+    '''
+    Returns HOURLY_FILE or DAILY_FILE if the name is one of the XMRG file names we recognise, otherwise None.
+    :param file_name:
+    :return:
+    '''
+    if HOURLY_FILE_PATTERN.match(file_name) or LEGACY_HOURLY_FILE_PATTERN.match(file_name):
+        return HOURLY_FILE
+    if DAILY_FILE_PATTERN.match(file_name):
+        return DAILY_FILE
+    return None
+
+
+class xmrg_archive_catalog:
+    '''
+    Index of the XMRG files in an archive directory tree. The tree is scanned once, in parallel across the
+    directories, and the index is cached to a JSON file. On later scans a directory is only listed again if its
+    modification time changed, which is the case whenever a file is added or removed, so updating the index for
+    a large archive only costs a stat per directory.
+    '''
+    def __init__(self, archive_path, index_file=None, max_workers=DEFAULT_CATALOG_WORKERS):
+        '''
+
+        :param archive_path: Root of the archive, either the {base}/{year}/{month} tree or a flat directory.
+        :param index_file: Optional path of the JSON file the index is cached in between runs.
+        :param max_workers: Number of threads listing directories.
+        '''
+        self._logger = logging.getLogger('xmrg_archive_catalog')
+        self._archive_path = archive_path
+        self._index_file = index_file
+        self._max_workers = max_workers
+        # Per directory {'mtime': float, 'directories': [names], 'files': {file name: [file type, date]}}
+        self._directories = {}
+        # Sorted (date, file type, path) tuples built from the directories.
+        self._entries = []
+        self._entry_dates = []
+
+        self.load_index()
+
+    @property
+    def file_count(self):
+        return len(self._entries)
+
+    def load_index(self):
+        if self._index_file is not None and os.path.exists(self._index_file):
+            try:
+                with open(self._index_file, 'r') as index_file:
+                    index = json.load(index_file)
+                if index.get('version') == CATALOG_VERSION and index.get('archive_path') == self._archive_path:
+                    self._directories = index['directories']
+            except Exception as e:
+                self._logger.error(f"Unable to load catalog index: {self._index_file}, rescanning the archive.")
+                self._logger.exception(e)
+                self._directories = {}
+
+    def save_index(self):
+        if self._index_file is not None:
+            # Write to a temporary file and rename it so an interrupted run doesn't leave a partial index.
+            temp_filename = f"{self._index_file}.{os.getpid()}.tmp"
+            with open(temp_filename, 'w') as index_file:
+                json.dump({'version': CATALOG_VERSION,
+                           'archive_path': self._archive_path,
+                           'directories': self._directories}, index_file)
+            os.replace(temp_filename, self._index_file)
+
+    def scan_directory(self, directory, cached_entry):
+        '''
+        Lists a directory if it changed since the cached entry was made.
+        :param directory: Path of the directory.
+        :param cached_entry: The entry from the previous scan or None.
+        :return: Tuple of (directory entry, True if the directory was listed).
+        '''
+        mtime = os.stat(directory).st_mtime
+        if cached_entry is not None and cached_entry['mtime'] == mtime:
+            return cached_entry, False
+        sub_directories = []
+        files = {}
+        with os.scandir(directory) as directory_entries:
+            for directory_entry in directory_entries:
+                if directory_entry.is_dir():
+                    sub_directories.append(directory_entry.name)
+                else:
+                    file_type = xmrg_file_type(directory_entry.name)
+                    if file_type is not None:
+                        try:
+                            files[directory_entry.name] = [file_type,
+                                                           get_collection_date_from_filename(directory_entry.name)]
+                        except ValueError:
+                            self._logger.error(f"Unable to get the date from file: {directory_entry.path}")
+        return {'mtime': mtime, 'directories': sorted(sub_directories), 'files': files}, True
+
+    def scan(self):
+        '''
+        Brings the index up to date with the archive, then saves it if an index file was given.
+        :return:
+        '''
+        directories = {}
+        listed_count = 0
+        frontier = [self._archive_path]
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="xmrg_catalog") as executor:
+            while frontier:
+                results = executor.map(lambda directory: self.scan_directory(directory,
+                                                                             self._directories.get(directory)),
+                                       frontier)
+                next_frontier = []
+                for directory, (directory_entry, listed) in zip(frontier, results):
+                    directories[directory] = directory_entry
+                    listed_count += listed
+                    next_frontier.extend(os.path.join(directory, sub_directory)
+                                         for sub_directory in directory_entry['directories'])
+                frontier = next_frontier
+        self._directories = directories
+        self._logger.debug(f"Catalog scan of: {self._archive_path} listed {listed_count} of "
+                           f"{len(directories)} directories.")
+        self.build_entries()
+        if listed_count:
+            self.save_index()
+
+    def build_entries(self):
+        # If the same hour is in the archive gzipped and uncompressed, keep the gzipped file.
+        entries = {}
+        for directory, directory_entry in self._directories.items():
+            for file_name, (file_type, file_date) in directory_entry['files'].items():
+                key = (file_date, file_type)
+                if key not in entries or file_name.endswith('.gz'):
+                    entries[key] = os.path.join(directory, file_name)
+        self._entries = sorted((datetime.strptime(file_date, "%Y-%m-%dT%H:%M:%S"), file_type, file_path)
+                               for (file_date, file_type), file_path in entries.items())
+        self._entry_dates = [entry[0] for entry in self._entries]
+
+    def files(self, start_date, end_date, file_type=HOURLY_FILE):
+        '''
+        Returns the paths of the files in the archive from the start date up to, but not including, the end date.
+        :param start_date: datetime
+        :param end_date: datetime
+        :param file_type: HOURLY_FILE or DAILY_FILE.
+        :return: List of file paths in date order.
+        '''
+        start = bisect.bisect_left(self._entry_dates, start_date)
+        end = bisect.bisect_left(self._entry_dates, end_date)
+        return [entry[2] for entry in self._entries[start:end] if entry[1] == file_type]
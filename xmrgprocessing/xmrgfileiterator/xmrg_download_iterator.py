@@ -0,0 +1,138 @@
+import os
+import gzip
+import zlib
+import shutil
+import logging.config
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from ..xmrg_utilities import build_filename, http_download_file, create_download_session, \
+    DEFAULT_DOWNLOAD_WORKERS, DEFAULT_DOWNLOAD_TIMEOUT
+
+
+class xmrg_download_iterator:
+    '''
+    Iterator that downloads the hourly XMRG files for a date range and hands back each file as soon as its
+    download finishes, so the workers can start on the first files while the rest are still being fetched.
+    At most max_in_flight files are downloading or downloaded and waiting to be handed off. New downloads only
+    start as the consumer takes files, so a slow consumer never fills the disk and a slow server never leaves
+    it idle for longer than one download.
+    Files are returned in the order their downloads complete, not date order.
+    '''
+    def __init__(self, **kwargs):
+        self._logger = logging.getLogger('xmrg_download_iterator')
+        #Base URL the files are downloaded from.
+        self._download_url = kwargs.get('download_url', None)
+        #Where the files are saved, defaults to the base_xmrg_path given to setup_iterator.
+        self._destination_directory = kwargs.get('destination_directory', None)
+        self._max_in_flight = kwargs.get('max_in_flight', 8)
+        self._max_workers = kwargs.get('max_workers', DEFAULT_DOWNLOAD_WORKERS)
+        self._timeout = kwargs.get('timeout', DEFAULT_DOWNLOAD_TIMEOUT)
+        #Don't download a file again if it already exists in the destination directory.
+        self._skip_existing = kwargs.get('skip_existing', True)
+        #Gunzip each file in the download thread so the workers get an uncompressed file.
+        self._decompress = kwargs.get('decompress', False)
+
+        self._start_date = kwargs.get('start_date', None)
+        self._end_date = kwargs.get('end_date', None)
+        self._failed_files = []
+
+    @property
+    def failed_files(self):
+        return self._failed_files
+
+    def setup_iterator(self, **kwargs):
+        self._start_date = kwargs['start_date']
+        self._end_date = kwargs['end_date']
+        if self._destination_directory is None:
+            self._destination_directory = kwargs.get('full_xmrg_path', None) or kwargs.get('base_xmrg_path', None)
+        self._download_url = kwargs.get('download_url', self._download_url)
+
+    def file_names(self):
+        '''
+        Builds the hourly file names from the start date up to, but not including, the end date.
+        :return:
+        '''
+        file_names = []
+        file_date = self._start_date
+        while file_date < self._end_date:
+            file_names.append(build_filename(file_date, "gz"))
+            file_date += timedelta(hours=1)
+        return file_names
+
+    def fetch_file(self, file_name, session):
+        '''
+        Downloads a file and, if decompress is set, gunzips it. Runs in the download threads.
+        :param file_name: Name of the file to download.
+        :param session: requests.Session shared by the download threads.
+        :return: Path of the file ready for processing or None if the download failed.
+        '''
+        if self._decompress and self._skip_existing and file_name.endswith('.gz'):
+            #An earlier run already downloaded and uncompressed the file.
+            uncompressed_file = os.path.join(self._destination_directory, file_name[:-3])
+            if os.path.exists(uncompressed_file):
+                return uncompressed_file
+        downloaded_file = http_download_file(self._download_url, file_name, self._destination_directory,
+                                             session=session, timeout=self._timeout,
+                                             skip_existing=self._skip_existing)
+        if downloaded_file is not None and self._decompress and downloaded_file.endswith('.gz'):
+            uncompressed_file = downloaded_file[:-3]
+            temp_filename = f"{uncompressed_file}.part"
+            try:
+                with gzip.open(downloaded_file, 'rb') as compressed, open(temp_filename, 'wb') as uncompressed:
+                    shutil.copyfileobj(compressed, uncompressed)
+                os.replace(temp_filename, uncompressed_file)
+            except (OSError, EOFError, zlib.error) as e:
+                #A corrupt or truncated download, remove it so the next run fetches it again.
+                self._logger.error(f"Unable to decompress: {downloaded_file}: {e}")
+                os.remove(downloaded_file)
+                return None
+            finally:
+                if os.path.exists(temp_filename):
+                    os.remove(temp_filename)
+            os.remove(downloaded_file)
+            downloaded_file = uncompressed_file
+        return downloaded_file
+
+    def __iter__(self):
+        return self.download_files()
+
+    def __length_hint__(self):
+        if self._start_date is None or self._end_date is None:
+            return NotImplemented
+        return max(0, -(-int((self._end_date - self._start_date).total_seconds()) // 3600))
+
+    def download_files(self):
+        '''
+        Generator that keeps up to max_in_flight downloads going and yields each file path as it completes.
+        :return:
+        '''
+        if not os.path.exists(self._destination_directory):
+            os.makedirs(self._destination_directory)
+        self._failed_files = []
+        pending_files = self.file_names()
+        pending_files.reverse()
+        session = create_download_session(pool_size=self._max_workers)
+        try:
+            with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="xmrg_download") as executor:
+                in_flight = {}
+                while pending_files or in_flight:
+                    while pending_files and len(in_flight) < self._max_in_flight:
+                        file_name = pending_files.pop()
+                        future = executor.submit(self.fetch_file, file_name, session)
+                        in_flight[future] = file_name
+                    done, not_done = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        file_name = in_flight.pop(future)
+                        downloaded_file = None
+                        try:
+                            downloaded_file = future.result()
+                        except Exception as e:
+                            self._logger.exception(e)
+                        if downloaded_file is not None:
+                            yield downloaded_file
+                        else:
+                            self._logger.error(f"Failed to download: {file_name}")
+                            self._failed_files.append(file_name)
+        finally:
+            session.close()
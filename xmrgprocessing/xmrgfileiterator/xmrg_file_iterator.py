@@ -5,6 +5,7 @@ from pathlib import Path
 from string import Template
 
 from ..xmrg_utilities import file_list_from_date_range, build_filename
+from .xmrg_archive_catalog import xmrg_archive_catalog
 
 DEFAULT_XMRG_PATH = "{base_path}/{year}/{month}"
 class xmrg_file_iterator:
@@ -25,10 +26,34 @@ class xmrg_file_iterator:
         self._end_date = kwargs.get('end_date', None)
         self._current_iterate_date = self._start_date
 
+        #In catalog mode the archive is indexed and we only iterate the files that exist, instead of building
+        #the path for every hour.
+        self._use_catalog = kwargs.get('use_catalog', False)
+        #Optional JSON file to cache the catalog index in between runs.
+        self._catalog_index_file = kwargs.get('catalog_index_file', None)
+        self._catalog = None
+        self._catalog_path = None
+        self._file_ndx = 0
+
     def __iter__(self):
         return self
 
+    def __length_hint__(self):
+        # Number of files left, used by the processing to pick how to run the job.
+        if self._use_catalog:
+            return len(self._file_list) - self._file_ndx
+        if self._current_iterate_date is None or self._end_date is None:
+            return NotImplemented
+        return max(0, -(-int((self._end_date - self._current_iterate_date).total_seconds()) // 3600))
+
     def __next__(self):
+        if self._use_catalog:
+            if self._file_ndx >= len(self._file_list):
+                raise StopIteration
+            full_filepath = self._file_list[self._file_ndx]
+            self._file_ndx += 1
+            return full_filepath
+
         full_filepath = None
         try:
             file_name = build_filename(self._current_iterate_date, "gz")
@@ -75,5 +100,17 @@ class xmrg_file_iterator:
         self._end_date = kwargs['end_date']
         self._current_iterate_date = self._start_date
 
+        if self._use_catalog:
+            archive_path = self._full_xmrg_path if self._full_xmrg_path is not None else self._base_xmrg_path
+            if self._catalog is None or self._catalog_path != archive_path:
+                self._catalog = xmrg_archive_catalog(archive_path, self._catalog_index_file)
+                self._catalog_path = archive_path
+            self._catalog.scan()
+            self._file_list = self._catalog.files(self._start_date, self._end_date)
+            self._file_ndx = 0
+            hour_count = int((self._end_date - self._start_date).total_seconds() // 3600)
+            self._logger.info(f"Catalog has {len(self._file_list)} of {hour_count} hourly files "
+                              f"from: {self._start_date} to: {self._end_date}")
+
         pass
 